@@ -0,0 +1,104 @@
+#!/usr/bin/python3
+# Copyright 2016 Robert Muth <robert@muth.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 3
+# of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+"""
+airtime_test.py checks the airtime estimates and the duty cycle budgets
+without a serial device.
+"""
+
+import logging
+import sys
+
+from pyzwaver import airtime
+from pyzwaver import ratelimit
+from pyzwaver import zwave as z
+from pyzwaver import zmessage
+
+
+def Payload(node, data):
+    return zmessage.MakeRawCommandWithId(node, data, 5, cb_id=1)
+
+
+def TestEstimate():
+    data = [z.SwitchBinary, 1, 0xff]
+    assert airtime.CommandLength(Payload(2, data)) == 3
+    assert airtime.CommandLength(
+        zmessage.MakeRawCommandMultiWithId([2, 3], data, 5, cb_id=1)) == 3
+    # controller messages do not go out over the air
+    assert airtime.CommandLength(zmessage.MakeRawMessage(z.API_ZW_GET_VERSION, [])) == 0
+
+    assert airtime.SpeedFromProtocolInfo(bytes([0xd3, 0x9c, 0x01, 0x04, 0x10, 0x01])) == 40000
+    budget = airtime.AirtimeBudget()
+    slow = budget.Estimate(2, Payload(2, data))
+    budget.SetSpeed(2, 100000)
+    fast = budget.Estimate(2, Payload(2, data))
+    assert abs(slow - 8.0 * (24 + 21) / 9600) < 1e-9
+    assert fast < slow
+    assert budget.Estimate(2, Payload(2, data), attempts=3) == 3 * fast
+
+
+def TestTokenBucketCharge():
+    b = ratelimit.TokenBucket(1.0, 1.0)
+    b.Charge(0.0, 2.0)
+    assert not b.Available(0.5)
+    assert abs(b.Delay(0.5, 1.0) - 1.5) < 1e-9
+
+
+def TestBudget():
+    budget = airtime.AirtimeBudget(max_duty_cycle=0.5, node_duty_cycle=0.1,
+                                   max_burst=0.2, node_max_burst=0.05)
+    p = Payload(2, [z.SwitchBinary, 1, 0xff])
+    cost = budget.Estimate(2, p)
+    assert budget.Delay(0.0, 2, p) == (0.0, 0.0)
+    # use up the burst of node 2
+    t = 0.0
+    while budget.Delay(t, 2, p)[1] == 0.0:
+        budget.Reserve(t, 2, p)
+        budget.Record(t, 2, p, 0)
+    _, node_delay = budget.Delay(t, 2, p)
+    assert node_delay > 0.0
+    # other nodes are not affected
+    assert budget.Delay(t, 3, Payload(3, [z.SwitchBinary, 1, 0xff]))[1] == 0.0
+    # the budget recovers at the duty cycle
+    assert budget.Delay(t + node_delay, 2, p)[1] == 0.0
+
+    # retries count against the budget
+    before = budget.totals[3]
+    budget.Reserve(t, 3, Payload(3, [1]))
+    budget.Record(t, 3, Payload(3, [1]), 2)
+    assert abs(budget.totals[3] - before - 3 * budget.Estimate(3, Payload(3, [1]))) < 1e-9
+
+    u = budget.Utilization(1.0)
+    assert set(u) == {2, 3}
+    assert abs(u[2] - budget.totals[2] / airtime.UTILIZATION_WINDOW_SECS) < 1e-9
+    assert cost > 0
+    # old messages drop out of the window
+    assert budget.Utilization(1000.0) == {}
+    assert "airtime" in budget.UtilizationString(1.0)
+
+
+def main():
+    logging.basicConfig(level=logging.CRITICAL)
+    TestEstimate()
+    TestTokenBucketCharge()
+    TestBudget()
+    print("OK")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -21,12 +21,19 @@ Example command line tool for pairing/unpairing
 
 # python import
 import logging
+import os
 import sys
+import tempfile
+import time
 from typing import Dict, Tuple, List
 import queue
 
+from pyzwaver import command_helper as ch
+from pyzwaver import device_profile
+from pyzwaver.command import CUSTOM_COMMAND_APPLICATION_UPDATE
 from pyzwaver import zmessage
 from pyzwaver.command_translator import CommandTranslator
+from pyzwaver import node as node_module
 from pyzwaver.node import Nodeset, Node
 from pyzwaver import zwave as z
 
@@ -43,6 +50,273 @@ class FakeDriver(object):
         self.history.append(m)
         print(m)
 
+    def PurgeMessages(self, node=None, lane=None, tag=None):
+        return 0
+
+
+def TestMultiCommandBundling(fake_driver, nodeset):
+    gets = ch.CommandVersionQueries(range(0x20, 0x40))
+    bundles = ch.MultiCommandBundles(gets + ch.BasicSet(0xff) + gets[:1], max_size=40)
+    # 32 gets of 3 bytes with 1 byte length prefix each, 9 fit into 40 bytes
+    assert [b[0] for b in bundles] == [z.MultiCmd_Encap] * 4 + [z.Basic_Set, z.MultiCmd_Encap]
+    assert [b[1]["count"] for b in bundles if b[0] == z.MultiCmd_Encap] == [9, 9, 9, 5, 2]
+    # supervised Sets keep their own session and must not be bundled
+    supervised = (z.Supervision_Get, {"session": 1, "command": bytes([z.Basic, 1, 0xff])})
+    bundles = ch.MultiCommandBundles([supervised] + gets[:2] + [supervised])
+    assert [b[0] for b in bundles] == [z.Supervision_Get, z.MultiCmd_Encap, z.Supervision_Get]
+
+    node = nodeset.GetNode(3)
+    for cls in [z.Basic, z.SwitchBinary, z.MultiCmd]:
+        node.put(0, z.Version_CommandClassReport, {"class": cls, "version": 1})
+    del fake_driver.history[:]
+    node.BatchCommandSubmitFilteredSlow([(z.Basic_Get, {}), (z.SwitchBinary_Get, {}),
+                                         (z.Meter_Get, {})])
+    [m] = fake_driver.history
+    # SOF len REQU SEND_DATA node len MultiCmd_Encap ...
+    assert tuple(m.payload[6:8]) == z.MultiCmd_Encap
+
+
+def TestSupervision(fake_driver, nodeset):
+    node = nodeset.GetNode(4)
+    for cls in [z.SwitchBinary, z.Supervision]:
+        node.put(0, z.Version_CommandClassReport, {"class": cls, "version": 1})
+
+    del fake_driver.history[:]
+    node.BatchCommandSubmitFilteredFast(ch.BinarySwitchSet(0xff))
+    # the follow up SwitchBinary_Get is held back
+    [m] = fake_driver.history
+    assert tuple(m.payload[6:8]) == z.Supervision_Get
+    session = m.payload[8]
+    node.put(1, z.Supervision_Report, {"session": session, "status": 0xff, "duration": 0})
+    assert node.values.Get(z.SwitchBinary_Report) == {"level": 0xff}
+
+    del fake_driver.history[:]
+    node.BatchCommandSubmitFilteredFast(ch.BinarySwitchSet(0))
+    session = fake_driver.history[0].payload[8]
+    node.put(2, z.Supervision_Report, {"session": session, "status": 0x02, "duration": 0})
+    # failure: we fall back to asking the node
+    assert tuple(fake_driver.history[-1].payload[6:8]) == z.SwitchBinary_Get
+    assert node.values.Get(z.SwitchBinary_Report) == {"level": 0xff}
+
+    # restoring the last level does not tell us the level
+    node.put(3, z.Version_CommandClassReport, {"class": z.SwitchMultilevel, "version": 1})
+    del fake_driver.history[:]
+    node.BatchCommandSubmitFilteredFast(ch.MultilevelSwitchSet(0xff, request_update=False) +
+                                        [(z.SwitchMultilevel_Get, {})])
+    session = fake_driver.history[0].payload[8]
+    node.put(4, z.Supervision_Report, {"session": session, "status": 0xff, "duration": 0})
+    assert node.values.Get(z.SwitchMultilevel_Report) is None
+    assert tuple(fake_driver.history[-1].payload[6:8]) == z.SwitchMultilevel_Get
+
+    # unanswered sessions fall back to their Gets once they expire, all of them
+    timeout = node_module.SUPERVISION_TIMEOUT_SECS
+    node_module.SUPERVISION_TIMEOUT_SECS = 0.05
+    try:
+        del fake_driver.history[:]
+        node.BatchCommandSubmitFilteredFast(ch.BinarySwitchSet(0xff))
+        node.BatchCommandSubmitFilteredFast(ch.BinarySwitchSet(0))
+        assert len(fake_driver.history) == 2
+        time.sleep(0.3)
+        assert [tuple(m.payload[6:8]) for m in fake_driver.history[2:]] == [
+            z.SwitchBinary_Get, z.SwitchMultilevel_Get] * 2
+
+        # WORKING keeps the session alive for the announced duration
+        del fake_driver.history[:]
+        node.BatchCommandSubmitFilteredFast(ch.BinarySwitchSet(0))
+        session = fake_driver.history[0].payload[8] & 0x3f
+        assert SentKeys(fake_driver) == [z.Supervision_Get]
+        node.put(5, z.Supervision_Report, {"session": session, "status": 0x01, "duration": 1})
+        time.sleep(0.3)
+        assert SentKeys(fake_driver) == []
+        node.put(6, z.Supervision_Report, {"session": session, "status": 0xff, "duration": 0})
+        assert node.values.Get(z.SwitchBinary_Report) == {"level": 0}
+        time.sleep(1.0)
+        assert SentKeys(fake_driver) == []
+    finally:
+        node_module.SUPERVISION_TIMEOUT_SECS = timeout
+
+
+def SentKeys(fake_driver):
+    out = [tuple(m.payload[6:8]) for m in fake_driver.history
+           if m.payload[3] == z.API_ZW_SEND_DATA]
+    del fake_driver.history[:]
+    return out
+
+
+def TestConfigurationDiscovery(fake_driver, nodeset):
+    node = nodeset.GetNode(5)
+    node.put(0, z.Version_CommandClassReport, {"class": z.Configuration, "version": 4})
+    del fake_driver.history[:]
+
+    node.RefreshAllParameters()
+    assert SentKeys(fake_driver) == [z.Configuration_PropertiesGet]
+    # walk the chain 0 -> 1 -> 2 -> 7 -> 0
+    chain = [(0, 0, 1), (1, 1, 2), (2, 1, 7), (7, 2, 0)]
+    for no, size, nxt in chain:
+        props = {"format": 1, "size": size, "next": nxt, "flags": 0}
+        if size:
+            props.update({"min": 0, "max": 100, "default": 0})
+        node.put(1, z.Configuration_PropertiesReport, {"parameter": no, "properties": props})
+        expected = [z.Configuration_PropertiesGet] if nxt else [z.Configuration_BulkGet] * 2
+        assert SentKeys(fake_driver) == expected
+    assert sorted(node.values.ConfigurationProperties()) == [1, 2, 7]
+
+    node.put(2, z.Configuration_BulkReport, {"parameter": 1, "count": 2, "follow": 0,
+                                             "flags": 1, "values": [5, 6]})
+    assert sorted(node.values.Configuration()) == [(1, 1, 5), (2, 1, 6)]
+
+    # parameters 1 and 2 go out in one bulk set, 7 in another
+    bulk = ch.ConfigurationBulkSet([(1, 1, 9), (2, 1, 10), (7, 2, 300)])
+    assert [(c[1]["parameter"], c[1]["count"]) for c in bulk] == [(1, 2), (7, 1)]
+    assert bulk[1][1]["values"] == [1, 44]
+    node.SetParameters([(1, 1, 9), (2, 1, 10)])
+    assert SentKeys(fake_driver) == [z.Configuration_BulkSet]
+
+    # parameters without bulk support are read and written one by one
+    node = nodeset.GetNode(8)
+    node.put(0, z.Version_CommandClassReport, {"class": z.Configuration, "version": 4})
+    del fake_driver.history[:]
+    for no, nxt in [(1, 2), (2, 0)]:
+        props = {"format": 1, "size": 1, "readonly": False, "altering": False,
+                 "min": 0, "max": 100, "default": 0, "next": nxt,
+                 "flags": ch.CONFIGURATION_PROPERTY_ADVANCED | ch.CONFIGURATION_PROPERTY_NO_BULK}
+        node.put(1, z.Configuration_PropertiesReport, {"parameter": no, "properties": props})
+    assert SentKeys(fake_driver) == [z.Configuration_PropertiesGet] + [z.Configuration_Get] * 2
+    node.SetParameters([(1, 1, 9), (2, 1, 10)])
+    assert SentKeys(fake_driver) == [z.Configuration_Set, z.Configuration_Get] * 2
+
+    # older nodes still get the brute force treatment
+    node = nodeset.GetNode(6)
+    node.put(0, z.Version_CommandClassReport, {"class": z.Configuration, "version": 1})
+    del fake_driver.history[:]
+    node.RefreshAllParameters()
+    assert SentKeys(fake_driver) == [z.Configuration_Get] * 255
+
+
+def TestDeviceProfiles(fake_driver):
+    path = os.path.join(tempfile.mkdtemp(), "profiles.json")
+    profiles = device_profile.ProfileCache(path)
+    nodeset = Nodeset(CommandTranslator(fake_driver), 1, profiles)
+    # a binary power switch
+    update = {"type": (4, 0x10, 0x01), "commands": [z.Version, z.ManufacturerSpecific, z.Meter],
+              "controls": []}
+    firmware = {"library": 3, "protocol": 0x0400, "firmware": 0x0100}
+    product = {"manufacturer": 0x86, "type": 3, "product": 6}
+
+    node = nodeset.GetNode(7)
+    node.put(0, CUSTOM_COMMAND_APPLICATION_UPDATE, update)
+    assert SentKeys(fake_driver) == [z.Version_Get, z.ManufacturerSpecific_Get]
+    node.put(1, z.Version_Report, firmware)
+    node.put(1, z.ManufacturerSpecific_Report, product)
+    # unknown product: full interview
+    sent = SentKeys(fake_driver)
+    assert sent.count(z.Version_CommandClassGet) == 6
+    for cls in node.values.Classes():
+        node.put(2, z.Version_CommandClassReport, {"class": cls, "version": 2})
+    assert sorted(SentKeys(fake_driver)) == [z.Meter_SupportedGet,
+                                             z.ManufacturerSpecific_DeviceSpecificGet,
+                                             z.ManufacturerSpecific_DeviceSpecificGet]
+    node.put(3, z.SwitchAll_Report, {"mode": 0xff})
+    node.put(3, z.ManufacturerSpecific_DeviceSpecificReport, {"type": 0})
+    node.put(3, z.ManufacturerSpecific_DeviceSpecificReport, {"type": 1})
+    assert not node.IsInterviewed()
+    node.put(3, z.Meter_SupportedReport, {"type": 1, "scale": 5})
+    assert node.IsInterviewed()
+    assert len(profiles) == 1
+    SentKeys(fake_driver)
+
+    # the next node of the same product only gets identified
+    other = nodeset.GetNode(8)
+    other.put(10, CUSTOM_COMMAND_APPLICATION_UPDATE, update)
+    other.put(11, z.Version_Report, firmware)
+    other.put(11, z.ManufacturerSpecific_Report, product)
+    assert other.IsInterviewed()
+    sent = SentKeys(fake_driver)
+    assert z.Version_CommandClassGet not in sent and z.Meter_SupportedGet not in sent
+    # but the queries specific to the node are still sent
+    assert z.SwitchAll_Get in sent
+    assert other.values.MeterSupported() == {0, 2}
+    assert other.values.CommandVersion(z.Meter) == 2
+
+    # the profiles survive a restart
+    assert len(device_profile.ProfileCache(path)) == 1
+
+
+def TestNodeValueViews(nodeset):
+    node = nodeset.GetNode(5)
+    sensor = {"unit": 0, "exp": 0, "mantissa": 21, "_value": 21.0}
+    node.put(0, z.SensorMultilevel_Report, {"type": 1, "value": sensor})
+    sensors = node.values.Sensors()
+    assert [s[-1] for s in sensors] == [21.0]
+    # unrelated reports keep the view cached
+    node.put(1, z.SwitchBinary_Report, {"level": 0})
+    assert node.values.Sensors() is sensors
+    assert node.values.MiscSensors()[0][-1] == 0
+    # writes invalidate it
+    sensor = dict(sensor, mantissa=22, _value=22.0)
+    node.put(2, z.SensorMultilevel_Report, {"type": 1, "value": sensor})
+    assert [s[-1] for s in node.values.Sensors()] == [22.0]
+    assert node.values.Timestamp(z.SensorMultilevel_Report, (1, 0)) == 2
+    assert node.values.GetMap(z.SensorMultilevel_Report)[(1, 0)] == (2, sensor)
+    node.put(3, z.SwitchBinary_Report, {"level": 0xff})
+    assert node.values.MiscSensors()[0][-1] == 0xff
+    assert node.values.Timestamp(z.SwitchBinary_Report) == 3
+
+
+class ChangeListener:
+
+    def __init__(self):
+        self.changes = []
+
+    def changed(self, n, _ts, key, subkey, old, new):
+        self.changes.append((n, key, subkey, old, new))
+
+
+def Meter(watts, prev):
+    return {"value": {"type": 1, "unit": 2, "exp": 0, "mantissa": watts, "dt": 5,
+                      "mantissa2": prev, "_value": float(watts)}}
+
+
+def TestChangeDetection(fake_driver):
+    nodeset = Nodeset(CommandTranslator(fake_driver), 1)
+    listener = ChangeListener()
+    nodeset.AddChangeListener(listener)
+    nodeset.put(6, 0, z.SwitchBinary_Report, {"level": 0})
+    nodeset.put(6, 1, z.SwitchBinary_Report, {"level": 0})
+    nodeset.put(6, 2, z.SwitchBinary_Report, {"level": 0xff})
+    # not a value changer
+    nodeset.put(6, 3, z.ManufacturerSpecific_DeviceSpecificReport, {"type": 0})
+    assert [(c[3], c[4]) for c in listener.changes] == [
+        (None, {"level": 0}), ({"level": 0}, {"level": 0xff})]
+
+    # only the value counts, not the bookkeeping fields of the report
+    listener.changes.clear()
+    nodeset.put(6, 4, z.Meter_Report, Meter(100, 0))
+    nodeset.put(6, 5, z.Meter_Report, Meter(100, 100))
+    assert len(listener.changes) == 1
+    assert listener.changes[0][2] == (1, 2)
+
+    # changes within the deadband are suppressed, also when they add up slowly
+    nodeset.SetDeadband(z.Meter_Report, 0.5, n=6)
+    listener.changes.clear()
+    for t, watts in enumerate([100.0, 100.3, 99.8, 100.4, 101.0, 100.6]):
+        nodeset.put(6, 6 + t, z.Meter_Report, {"value": dict(Meter(0, 0)["value"], _value=watts)})
+    assert [c[4]["_value"] for c in listener.changes] == [100.0, 101.0]
+
+    # values implied by a confirmed Set are changes as well
+    for cls in [z.SwitchBinary, z.Supervision]:
+        nodeset.put(7, 0, z.Version_CommandClassReport, {"class": cls, "version": 1})
+    listener.changes.clear()
+    del fake_driver.history[:]
+    nodeset.GetNode(7).BatchCommandSubmitFilteredFast(ch.BinarySwitchSet(0xff))
+    session = fake_driver.history[0].payload[8]
+    nodeset.put(7, 1, z.Supervision_Report, {"session": session, "status": 0xff, "duration": 0})
+    nodeset.put(7, 2, z.SwitchBinary_Report, {"level": 0xff})
+    assert [(c[1], c[4]) for c in listener.changes] == [(z.SwitchBinary_Report, {"level": 0xff})]
+
+    nodeset.DropNode(6)
+    assert not [k for k in nodeset._reported if k[0] == 6]
+
 
 def main():
     fake_driver = FakeDriver()
@@ -55,6 +329,12 @@ def main():
     node.put(0, z.Version_CommandClassReport, {"class": z.Basic, "version": 10})
     assert node.values.HasCommandClass(z.Basic)
 
+    TestMultiCommandBundling(fake_driver, nodeset)
+    TestSupervision(fake_driver, nodeset)
+    TestConfigurationDiscovery(fake_driver, nodeset)
+    TestDeviceProfiles(fake_driver)
+    TestNodeValueViews(nodeset)
+    TestChangeDetection(fake_driver)
     print ("OK")
     return 0
 
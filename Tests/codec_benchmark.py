@@ -0,0 +1,114 @@
+#!/usr/bin/python3
+# Copyright 2016 Robert Muth <robert@muth.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 3
+# of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+"""
+codec_benchmark.py compares the compiled command codecs with the
+interpreter of the parse tables.
+It reads the same message format as command_test.py from stdin.
+"""
+
+# python imports
+import logging
+import sys
+import time
+
+# local imports
+
+from pyzwaver import command
+from pyzwaver import command_helper as ch
+from pyzwaver import zmessage
+from pyzwaver import zwave as z
+
+from command_test import ParseToken
+
+ROUNDS = 2000
+
+
+def ReadCommands(fp):
+    out = []
+    for line in fp:
+        if line.startswith("#"): continue
+        token = line.split()
+        if len(token) == 0: continue
+        message = [ParseToken(t) for t in token]
+        if message[0] != z.SOF: continue
+        if message[2] != z.REQUEST: continue
+        if message[3] != z.API_APPLICATION_COMMAND_HANDLER: continue
+        size = message[6]
+        data = command.MaybePatchCommand(message[7:7 + size])
+        out.append(((data[0], data[1]), data, command.ParseCommand(data)))
+    return out
+
+
+def Measure(commands, parse, assemble):
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        for _, data, _ in commands:
+            parse(data)
+    mid = time.perf_counter()
+    for _ in range(ROUNDS):
+        for key, _, value in commands:
+            assemble(key, value)
+    end = time.perf_counter()
+    n = ROUNDS * len(commands)
+    return n / (mid - start), n / (end - mid)
+
+
+def MeasureQueryBatch(make):
+    """Time to build a refresh batch of raw messages for 255 nodes"""
+    queries = (ch.CommandVersionQueries(range(0x20, 0x40)) +
+               ch.SensorMultiLevelQueries(range(1, 8)) +
+               ch.ParameterQueries(range(1, 16)) +
+               ch.BasicSet(0xff))
+    start = time.perf_counter()
+    for n in range(1, 256):
+        for key, values in queries:
+            make(n, key, values)
+    return 255 * len(queries) / (time.perf_counter() - start)
+
+
+def MakeUncached(n, key, values):
+    return zmessage.MakeRawCommandWithId(n, command.AssembleCommand(key, values), 0x25)
+
+
+TEMPLATES = command.AssembleCache(zmessage.MakeRawCommandTemplate)
+
+
+def MakeCached(n, key, values):
+    return zmessage.MakeRawCommandWithIdFromTemplate(n, TEMPLATES.Get(key, values), 0x25)
+
+
+def _main(argv):
+    logging.basicConfig(level=logging.CRITICAL)
+    commands = ReadCommands(sys.stdin)
+    print("commands: %d  rounds: %d" % (len(commands), ROUNDS))
+    interpreted = Measure(commands, command._ParseCommandInterpreted,
+                          command._AssembleCommandInterpreted)
+    compiled = Measure(commands, command.ParseCommand, command.AssembleCommand)
+    for name, i, c in [("parse", interpreted[0], compiled[0]),
+                       ("assemble", interpreted[1], compiled[1])]:
+        print("%-10s interpreted: %10.0f ops/s  compiled: %10.0f ops/s  speedup: %.2fx" %
+              (name, i, c, c / i))
+    uncached = MeasureQueryBatch(MakeUncached)
+    cached = MeasureQueryBatch(MakeCached)
+    print("%-10s uncached:    %10.0f ops/s  cached:   %10.0f ops/s  speedup: %.2fx" %
+          ("batch", uncached, cached, cached / uncached))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(_main(sys.argv[1:]))
@@ -0,0 +1,330 @@
+#!/usr/bin/python3
+# Copyright 2016 Robert Muth <robert@muth.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 3
+# of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+"""
+codec_fuzz.py generates valid and mutated payloads for every entry of
+SUBCMD_TO_PARSE_TABLE and feeds them through the codecs.
+
+It reports
+* parse and assemble throughput per field kind and per command
+* crashes, i.e. exceptions other than ValueError, on any payload
+* round trip mismatches on valid payloads
+
+Use --report to also write the results as json.
+The exit code is non-zero if valid payloads crash or do not round trip.
+"""
+
+# python imports
+import argparse
+import collections
+import json
+import logging
+import random
+import sys
+import time
+
+# local imports
+
+from pyzwaver import command
+from pyzwaver import zwave as z
+
+
+def _Bytes(rng, n):
+    return [rng.randrange(256) for _ in range(n)]
+
+
+def _GenMantissa(rng):
+    return _Bytes(rng, rng.choice([1, 2, 4]))
+
+
+def _GenMeter(rng):
+    mantissa = _GenMantissa(rng)
+    size = len(mantissa)
+    c1 = rng.randrange(256)
+    c2 = rng.randrange(8) << 5 | rng.randrange(4) << 3 | size
+    if rng.random() < 0.3:
+        # version 1 without delta time and previous value
+        return [c1, c2] + mantissa
+    return [c1, c2] + mantissa + _Bytes(rng, 2) + _Bytes(rng, size)
+
+
+def _GenExtensions(rng):
+    extensions = []
+    count = rng.randrange(3)
+    for i in range(count):
+        data = _Bytes(rng, rng.randrange(4))
+        more = 0x80 if i < count - 1 else 0
+        extensions += [len(data) + 2, rng.randrange(0x80) | more] + data
+    mode = rng.randrange(128) << 1 | (1 if count else 0)
+    return [mode] + extensions + _Bytes(rng, rng.randrange(16))
+
+
+def _GenGroups(rng):
+    out = []
+    for _ in range(rng.randrange(4)):
+        out += [rng.randrange(256), 0, rng.randrange(256), rng.randrange(256),
+                0, rng.randrange(256), rng.randrange(256)]
+    return out
+
+
+def _GenString(rng):
+    size = rng.randrange(32)
+    return [rng.randrange(8) << 5 | size] + _Bytes(rng, size)
+
+
+def _GenValue(rng):
+    size = rng.choice([1, 2, 4])
+    return [size] + _Bytes(rng, size)
+
+
+def _GenSensor(rng):
+    mantissa = _GenMantissa(rng)
+    return [rng.randrange(8) << 5 | rng.randrange(4) << 3 | len(mantissa)] + mantissa
+
+
+def _GenConfigurationProperties(rng):
+    size = rng.choice([0, 1, 2, 4])
+    out = [rng.randrange(4) << 6 | rng.randrange(4) << 3 | size] + _Bytes(rng, 3 * size) + _Bytes(rng, 2)
+    if rng.random() < 0.5:
+        # version 4 flags
+        out += _Bytes(rng, 1)
+    return out
+
+
+def _GenTarget(rng):
+    n = rng.randrange(4)
+    return [n] + _Bytes(rng, 2 * n)
+
+
+# Generators for the wire representation of a valid field of each kind.
+# The second element tells whether the field may be omitted when trailing.
+_GENERATORS = {
+    "A": (lambda rng: (lambda size: [size] + _Bytes(rng, size))(rng.randrange(16)), False),
+    "B": (lambda rng: _Bytes(rng, 1), False),
+    "C": (lambda rng: _Bytes(rng, 7), False),
+    "E": (_GenExtensions, False),
+    "F": (_GenString, False),
+    "G": (_GenGroups, False),
+    "L": (lambda rng: _Bytes(rng, rng.randrange(16)), False),
+    "M": (_GenMeter, False),
+    "O": (lambda rng: _Bytes(rng, 8), False),
+    "P": (_GenConfigurationProperties, False),
+    "R": (lambda rng: _Bytes(rng, rng.randrange(1, 5)), False),
+    "V": (_GenValue, False),
+    "W": (lambda rng: _Bytes(rng, 2), False),
+    "X": (_GenSensor, False),
+    "b": (lambda rng: _Bytes(rng, 1), True),
+    "t": (_GenTarget, True),
+}
+
+
+def _Fields(table):
+    return [(t[0], t[2:-1]) for t in table]
+
+
+def GenerateValid(rng, key, fields):
+    out = [key >> 8, key & 0xff]
+    omit = rng.random() < 0.2
+    for kind, _ in fields:
+        gen, optional = _GENERATORS[kind]
+        if optional and omit:
+            # once we omit an optional field all following ones must be omitted
+            break
+        out += gen(rng)
+    return out
+
+
+def Mutate(rng, data):
+    data = data[:]
+    choice = rng.randrange(4)
+    if choice == 0 and len(data) > 2:
+        del data[rng.randrange(2, len(data)):]
+    elif choice == 1:
+        data += _Bytes(rng, rng.randrange(1, 8))
+    elif choice == 2 and len(data) > 2:
+        data[rng.randrange(2, len(data))] = rng.randrange(256)
+    else:
+        pos = rng.randrange(2, len(data) + 1)
+        data[pos:pos] = _Bytes(rng, 1)
+    return data
+
+
+class Report:
+
+    def __init__(self, seed, rounds):
+        self.seed = seed
+        self.rounds = rounds
+        self.kinds = {}
+        self.commands = {}
+        self.unsupported = []
+        self.crashes = collections.Counter()
+        self.mismatches = collections.Counter()
+        self.rejected = collections.Counter()
+        self.examples = {}
+
+    def Record(self, counter, what, name, data, e=None):
+        k = (name, what if e is None else "%s: %s" % (what, type(e).__name__))
+        counter[k] += 1
+        self.examples.setdefault(k, " ".join("%02x" % x for x in data))
+
+    def Failed(self):
+        return any(what.startswith("valid") for _, what in
+                   list(self.crashes) + list(self.mismatches))
+
+    def ToJson(self):
+        def rows(counter):
+            return [{"command": name, "what": what, "count": count,
+                     "example": self.examples[(name, what)]}
+                    for (name, what), count in sorted(counter.items())]
+
+        return {
+            "seed": self.seed,
+            "rounds": self.rounds,
+            "kinds": self.kinds,
+            "commands": self.commands,
+            "unsupported": self.unsupported,
+            "crashes": rows(self.crashes),
+            "mismatches": rows(self.mismatches),
+            "rejected": rows(self.rejected),
+        }
+
+
+def _OpsPerSecond(func, items):
+    start = time.perf_counter()
+    for x in items:
+        func(x)
+    elapsed = time.perf_counter() - start
+    return len(items) / max(elapsed, 1e-9)
+
+
+def FuzzCommand(rng, report, key, fields, rounds):
+    name = z.SUBCMD_TO_STRING.get(key, "%04x" % key)
+    cmd_key = (key >> 8, key & 0xff)
+    valid = []
+    for _ in range(rounds):
+        data = GenerateValid(rng, key, fields)
+        try:
+            values = command.ParseCommand(data)
+        except Exception as e:
+            report.Record(report.crashes, "valid", name, data, e)
+            continue
+        try:
+            data2 = command.AssembleCommand(cmd_key, values)
+        except Exception as e:
+            report.Record(report.crashes, "valid assemble", name, data, e)
+            continue
+        if data2 != data:
+            report.Record(report.mismatches, "valid round trip", name, data)
+            continue
+        valid.append((data, values))
+
+    for data, _ in valid:
+        for _ in range(4):
+            mutated = Mutate(rng, data)
+            try:
+                values = command.ParseCommand(mutated)
+            except ValueError as e:
+                report.Record(report.rejected, "mutated", name, mutated, e)
+                continue
+            except Exception as e:
+                report.Record(report.crashes, "mutated", name, mutated, e)
+                continue
+            try:
+                data2 = command.AssembleCommand(cmd_key, values)
+            except Exception as e:
+                report.Record(report.crashes, "mutated assemble", name, mutated, e)
+                continue
+            try:
+                again = command.ParseCommand(data2)
+            except ValueError:
+                again = None
+            except Exception as e:
+                report.Record(report.crashes, "mutated reparse", name, mutated, e)
+                continue
+            if again != values:
+                report.Record(report.mismatches, "mutated round trip", name, mutated)
+
+    if valid:
+        report.commands[name] = {
+            "parse_ops": _OpsPerSecond(command.ParseCommand, [d for d, _ in valid]),
+            "assemble_ops": _OpsPerSecond(lambda v: command.AssembleCommand(cmd_key, v),
+                                          [v for _, v in valid]),
+        }
+
+
+def MeasureKinds(rng, report, rounds):
+    for kind, (gen, _) in sorted(_GENERATORS.items()):
+        parser, maker = command._PARSE_ACTIONS[kind]
+        samples = [[0, 0] + gen(rng) for _ in range(rounds)]
+        values = [parser(m, 2)[1] for m in samples]
+        report.kinds[kind] = {
+            "parse_ops": _OpsPerSecond(lambda m: parser(m, 2), samples),
+            "assemble_ops": _OpsPerSecond(maker, values),
+        }
+
+
+def PrintReport(report: Report, slowest):
+    print("seed: %d  rounds: %d" % (report.seed, report.rounds))
+    print()
+    print("kind  parse ops/s  assemble ops/s")
+    for kind, r in sorted(report.kinds.items()):
+        print("%-4s %12.0f %15.0f" % (kind, r["parse_ops"], r["assemble_ops"]))
+    print()
+    print("slowest commands (parse ops/s)")
+    for name, r in sorted(report.commands.items(), key=lambda x: x[1]["parse_ops"])[:slowest]:
+        print("  %-50s %10.0f" % (name, r["parse_ops"]))
+    print()
+    print("unsupported: %s" % " ".join(report.unsupported))
+    for title, counter in [("crashes", report.crashes), ("mismatches", report.mismatches)]:
+        print()
+        print("%s: %d" % (title, sum(counter.values())))
+        for (name, what), count in sorted(counter.items()):
+            print("  %-50s %-30s %5d  e.g. %s" % (name, what, count,
+                                                  report.examples[(name, what)]))
+    print()
+    print("rejected mutations: %d" % sum(report.rejected.values()))
+
+
+def _main(argv):
+    parser = argparse.ArgumentParser(description="codec fuzzer and benchmark")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--rounds", type=int, default=200,
+                        help="valid payloads generated per command")
+    parser.add_argument("--slowest", type=int, default=10)
+    parser.add_argument("--report", default=None, help="write json report here")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.CRITICAL)
+
+    rng = random.Random(args.seed)
+    report = Report(args.seed, args.rounds)
+    for key, table in sorted(z.SUBCMD_TO_PARSE_TABLE.items()):
+        fields = _Fields(table)
+        if any(kind not in _GENERATORS for kind, _ in fields):
+            report.unsupported.append(z.SUBCMD_TO_STRING.get(key, "%04x" % key))
+            continue
+        FuzzCommand(rng, report, key, fields, args.rounds)
+    MeasureKinds(rng, report, 20 * args.rounds)
+
+    PrintReport(report, args.slowest)
+    if args.report:
+        with open(args.report, "w") as fp:
+            json.dump(report.ToJson(), fp, sort_keys=True, indent=2)
+    return 1 if report.Failed() else 0
+
+
+if __name__ == "__main__":
+    sys.exit(_main(sys.argv[1:]))
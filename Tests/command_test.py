@@ -55,6 +55,9 @@ def Hexify(t):
 
 
 
+PARSE_CACHE = command.ParseCache()
+
+
 def ProcessApplicationData(data):
     print("application data: ", Hexify(data))
     data = command.MaybePatchCommand(data)
@@ -64,9 +67,24 @@ def ProcessApplicationData(data):
 
     value = command.ParseCommand(data)
     print (value)
+    # the compiled codecs must agree with the interpreter
+    assert value == command._ParseCommandInterpreted(data)
     data2 = command.AssembleCommand(k, value)
     print("assembled data: ", Hexify(data2))
     assert data == data2
+    assert data2 == command._AssembleCommandInterpreted(k, value)
+    # records are immutable but must still assemble to the same bytes
+    record = command.ParseRecord(data)
+    assert record.keys() == value.keys()
+    assert record == command.MakeRecord(k, value)
+    assert hash(record) == hash(command.MakeRecord(k, value))
+    assert command.AssembleCommand(k, record) == data
+    frozen = PARSE_CACHE.Parse(data)
+    assert frozen == record
+    assert frozen is PARSE_CACHE.Parse(data)
+    cached = command.AssembleCommandCached(k, value)
+    assert cached == tuple(data)
+    assert cached is command.AssembleCommandCached(k, value)
 
 
 def _main(argv):
@@ -88,6 +106,8 @@ def _main(argv):
         size = message[6]
         data = message[7:7 + size]
         ProcessApplicationData(data)
+    print()
+    print("parse cache: ", PARSE_CACHE)
     return 0
 
 
@@ -0,0 +1,217 @@
+#!/usr/bin/python3
+# Copyright 2016 Robert Muth <robert@muth.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 3
+# of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+"""
+frame_test.py checks the inbound Frame, the decapsulation and the lazily
+decoded command values.
+"""
+
+import json
+import logging
+import sys
+
+from pyzwaver import command
+from pyzwaver import zmessage
+from pyzwaver import zwave as z
+from pyzwaver.command_translator import CommandTranslator, Decapsulate, SECURITY_S2
+from pyzwaver.zmessage import Crc16
+
+# SOF len:09 REQU API_APPLICATION_COMMAND_HANDLER:04 00 node:09 len:03 Basic_Report:20 X:03 ff chk:24
+BASIC_REPORT = [0x01, 0x09, 0x00, 0x04, 0x00, 0x09, 0x03, 0x20, 0x03, 0xff, 0x24]
+
+
+class FakeDriver:
+
+    def AddListener(self, _l):
+        pass
+
+
+class RoutingListener:
+
+    def __init__(self):
+        self.seen = []
+
+    def put(self, n, _ts, key, values):
+        self.seen.append((n, key, values))
+
+
+def TestFrame():
+    f = zmessage.Frame(BASIC_REPORT)
+    assert f == bytes(BASIC_REPORT)
+    assert len(f) == len(BASIC_REPORT)
+    assert f[3] == z.API_APPLICATION_COMMAND_HANDLER
+    assert f[4:-1] == bytes(BASIC_REPORT[4:-1])
+    assert f.IsRequest()
+    assert f.Func() == z.API_APPLICATION_COMMAND_HANDLER
+    assert f.Node() == 9
+    assert f.CommandKey() == z.Basic_Report
+    assert bytes(f.Command()) == bytes([0x20, 0x03, 0xff])
+    assert "Basic_Report" in str(f)
+
+    ack = zmessage.Frame(zmessage.RAW_MESSAGE_ACK)
+    assert ack.Node() == -1
+    assert ack.CommandKey() is None
+
+
+def TestLazyValues():
+    translator = CommandTranslator(FakeDriver())
+    listener = RoutingListener()
+    translator.AddListener(listener)
+    translator.put(1, zmessage.Frame(BASIC_REPORT))
+    n, key, values = listener.seen[0]
+    assert (n, key) == (9, z.Basic_Report)
+    assert not values.Decoded()
+    assert values["level"] == 255
+    assert values.Decoded()
+    assert values == {"level": 255}
+
+
+def TestParseError():
+    # Basic_Report without the level byte
+    broken = [0x01, 0x08, 0x00, 0x04, 0x00, 0x09, 0x02, 0x20, 0x03, 0x00]
+    values = command.CommandValues(zmessage.Frame(broken).Command())
+    try:
+        values.Decode()
+        assert False, "expected a parse error"
+    except ValueError:
+        pass
+
+
+def MakeApplicationCommand(n, data):
+    out = [z.SOF, len(data) + 6, z.REQUEST, z.API_APPLICATION_COMMAND_HANDLER, 0, n, len(data)]
+    out += data
+    out.append(zmessage.Checksum(out) ^ z.SOF)
+    return out
+
+
+def Crc16Encap(data):
+    data = [0x56, 0x01] + data
+    crc = Crc16(data)
+    return data + [crc >> 8, crc & 0xff]
+
+
+def TestDecapsulate():
+    assert Crc16(b"123456789") == 0xe5cc
+    switch_report = [0x25, 0x03, 0xff]
+    # CRC16 wrapping a multi channel command from endpoint 2
+    wrapped = Crc16Encap([0x60, 0x0d, 0x02, 0x00] + switch_report)
+    [(inner, endpoint, security, path)] = Decapsulate(9, memoryview(bytes(wrapped)))
+    assert bytes(inner) == bytes(switch_report)
+    assert endpoint == 2
+    assert security is None
+    assert path == (z.CRC16Encap_Encap, z.MultiChannel_ChannelEncap)
+
+    # a corrupted crc drops the command
+    wrapped[-1] ^= 1
+    assert Decapsulate(9, memoryview(bytes(wrapped))) == []
+
+    multi = [0x8f, 0x01, 0x02, len(switch_report)] + switch_report + [3, 0x20, 0x03, 0x00]
+    out = Decapsulate(9, memoryview(bytes(multi)))
+    assert [bytes(x[0]) for x in out] == [bytes(switch_report), bytes([0x20, 0x03, 0x00])]
+
+    # S2 is only unwrapped given a decryptor
+    s2 = [0x9f, 0x03, 0x01, 0x00, 0xaa, 0xbb]
+    [(inner, _, security, _)] = Decapsulate(9, memoryview(bytes(s2)))
+    assert bytes(inner) == bytes(s2) and security is None
+    [(inner, _, security, path)] = Decapsulate(9, memoryview(bytes(s2)),
+                                               lambda n, data: bytes(switch_report))
+    assert bytes(inner) == bytes(switch_report)
+    assert security == SECURITY_S2
+    assert path == (z.Security2_MessageEncapsulation,)
+
+    translator = CommandTranslator(FakeDriver())
+    listener = RoutingListener()
+    translator.AddListener(listener)
+    translator.put(1, MakeApplicationCommand(9, multi))
+    translator.put(2, MakeApplicationCommand(9, [0x60, 0x0d, 0x03, 0x00] + switch_report))
+    assert [(n, key) for n, key, _ in listener.seen] == [
+        (9, z.SwitchBinary_Report), (9, z.Basic_Report), (9, z.SwitchBinary_Report)]
+    values = listener.seen[2][2]
+    assert values.endpoint == 3
+    assert values["level"] == 0xff
+
+
+def TestParseCache():
+    cache = command.EnableParseCache(size=2)
+    try:
+        first = command.CommandValues(zmessage.Frame(BASIC_REPORT).Command()).Decode()
+        second = command.CommandValues(zmessage.Frame(BASIC_REPORT).Command()).Decode()
+        assert first is second
+        assert (cache.hits, cache.misses) == (1, 1)
+        try:
+            first["level"] = 0
+            assert False, "cached values must be immutable"
+        except TypeError:
+            pass
+        for level in range(3):
+            cache.Parse([0x20, 0x03, level])
+        assert len(cache) == 2
+    finally:
+        command.DisableParseCache()
+
+
+def TestRecords():
+    meter = [0x32, 0x02, 0x21, 0x74, 0x00, 0x00, 0xa8, 0xa7, 0x00, 0x53, 0x00, 0x02, 0x60, 0x11]
+    r = command.ParseRecord(meter)
+    assert type(r).__name__ == "Meter_Report"
+    assert r == command.ParseRecord(meter)
+    assert r["value"]["mantissa"] == (0, 0, 0xa8, 0xa7)
+    assert r.value.unit == 2
+    assert "hardware" not in command.ParseRecord([0x86, 0x12, 3, 2, 78, 1, 43])
+    d = r.AsDict()
+    assert type(d["value"]) is dict
+    assert d["value"]["mantissa"] == [0, 0, 0xa8, 0xa7]
+    # sets become sorted lists so the dicts can be encoded as json
+    supported = command.MakeRecord(z.SensorMultilevel_SupportedReport,
+                                   {"bits": {"size": 1, "value": {3, 1}}})
+    assert json.loads(json.dumps(supported.AsDict())) == {"bits": {"size": 1, "value": [1, 3]}}
+    try:
+        r.value = 1
+        assert False, "records must be immutable"
+    except TypeError:
+        pass
+    try:
+        r["value"] = 1
+        assert False, "records must be immutable"
+    except TypeError:
+        pass
+    # names clashing with keywords or Mapping methods get an underscore
+    kex = command.MakeRecord(z.Security2_KexReport, {"mode": 0, "schemes": 2,
+                                                     "profiles": 1, "keys": 1})
+    assert kex.keys_ == 1 and kex["keys"] == 1
+    assert list(kex.keys()) == ["mode", "schemes", "profiles", "keys"]
+    assert command.MakeRecord(z.Version_CommandClassReport,
+                              {"class": 0x20, "version": 1}).class_ == 0x20
+    # custom commands have no record type
+    assert command.MakeRecord(command.CUSTOM_COMMAND_FAILED_NODE, {"failed": True}) == {
+        "failed": True}
+
+
+def main():
+    logging.basicConfig(level=logging.CRITICAL)
+    TestFrame()
+    TestLazyValues()
+    TestParseError()
+    TestParseCache()
+    TestDecapsulate()
+    TestRecords()
+    print("OK")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
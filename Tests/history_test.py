@@ -0,0 +1,78 @@
+#!/usr/bin/python3
+# Copyright 2016 Robert Muth <robert@muth.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 3
+# of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+"""
+history_test.py checks the bounded value history and its integration with
+NodeValues.
+"""
+
+import logging
+import sys
+
+from pyzwaver import zwave as z
+from pyzwaver.history import ValueHistory
+from pyzwaver.node import NodeValues
+
+
+def TestValueHistory():
+    h = ValueHistory(capacity=8)
+    for t in range(8):
+        h.Add(float(t), 10.0 * t)
+    assert len(h) == 8
+    assert h.Range(2.0, 4.0) == [(2.0, 20.0), (3.0, 30.0), (4.0, 40.0)]
+    # a full buffer halves the resolution of its older half
+    h.Add(8.0, 80.0)
+    assert len(h) == 7
+    assert h.downsampled == 1
+    assert h.Range(0.0, 3.9) == [(0.0, 0.0), (2.0, 20.0)]
+    assert h.Range(4.0) == [(t, 10.0 * t) for t in [4.0, 5.0, 6.0, 7.0, 8.0]]
+    assert h.Last() == (8.0, 80.0)
+    # the buffer never grows beyond its capacity
+    for t in range(9, 1000):
+        h.Add(float(t), 1.0)
+    assert len(h) <= 8
+    assert h.Range(0.0)[0] == (0.0, 0.0)
+    # out of order samples keep the buffer sorted
+    h.Add(998.5, 2.0)
+    ts = [t for t, _ in h.Range(0.0)]
+    assert ts == sorted(ts)
+
+
+def TestNodeValuesHistory():
+    values = NodeValues()
+    values.TrackDefaultHistory(capacity=16)
+    for t in range(3):
+        values.SetMapEntry(float(t), z.Meter_Report, (1, 2), {"unit": 2, "_value": 100.0 + t})
+        values.Set(float(t), z.SwitchMultilevel_Report, {"level": 10 * t})
+        # not tracked
+        values.Set(float(t), z.Basic_Report, {"level": t})
+    assert values.History(z.Meter_Report, (1, 2)).Range(1.0) == [(1.0, 101.0), (2.0, 102.0)]
+    assert len(values.History(z.SwitchMultilevel_Report)) == 3
+    assert values.History(z.Basic_Report) is None
+    assert len(values.Histories()) == 2
+
+
+def main():
+    logging.basicConfig(level=logging.CRITICAL)
+    TestValueHistory()
+    TestNodeValuesHistory()
+    print("OK")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,131 @@
+#!/usr/bin/python3
+# Copyright 2016 Robert Muth <robert@muth.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 3
+# of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+"""
+interview_test.py checks the order and retry behavior of the node interview
+planner without a serial device.
+"""
+
+import logging
+import sys
+
+from pyzwaver import interview
+from pyzwaver import zwave as z
+from pyzwaver.node import NodeValues
+
+STATIC = interview.INTERVIEW_STATIC
+DYNAMIC = interview.INTERVIEW_DYNAMIC
+
+CLASSES = [z.Version, z.ManufacturerSpecific, z.SensorMultilevel, z.Meter, z.Basic]
+
+
+def MakeValues(versions):
+    values = NodeValues()
+    for cls in CLASSES:
+        values.SetMapEntry(0, z.Version_CommandClassReport, cls, versions.get(cls, -1))
+    return values
+
+
+def Keys(queries):
+    return [q[0] for q in queries]
+
+
+def TestVersionsFirst():
+    values = MakeValues({})
+    planner = interview.InterviewPlanner()
+    plan = planner.Plan(values, STATIC, 0.0)
+    # SupportedGets wait for the versions, so does the final ManufacturerSpecific_Get
+    assert Keys(plan) == [z.Version_CommandClassGet] * len(CLASSES) + [z.Version_Get]
+    # nothing is re-sent while the queries are in flight
+    assert planner.Plan(values, STATIC, 1.0) == []
+
+    versions = {z.Version: 2, z.ManufacturerSpecific: 1, z.SensorMultilevel: 5,
+                z.Meter: 1, z.Basic: 1}
+    for cls, v in versions.items():
+        values.SetMapEntry(1, z.Version_CommandClassReport, cls, v)
+    plan = planner.Plan(values, STATIC, 2.0)
+    # no Meter_SupportedGet or DeviceSpecificGet for v1
+    assert Keys(plan) == [z.SensorMultilevel_SupportedGet, z.ManufacturerSpecific_Get]
+
+    # the sensor values depend on the supported report
+    assert Keys(planner.Plan(values, DYNAMIC, 3.0)) == [z.Basic_Get, z.Meter_Get]
+    values.Set(4, z.SensorMultilevel_SupportedReport, {"bits": {"value": 0x05}})
+    plan = planner.Plan(values, DYNAMIC, 4.0, ["sensor-values"])
+    assert plan == [(z.SensorMultilevel_Get, {"sensor": 1}),
+                    (z.SensorMultilevel_Get, {"sensor": 3})]
+
+
+def TestRetries():
+    values = MakeValues({z.Version: 1, z.ManufacturerSpecific: 2, z.SensorMultilevel: 1,
+                         z.Meter: 1, z.Basic: 1})
+    planner = interview.InterviewPlanner(retry_secs=10.0, max_tries=2)
+    plan = planner.Plan(values, STATIC, 0.0)
+    assert Keys(plan) == [z.Version_Get, z.ManufacturerSpecific_DeviceSpecificGet,
+                          z.ManufacturerSpecific_DeviceSpecificGet, z.ManufacturerSpecific_Get]
+    values.Set(1, z.Version_Report, {"library": 3})
+    values.SetMapEntry(1, z.ManufacturerSpecific_DeviceSpecificReport, 0, {"type": 0})
+    # only the unanswered queries are retried, the device type does not
+    # answer the serial number query
+    assert planner.Plan(values, STATIC, 11.0) == [
+        (z.ManufacturerSpecific_DeviceSpecificGet, {"type": 1}), (z.ManufacturerSpecific_Get, {})]
+    # and eventually given up
+    assert planner.Plan(values, STATIC, 22.0) == []
+    progress = planner.Progress(values, 22.0)
+    assert progress["product"] == interview.STEP_COMPLETE
+    assert progress["versions"] == interview.STEP_COMPLETE
+    assert progress["Meter_SupportedGet"] == interview.STEP_SKIPPED
+
+
+def TestUnversioned():
+    # without the Version command class we assume version 1
+    values = NodeValues()
+    for cls in [z.ManufacturerSpecific, z.Meter]:
+        values.SetMapEntry(0, z.Version_CommandClassReport, cls, -1)
+    planner = interview.InterviewPlanner()
+    assert Keys(planner.Plan(values, STATIC, 0.0)) == [z.ManufacturerSpecific_Get]
+
+
+def TestOnDemand():
+    values = MakeValues({z.Version: 1, z.ManufacturerSpecific: 1, z.SensorMultilevel: 1,
+                         z.Meter: 1, z.Basic: 1})
+    values.SetMapEntry(0, z.Version_CommandClassReport, z.SceneActuatorConf, 1)
+    values.SetMapEntry(0, z.SceneActuatorConf_Report, 3, {"scene": 3})
+    planner = interview.InterviewPlanner(retry_secs=10.0)
+    # scene configurations are not part of the regular interview
+    for kind in [STATIC, interview.INTERVIEW_SEMI_STATIC]:
+        assert z.SceneActuatorConf_Get not in Keys(planner.Plan(values, kind, 0.0))
+    # and only the unknown ones are asked for
+    plan = planner.Plan(values, interview.INTERVIEW_ON_DEMAND, 0.0, ["scene-configurations"])
+    assert [q[1]["scene"] for q in plan] == [s for s in range(1, 256) if s != 3]
+    for s in range(1, 255):
+        values.SetMapEntry(1, z.SceneActuatorConf_Report, s, {"scene": s})
+    plan = planner.Plan(values, interview.INTERVIEW_ON_DEMAND, 11.0, ["scene-configurations"])
+    assert plan == [(z.SceneActuatorConf_Get, {"scene": 255})]
+
+
+def main():
+    logging.basicConfig(level=logging.CRITICAL)
+    TestVersionsFirst()
+    TestRetries()
+    TestUnversioned()
+    TestOnDemand()
+    print("OK")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,169 @@
+#!/usr/bin/python3
+# Copyright 2016 Robert Muth <robert@muth.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 3
+# of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+"""
+message_queue_test.py exercises the outbound message queue of the driver
+without a serial device.
+"""
+
+import logging
+import sys
+import threading
+import time
+
+from pyzwaver import airtime
+from pyzwaver import command
+from pyzwaver import zmessage
+from pyzwaver import zwave as z
+from pyzwaver.driver import AirtimeGate, MessageQueueOut, PendingMessages
+
+
+def MakeMessage(n, priority, results, tag=None):
+    payload = zmessage.MakeRawCommandWithId(n, [z.Basic, 2], 0x25)
+    return zmessage.Message(payload, priority, lambda m: results.append((n, m)), n,
+                            tag=tag)
+
+
+def TestCancel():
+    results = []
+    m = MakeMessage(2, zmessage.NodePriorityLo(2), results)
+    # the payload is only prettified if somebody logs it
+    prettify = zmessage.PrettifyRawMessage
+    zmessage.PrettifyRawMessage = None
+    try:
+        assert m.Cancel()
+    finally:
+        zmessage.PrettifyRawMessage = prettify
+    assert m.WasCancelled()
+    assert results == [(2, None)]
+    # a cancelled message must not be started
+    assert not m.Start(time.time(), threading.Lock())
+    # and cannot be cancelled twice
+    assert not m.Cancel()
+
+
+def TestPurge():
+    results = []
+    q = MessageQueueOut()
+    for n in [2, 3, 2, 4]:
+        q.put(zmessage.NodePriorityLo(n), MakeMessage(n, zmessage.NodePriorityLo(n), results))
+    q.put(zmessage.NodePriorityHi(3),
+          MakeMessage(3, zmessage.NodePriorityHi(3), results, tag="refresh"))
+
+    purged = q.purge(lambda m: m.node == 2)
+    assert len(purged) == 2
+    assert q.qsize() == 3
+
+    purged = q.purge(lambda m: m.tag == "refresh")
+    assert len(purged) == 1
+    assert q.qsize() == 2
+    assert "2:" not in str(q)
+
+    assert q.get().node == 3
+    assert q.get().node == 4
+
+
+def TestBarrier():
+    pending = PendingMessages()
+    m2a = MakeMessage(2, zmessage.NodePriorityLo(2), [])
+    m2b = MakeMessage(2, zmessage.NodePriorityHi(2), [])
+    m3 = MakeMessage(3, zmessage.NodePriorityLo(3), [])
+    for m in [m2a, m3, m2b]:
+        pending.Add(m)
+
+    assert pending.Barrier([4]).done()
+    b2 = pending.Barrier([2])
+    b2_lo = pending.Barrier([2], lane=zmessage.NodePriorityLo(2)[0])
+    b_all = pending.Barrier()
+    # messages sent after the barrier do not matter
+    pending.Add(MakeMessage(2, zmessage.NodePriorityLo(2), []))
+
+    pending.Done(m2a)
+    assert b2_lo.done()
+    assert not b2.done()
+    pending.Done(m2b)
+    assert b2.done()
+    assert not b_all.done()
+    pending.Done(m3)
+    assert b_all.done()
+
+
+def TestCommandTemplate():
+    templates = command.AssembleCache(zmessage.MakeRawCommandTemplate)
+    args = {"class": z.Basic}
+    t = templates.Get(z.Version_CommandClassGet, args)
+    assert t is templates.Get(z.Version_CommandClassGet, {"class": z.Basic})
+    assert len(templates) == 1
+    for n in [2, 231]:
+        expected = zmessage.MakeRawCommandWithId(
+            n, command.AssembleCommand(z.Version_CommandClassGet, args), 0x25, cb_id=7)
+        assert zmessage.MakeRawCommandWithIdFromTemplate(n, t, 0x25, cb_id=7) == expected
+    # nested arguments are not hashable as is
+    args = {"parameter": 3, "value": {"size": 2, "value": 300}}
+    assert templates.Get(z.Configuration_Set, args) is templates.Get(z.Configuration_Set, args)
+
+
+def TestAirtimeGateKeepsOrder():
+    budget = airtime.AirtimeBudget(node_duty_cycle=0.1, node_max_burst=0.01)
+    gate = AirtimeGate(budget)
+    q = MessageQueueOut()
+    messages = [MakeMessage(2, zmessage.NodePriorityLo(2), [], tag=tag)
+                for tag in ["set", "get1", "get2"]]
+    messages.append(MakeMessage(3, zmessage.NodePriorityLo(3), [], tag="other"))
+    for m in messages:
+        q.put(m.priority, m)
+
+    # mimics Driver._NextMessage() and the airtime accounting of a send
+    sent = []
+    now = 0.0
+    while q.qsize() or len(gate):
+        m = gate.Release(now)
+        if m is None:
+            m = q.get(0.0)
+            if m is None or gate.Hold(now, m):
+                now += 0.01
+                continue
+        budget.Reserve(now, m.node, m.payload)
+        sent.append(m.tag)
+    assert len(gate) == 0
+    # node 2 exceeds its budget after the first message but keeps its order
+    assert sent.index("other") < sent.index("get1")
+    assert [t for t in sent if t != "other"] == ["set", "get1", "get2"]
+
+    # held messages can be purged
+    budget.Reserve(now, 2, messages[0].payload)
+    for m in messages[:3]:
+        assert gate.Hold(now, m)
+    assert len(gate) == 3
+    assert gate.purge(lambda m: m.tag == "get1") == [messages[1]]
+    assert gate.Release(now) is None
+    assert len(gate) == 2
+
+
+def main():
+    logging.basicConfig(level=logging.CRITICAL)
+    TestCancel()
+    TestPurge()
+    TestBarrier()
+    TestCommandTemplate()
+    TestAirtimeGateKeepsOrder()
+    print("OK")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
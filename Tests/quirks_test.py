@@ -0,0 +1,76 @@
+#!/usr/bin/python3
+# Copyright 2016 Robert Muth <robert@muth.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 3
+# of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+"""
+quirks_test.py checks the device quirk registry.
+"""
+
+import json
+import logging
+import sys
+import tempfile
+
+from pyzwaver import zwave as z
+from pyzwaver.quirks import QuirkRegistry, Quirk, BUILTIN_RULES
+
+PRODUCT = (0x86, 0x2, 0x64)
+
+
+def TestBuiltin():
+    r = QuirkRegistry(BUILTIN_RULES)
+    assert r.Lookup(z.Basic_Report) is None
+    assert r.Patch([0x31, 0x05, 0x01, 0x7f, 0x01, 0x0a]) == [0x31, 0x05, 0x01, 0x22, 0x01, 0x0a]
+    assert r.Patch([0x31, 0x05, 0x01, 0x32, 0x01, 0x2a]) == [0x31, 0x05, 0x01, 0x22, 0x01, 0x2a]
+    # well formed reports are left alone
+    assert r.Patch([0x31, 0x05, 0x01, 0x22, 0x01, 0x2a]) == [0x31, 0x05, 0x01, 0x22, 0x01, 0x2a]
+    assert r.Patch([0x86, 0x14, 0x25]) == [0x86, 0x14, 0x25, 1]
+
+
+def TestProductSpecific():
+    rule = {"name": "inverted level",
+            "command": "Basic_Report",
+            "product": ["0x86", 2, 100],
+            "when": {"equal": [[2, 0]]},
+            "then": {"set": [[2, 0xff]]}}
+    with tempfile.NamedTemporaryFile("w", suffix=".json") as fp:
+        json.dump([rule], fp)
+        fp.flush()
+        r = QuirkRegistry()
+        r.LoadFile(fp.name)
+    assert len(r) == 1
+    assert r.Lookup(z.Basic_Report) is None
+    assert r.Patch([0x20, 0x03, 0x00]) == [0x20, 0x03, 0x00]
+    assert r.Patch([0x20, 0x03, 0x00], PRODUCT) == [0x20, 0x03, 0xff]
+    assert r.Patch([0x20, 0x03, 0x00], (1, 2, 3)) == [0x20, 0x03, 0x00]
+
+    # python quirks are combined with the declarative ones
+    r.Add(Quirk("truncate", z.Basic_Report, lambda m: m[:3]))
+    # generic quirks run first
+    assert r.Patch([0x20, 0x03, 0x00, 0x00], PRODUCT) == [0x20, 0x03, 0xff]
+    assert len(r.Lookup(z.Basic_Report, PRODUCT)) == 2
+
+
+def main():
+    logging.basicConfig(level=logging.CRITICAL)
+    TestBuiltin()
+    TestProductSpecific()
+    print("OK")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
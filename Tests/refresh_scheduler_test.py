@@ -0,0 +1,119 @@
+#!/usr/bin/python3
+# Copyright 2016 Robert Muth <robert@muth.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 3
+# of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+"""
+refresh_scheduler_test.py checks that stale values get polled within the
+configured budgets without a serial device.
+"""
+
+import logging
+import random
+import sys
+
+from pyzwaver import zwave as z
+from pyzwaver.command import CUSTOM_COMMAND_PROTOCOL_INFO
+from pyzwaver.command_translator import CommandTranslator
+from pyzwaver.node import Nodeset
+from pyzwaver.refresh_scheduler import RefreshScheduler
+from pyzwaver.ratelimit import TokenBucket
+
+
+class FakeDriver:
+
+    def __init__(self):
+        self.history = []
+
+    def AddListener(self, _l):
+        pass
+
+    def SendMessage(self, m):
+        self.history.append(m)
+
+
+def MakeNode(nodeset, n, speed, mode="listening"):
+    node = nodeset.GetNode(n)
+    for cls in [z.SwitchBinary, z.SensorMultilevel]:
+        node.put(0, z.Version_CommandClassReport, {"class": cls, "version": 5})
+    node.put(0, CUSTOM_COMMAND_PROTOCOL_INFO,
+             {"protocol_version": 4, "flags": {mode, speed}, "device_type": (4, 16, 1)})
+    node.put(0, z.SwitchBinary_Report, {"level": 0})
+    for sensor in [1, 3]:
+        node.put(0, z.SensorMultilevel_Report,
+                 {"type": sensor, "value": {"unit": 0, "exp": 0, "mantissa": 7, "_value": 7.0}})
+    return node
+
+
+def TestTokenBucket():
+    b = TokenBucket(2.0, 1.0)
+    assert b.Take(0.0)
+    assert not b.Take(0.1)
+    assert abs(b.Delay(0.1) - 0.4) < 1e-9
+    assert b.Take(0.5)
+
+
+def TestScheduler():
+    nodeset = Nodeset(CommandTranslator(FakeDriver()), 1)
+    fast = MakeNode(nodeset, 2, "100000_baud")
+    slow = MakeNode(nodeset, 3, "9600_baud")
+    scheduler = RefreshScheduler(nodeset, global_rate=10.0, node_rate=1.0,
+                                 rng=random.Random(1))
+    for node in [fast, slow]:
+        scheduler.WatchDynamicValues(node, 0.0, interval=100.0)
+    assert len(scheduler) == 6
+    assert scheduler.NodeRate(fast) == 2.5
+    # nothing is stale yet
+    assert scheduler.Tick(50.0) == []
+
+    # an unsolicited report keeps the value fresh
+    fast.put(90.0, z.SwitchBinary_Report, {"level": 0xff})
+    polls = []
+    for t in range(100, 130):
+        polls += scheduler.Tick(float(t))
+    assert (2, (z.SwitchBinary_Get, {})) not in polls
+    assert (2, (z.SensorMultilevel_Get, {"sensor": 3})) in polls
+    assert len([p for p in polls if p[0] == 3]) == 3
+    assert scheduler.stats["fresh"] >= 1
+    assert len(polls) == 5
+
+    # a burst of stale values gets spread according to the node speed
+    scheduler = RefreshScheduler(nodeset, global_rate=10.0, node_rate=1.0, jitter=0.0)
+    scheduler.WatchDynamicValues(slow, 0.0, interval=100.0)
+    assert len(scheduler.Tick(200.0)) == 1
+    assert scheduler.Tick(201.0) == []
+    assert len(scheduler.Tick(205.0)) == 1
+    assert scheduler.stats["deferred"] >= 2
+
+    # FLiRS nodes are polled, sleeping nodes are not
+    flirs = MakeNode(nodeset, 4, "100000_baud", "sensor_1000ms")
+    sleeping = MakeNode(nodeset, 5, "100000_baud", "routing")
+    scheduler = RefreshScheduler(nodeset, global_rate=10.0, node_rate=10.0, jitter=0.0)
+    for node in [flirs, sleeping]:
+        scheduler.WatchDynamicValues(node, 0.0, interval=100.0)
+    assert sorted(set(p[0] for p in scheduler.Tick(200.0))) == [4]
+    assert scheduler.stats["asleep"] == 3
+
+
+def main():
+    logging.basicConfig(level=logging.CRITICAL)
+    TestTokenBucket()
+    TestScheduler()
+    print("OK")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,178 @@
+#!/usr/bin/python3
+# Copyright 2016 Robert Muth <robert@muth.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 3
+# of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+"""
+retransmit_test.py exercises the Retransmitter of the driver without
+a serial device.
+"""
+
+import logging
+import sys
+import threading
+import time
+
+from pyzwaver.controller import Controller
+from pyzwaver import zmessage
+from pyzwaver import zwave as z
+from pyzwaver.driver import Driver, Retransmitter
+
+
+def MakeMessage(results):
+    payload = zmessage.MakeRawCommandWithId(2, [z.Basic, 2], 0x25)
+    return zmessage.Message(payload, zmessage.NodePriorityHi(2),
+                            lambda m: results.append(m), 2, timeout=5.0)
+
+
+def TestResendAfterCan():
+    sent = []
+    rt = Retransmitter(lambda payload, comment: sent.append(comment),
+                       ack_timeout=1.0, backoff_base=0.01, backoff_max=0.02)
+    results = []
+    m = MakeMessage(results)
+    m.Start(time.time(), threading.Lock())
+    rt.Sent(time.time(), m)
+    rt.Acked(time.time(), m)
+    assert rt.Retry(time.time(), m, "can")
+    time.sleep(0.2)
+    assert sent == ["re-try"], sent
+    assert m.can == 1
+    assert rt.stats["can"] == 1
+    assert rt.stats["resent"] == 1
+    rt.Acked(time.time(), m)
+    m.Complete(time.time(), None, zmessage.MESSAGE_STATE_COMPLETED)
+    rt.Terminate()
+
+
+def TestAckTimeoutExhaustsBudget():
+    sent = []
+    rt = Retransmitter(lambda payload, comment: sent.append(comment),
+                       ack_timeout=0.02, backoff_base=0.01, backoff_max=0.02,
+                       max_retries=2)
+    results = []
+    m = MakeMessage(results)
+    m.Start(time.time(), threading.Lock())
+    rt.Sent(time.time(), m)
+    # never ACKed: 2 resends and then the message is aborted
+    time.sleep(0.5)
+    assert len(sent) == 2, sent
+    assert rt.stats["ack-timeout"] == 3
+    assert rt.stats["exhausted-message-budget"] == 1
+    assert m.state == zmessage.MESSAGE_STATE_ABORTED
+    assert results == [None]
+    rt.Terminate()
+
+
+def TestStaleAckTimeout():
+    sent = []
+    rt = Retransmitter(lambda payload, comment: sent.append(comment),
+                       ack_timeout=0.3, backoff_base=0.01, backoff_max=0.02)
+    m = MakeMessage([])
+    start = time.time()
+    m.Start(start, threading.Lock())
+    rt.Sent(start, m)
+    time.sleep(0.05)
+    assert rt.Retry(time.time(), m, "nak")
+    # the ACK timeout of the first transmission must not trigger another retry
+    time.sleep(max(0.0, start + 0.33 - time.time()))
+    assert sent == ["re-try"], sent
+    assert rt.stats["ack-timeout"] == 0
+    rt.Acked(time.time(), m)
+    time.sleep(0.1)
+    assert rt.stats["ack-timeout"] == 0
+    m.Complete(time.time(), None, zmessage.MESSAGE_STATE_COMPLETED)
+    rt.Terminate()
+
+
+def TestGlobalBudget():
+    rt = Retransmitter(lambda payload, comment: None,
+                       max_retries_per_window=1, window=100.0)
+    m1 = MakeMessage([])
+    m1.Start(time.time(), threading.Lock())
+    m2 = MakeMessage([])
+    m2.Start(time.time(), threading.Lock())
+    assert rt.Retry(time.time(), m1, "nak")
+    assert not rt.Retry(time.time(), m2, "nak")
+    assert rt.stats["exhausted-global-budget"] == 1
+    assert m2.WasAborted()
+    m1.Complete(time.time(), None, zmessage.MESSAGE_STATE_COMPLETED)
+    rt.Terminate()
+
+
+class HungDevice:
+    """A serial device which never answers"""
+
+    def write(self, _data):
+        pass
+
+    def flush(self):
+        pass
+
+    def flushInput(self):
+        pass
+
+    def flushOutput(self):
+        pass
+
+    def read(self, _n):
+        time.sleep(0.01)
+        return b""
+
+
+def TestTerminateWhileHung():
+    driver = Driver(HungDevice())
+    driver._hung_since = time.time()
+    # wake up the sending thread so it notices the hang, as if it had
+    # detected the hang itself
+    woken = threading.Event()
+    driver.SendMessage(zmessage.Message(None, zmessage.LowestPriority(),
+                                        lambda _: woken.set(), None))
+    assert woken.wait(1.0)
+    results = []
+    driver.SendMessage(MakeMessage(results))
+    start = time.time()
+    driver.Terminate()
+    assert time.time() - start < 1.0
+    # queued messages are cancelled
+    assert results == [None]
+
+
+def TestRecoveriesAreCountedOnce():
+    driver = Driver(HungDevice())
+    controller = Controller(driver)
+    driver._hung_since = time.time() - 2.0
+    driver.ResumeAfterRecovery(2, True)
+    # a second resume, e.g. after the driver noticed the recovery itself
+    assert driver.ResumeAfterRecovery(1, True) == 0.0
+    [(_, duration, attempts, success)] = controller.Recoveries()
+    assert duration >= 2.0 and attempts == 2 and success
+    driver.Terminate()
+
+
+def main():
+    logging.basicConfig(level=logging.CRITICAL)
+    TestResendAfterCan()
+    TestAckTimeoutExhaustsBudget()
+    TestStaleAckTimeout()
+    TestGlobalBudget()
+    TestTerminateWhileHung()
+    TestRecoveriesAreCountedOnce()
+    print("OK")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
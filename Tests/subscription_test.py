@@ -0,0 +1,137 @@
+#!/usr/bin/python3
+# Copyright 2016 Robert Muth <robert@muth.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 3
+# of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+"""
+subscription_test.py checks that indexed subscriptions on the
+CommandTranslator and the Nodeset only see the matching events.
+"""
+
+import logging
+import sys
+
+from pyzwaver import zmessage
+from pyzwaver import zwave as z
+from pyzwaver.command_translator import CommandTranslator
+from pyzwaver.node import Nodeset
+from pyzwaver.subscription import SubscriptionIndex
+
+
+class FakeDriver:
+
+    def AddListener(self, _l):
+        pass
+
+    def SendMessage(self, _m):
+        pass
+
+
+def MakeApplicationCommand(n, data):
+    out = [z.SOF, len(data) + 6, z.REQUEST, z.API_APPLICATION_COMMAND_HANDLER, 0, n, len(data)]
+    out += data
+    out.append(zmessage.Checksum(out) ^ z.SOF)
+    return zmessage.Frame(out)
+
+
+def TestIndex():
+    index = SubscriptionIndex()
+    index.Subscribe("all")
+    index.Subscribe("node5", n=5)
+    index.Subscribe("meters", cls=z.Meter)
+    index.Subscribe("meter-reports5", n=5, key=z.Meter_Report)
+    h = index.Subscribe("basic", key=z.Basic_Report)
+    assert len(index) == 5
+    assert sorted(index.Match(5, z.Meter_Report)) == ["all", "meter-reports5", "meters", "node5"]
+    assert sorted(index.Match(6, z.Meter_Report)) == ["all", "meters"]
+    assert sorted(index.Match(6, z.Basic_Report)) == ["all", "basic"]
+    index.Unsubscribe(h)
+    index.Unsubscribe(h)
+    assert index.Match(6, z.Basic_Report) == ["all"]
+    assert len(SubscriptionIndex().Match(6, z.Basic_Report)) == 0
+
+
+def TestTranslatorAndNodeset():
+    translator = CommandTranslator(FakeDriver())
+    nodeset = Nodeset(translator, 1)
+    seen = []
+    translator.Subscribe(lambda n, _ts, key, values: seen.append((n, key, values["level"])),
+                         n=9, cls=z.Basic)
+    changes = []
+    h = nodeset.SubscribeChanges(lambda n, _ts, key, _subkey, old, new:
+                                 changes.append((n, old, new)), key=z.Basic_Report)
+    for n, level in [(9, 0xff), (8, 0xff), (9, 0xff), (9, 0)]:
+        translator.put(1, MakeApplicationCommand(n, [z.Basic, 3, level]))
+    translator.put(2, MakeApplicationCommand(9, [z.SwitchBinary, 3, 0]))
+    assert seen == [(9, z.Basic_Report, 0xff)] * 2 + [(9, z.Basic_Report, 0)]
+    assert [(n, None if old is None else old["level"], new["level"]) for n, old, new in changes] == [
+        (9, None, 0xff), (8, None, 0xff), (9, 0xff, 0)]
+    nodeset.UnsubscribeChanges(h)
+    translator.put(3, MakeApplicationCommand(9, [z.Basic, 3, 0x20]))
+    assert len(changes) == 3
+
+
+class LogRecorder(logging.Handler):
+
+    def __init__(self):
+        super().__init__(logging.ERROR)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+def TestFailingSubscriber():
+    translator = CommandTranslator(FakeDriver())
+    seen = []
+
+    def Failing(_n, _ts, _key, values):
+        raise RuntimeError("bug in subscriber %d" % values["level"])
+
+    translator.Subscribe(Failing, n=9)
+    translator.Subscribe(lambda n, _ts, key, values: seen.append(values["level"]), n=9)
+    recorder = LogRecorder()
+    root = logging.getLogger()
+    level = root.level
+    root.setLevel(logging.ERROR)
+    root.addHandler(recorder)
+    try:
+        translator.put(1, MakeApplicationCommand(9, [z.Basic, 3, 0xff]))
+        # a broken subscriber is not a codec problem and does not stop the others
+        assert seen == [0xff]
+        assert len(recorder.messages) == 1
+        assert "listener failed" in recorder.messages[0]
+
+        del recorder.messages[:]
+        translator.put(2, MakeApplicationCommand(9, [z.Basic, 3]))
+        assert seen == [0xff]
+        assert len(recorder.messages) == 1
+        assert "cannot parse" in recorder.messages[0]
+    finally:
+        root.removeHandler(recorder)
+        root.setLevel(level)
+
+
+def main():
+    logging.basicConfig(level=logging.CRITICAL)
+    TestIndex()
+    TestTranslatorAndNodeset()
+    TestFailingSubscriber()
+    print("OK")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,190 @@
+#!/usr/bin/python3
+# Copyright 2016 Robert Muth <robert@muth.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 3
+# of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+"""
+transport_service_test.py exercises the segmentation and reassembly of
+large commands without a serial device.
+"""
+
+import logging
+import sys
+import time
+
+from pyzwaver import command
+from pyzwaver import transport_service as ts
+from pyzwaver import zmessage
+from pyzwaver import zwave as z
+from pyzwaver.command_translator import CommandTranslator
+
+XMIT = z.TRANSMIT_OPTION_ACK
+
+
+class FakeDriver:
+
+    def __init__(self):
+        self.sent = []
+
+    def AddListener(self, _l):
+        pass
+
+    def SendMessage(self, mesg):
+        self.sent.append(mesg)
+
+
+class Listener:
+
+    def __init__(self):
+        self.seen = []
+
+    def put(self, n, _ts, key, values):
+        self.seen.append((n, key, values))
+
+
+def MakeApplicationCommand(n, data):
+    out = [z.SOF, len(data) + 6, z.REQUEST, z.API_APPLICATION_COMMAND_HANDLER, 0, n, len(data)]
+    out += data
+    out.append(zmessage.Checksum(out) ^ z.SOF)
+    return out
+
+
+def SentCommands(driver):
+    """Extracts the commands from the queued API_ZW_SEND_DATA messages"""
+    out = [list(m.payload[6:6 + m.payload[5]]) for m in driver.sent]
+    driver.sent.clear()
+    return out
+
+
+def TestSegment():
+    payload = list(range(100))
+    segments = ts.Segment(payload, 5)
+    assert len(segments) == 3
+    assert max(len(s) for s in segments) <= 46
+    assert segments[0][:4] == [z.TransportService, ts.TRANSPORT_FIRST_SEGMENT, 100, 0x50]
+    assert segments[2][:5] == [z.TransportService, ts.TRANSPORT_SUBSEQUENT_SEGMENT, 100, 0x50, 78]
+
+    receiver = ts.TransportService(lambda n, c: None)
+    for s in reversed(segments):
+        datagram = receiver.Receive(1.0, 2, bytes(s))
+    assert list(datagram) == payload
+    assert receiver.stats["reassembled"] == 1
+    assert receiver.PendingBytes() == 0
+
+
+def TestLostSegment():
+    code = list(range(0x30, 0x30 + 90))
+    raw = command.AssembleCommand(z.UserCode_Report, {"user": 1, "status": 1, "code": code})
+    segments = ts.Segment(raw, 3)
+
+    driver = FakeDriver()
+    translator = CommandTranslator(driver)
+    listener = Listener()
+    translator.AddListener(listener)
+    # the second segment gets lost
+    translator.put(1.0, MakeApplicationCommand(7, segments[0]))
+    translator.put(1.1, MakeApplicationCommand(7, segments[2]))
+    assert not listener.seen
+    # only the missing segment is requested
+    assert SentCommands(driver) == [ts.SegmentRequest(3, ts.MAX_SEGMENT_PAYLOAD)]
+    translator.put(1.2, MakeApplicationCommand(7, segments[1]))
+    assert SentCommands(driver) == [ts.SegmentComplete(3)]
+    n, key, values = listener.seen[0]
+    assert (n, key) == (7, z.UserCode_Report)
+    assert values["code"] == tuple(code)
+
+
+def TestLostLastSegment():
+    segments = ts.Segment(list(range(100)), 4)
+    sent = []
+    receiver = ts.TransportService(lambda n, c: sent.append((n, c)), receive_timeout=0.05)
+    for s in segments[:-1]:
+        assert receiver.Receive(1.0, 6, bytes(s)) is None
+    # without the tail the receiver cannot know it is done, its timer asks
+    assert sent == []
+    time.sleep(0.2)
+    assert sent[0] == (6, ts.SegmentRequest(4, 2 * ts.MAX_SEGMENT_PAYLOAD))
+    datagram = receiver.Receive(1.5, 6, bytes(segments[-1]))
+    assert list(datagram) == list(range(100))
+    assert sent[-1] == (6, ts.SegmentComplete(4))
+    # the timer stops with the datagram
+    count = len(sent)
+    time.sleep(0.2)
+    assert len(sent) == count
+
+
+def TestSendSegmented():
+    driver = FakeDriver()
+    translator = CommandTranslator(driver)
+    code = list(range(60))
+    args = {"user": 1, "status": 1, "code": code}
+    # without segmentation the command is sent as is
+    translator.SendCommand(9, z.UserCode_Set, args, zmessage.NodePriorityLo(9), XMIT)
+    assert len(SentCommands(driver)) == 1
+    translator.SendCommand(9, z.UserCode_Set, args, zmessage.NodePriorityLo(9), XMIT,
+                           segment=True)
+    segments = SentCommands(driver)
+    assert len(segments) == 2
+
+    # the receiver asks for the second segment again
+    session = segments[0][3] >> 4
+    request = MakeApplicationCommand(9, ts.SegmentRequest(session, ts.MAX_SEGMENT_PAYLOAD))
+    translator.put(2.0, request)
+    assert SentCommands(driver) == [segments[1]]
+    translator.put(2.1, MakeApplicationCommand(9, ts.SegmentComplete(session)))
+    translator.put(2.2, request)
+    assert SentCommands(driver) == []
+
+    receiver = ts.TransportService(lambda n, c: None)
+    datagram = None
+    for s in segments:
+        datagram = receiver.Receive(3.0, 1, bytes(s))
+    assert list(datagram) == command.AssembleCommand(z.UserCode_Set, args)
+
+
+def TestExpiry():
+    receiver = ts.TransportService(lambda n, c: None, timeout=5.0, max_pending_bytes=250)
+    for n in [2, 3]:
+        receiver.Receive(n, n, bytes(ts.Segment(list(range(100)), 1)[0]))
+    assert receiver.PendingBytes() == 200
+    # the memory limit evicts the oldest datagram
+    receiver.Receive(4.0, 4, bytes(ts.Segment(list(range(100)), 1)[0]))
+    assert receiver.PendingBytes() == 200
+    assert receiver.stats["evicted"] == 1
+    # and incomplete datagrams time out
+    receiver.Expire(8.5)
+    assert receiver.PendingBytes() == 100
+    assert receiver.stats["expired"] == 1
+
+    # corrupted segments are dropped
+    bad = ts.Segment(list(range(100)), 2)[0]
+    bad[6] ^= 0xff
+    assert receiver.Receive(9.0, 5, bytes(bad)) is None
+    assert receiver.stats["bad-crc"] == 1
+
+
+def main():
+    logging.basicConfig(level=logging.CRITICAL)
+    TestSegment()
+    TestLostSegment()
+    TestLostLastSegment()
+    TestSendSegmented()
+    TestExpiry()
+    print("OK")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -354,15 +354,19 @@ _ALLOWED_PARAMETER_FORMATS = {
     "A{code}",
     "A{name}",
     "A{commands}",
+    "A{command}",
     "B{alarm}",
     "B{class}",
     "B{control}",
     "B{count}",
     "B{dayhour}",
+    "B{dst}",
     "B{delay}",
     "B{duration}",
     "B{endpoint}",
     "B{extra}",
+    "B{flags}",
+    "B{follow}",
     "B{generic}",
     "B{group}",
     "B{key}",
@@ -382,8 +386,10 @@ _ALLOWED_PARAMETER_FORMATS = {
     "B{scene}",
     "B{schemes}",
     "B{sec}",
+    "B{session}",
     "B{seq}",
     "B{specific}",
+    "B{src}",
     "B{state}",
     "B{status}",
     "B{thermo}",
@@ -400,15 +406,18 @@ _ALLOWED_PARAMETER_FORMATS = {
     "K{key}",
     "L{code}",
     "L{command}",
+    "L{commands}",
     "L{data}",
     "L{key}",
     "L{nodes}",
     "L{nonce}",
     "L{classes}",
     "L{extra}",
+    "L{values}",
     "M{value}",
     "N{name}",
     "O{nonce}",
+    "P{properties}",
     "R{bits}",
     "T{bits}",
     "V{value}",
@@ -420,6 +429,7 @@ _ALLOWED_PARAMETER_FORMATS = {
     "W{icon2}",
     "W{id}",
     "W{manufacturer}",
+    "W{parameter}",
     "W{product}",
     "W{protocol}",
     "W{type}",
@@ -613,7 +623,7 @@ C("MultiChannel", 0x60,
   CapabilityReport=(0x0a, "B{endpoint},B{generic},B{specific},L{classes}"),
   ChannelEndPointFind=(0x0b, ""),
   ChannelEndPointFindReport=(0x0c, ""),
-  ChannelEncap=(0x0d, ""),
+  ChannelEncap=(0x0d, "B{src},B{dst},L{command}"),
   )
 
 C("DoorLock", 0x62,
@@ -626,7 +636,7 @@ C("DoorLock", 0x62,
   )
 
 C("UserCode", 0x63,
-  Set=(0x1, ""),  # TODO
+  Set=(0x1, "B{user},B{status},L{code}"),
   Get=(0x2, "B{user}"),
   Report=(0x3, "B{user},B{status},L{code}"),
   NumberGet=(0x4, ""),
@@ -637,6 +647,11 @@ C("Configuration", 0x70,
   Set=(0x4, "B{parameter},V{value}"),
   Get=(0x5, "B{parameter}"),
   Report=(0x6, "B{parameter},V{value}"),
+  BulkSet=(0x7, "W{parameter},B{count},B{flags},L{values}"),
+  BulkGet=(0x8, "W{parameter},B{count}"),
+  BulkReport=(0x9, "W{parameter},B{count},B{follow},B{flags},L{values}"),
+  PropertiesGet=(0xe, "W{parameter}"),
+  PropertiesReport=(0xf, "W{parameter},P{properties}"),
   )
 
 C("Alarm", 0x71,
@@ -774,7 +789,10 @@ C("CentralScene", 0x5b,
 
 C("TransportService", 0x55)
 
-C("Supervision", 0x6c)
+C("Supervision", 0x6c,
+  Get=(0x01, "B{session},A{command}"),
+  Report=(0x02, "B{session},B{status},B{duration}"),
+  )
 
 C("Security2", 0x9f,
   NonceGet=(0x01, "B{seq}"),
@@ -786,7 +804,7 @@ C("Security2", 0x9f,
   KexFail=(0x07, "B{type}"),
   PublicKeyReport=(0x08, "B{mode},L{key}"),
   NetworkKeyGet=(0x09, "B{key}"),
-  NetworkKeyReport=(0x0a, "B{key},L{key}"),
+  NetworkKeyReport=(0x0a, "B{keys},L{key}"),
   NetworkKeyVerify=(0x0b, ""),
   TransferEnd=(0x0c, "B{mode}"),
   CommandsSupportedGet=(0x0d, ""),
@@ -798,13 +816,17 @@ C("ManufacturerProprietary", 0x91)
 C("SimpleAvControl", 0x94)
 C("BasicWindowCovering", 0x50)
 C("ClimateControlSchedule", 0x46)
-C("CRC16Encap", 0x56)
+C("CRC16Encap", 0x56,
+  Encap=(0x01, "L{data}"),
+  )
 C("EnergyProduction", 0x90)
 C("ScreenMd", 0x92)
 C("ScreenAttributes", 0x93)
 C("Language", 0x89)
 C("MeterPulse", 0x35)
-C("MultiCmd", 0x8f)
+C("MultiCmd", 0x8f,
+  Encap=(0x01, "B{count},L{commands}"),
+  )
 C("MultiInstanceAssociation", 0x8e)
 C("Proprietary", 0x88)
 C("SwitchToggleMultilevel", 0x29)
@@ -24,6 +24,10 @@ zwave_out/<home-id>/<node-number>/<command> json-payload
 topic format for incoming messages is
 zwave_in/<home-id>/<node-number>/<command> json-payload
 
+with --changes_only only values which actually changed are published, values
+kept per subkey, e.g. sensors and meters, get the subkey appended to the topic:
+zwave_in/<home-id>/<node-number>/<command>[/<subkey>] json-payload
+
 to send a command to the proxy use something like:
 mosquitto_pub -h <mqtt-broker> -t zwave_out/<home-id>/<node-num>/Basic_Set -m '{"level": 255}'
 
@@ -91,7 +95,19 @@ class EventListener(object):
         # print("@@@IN", name, values)
         self._mqtt_client.publish(
             "zwave_in/%d/%d/%s" % (self._home_id, n, name),
-            json.dumps(values, cls=PythonObjectEncoder))
+            json.dumps(values.AsDict(), cls=PythonObjectEncoder))
+
+    def changed(self, n, _ts, key, subkey, _old, new):
+        if command.IsCustom(key):
+            return
+        topic = "zwave_in/%d/%d/%s" % (self._home_id, n, command.StringifyCommand(key))
+        if subkey is not None:
+            if isinstance(subkey, tuple):
+                subkey = "_".join(str(x) for x in subkey)
+            topic += "/%s" % subkey
+        if isinstance(new, command.Record):
+            new = new.AsDict()
+        self._mqtt_client.publish(topic, json.dumps(new, cls=PythonObjectEncoder))
 
 
 def main():
@@ -109,6 +125,8 @@ def main():
     parser.add_argument('--mqtt_broker_port', type=int,
                         default=1883,
                         help='mqtt broker port')
+    parser.add_argument('--changes_only', action='store_true',
+                        help='only publish values which changed')
     parser.add_argument('--verbosity', type=int,
                         default=30,  # = logging.WARNING
                         help='Lower numbers mean more verbosity')
@@ -162,7 +180,11 @@ def main():
     client.on_connect = on_connect
     client.on_message = on_message
 
-    translator.AddListener(EventListener(controller.props.home_id, client))
+    listener = EventListener(controller.props.home_id, client)
+    if args.changes_only:
+        nodeset.AddChangeListener(listener)
+    else:
+        translator.AddListener(listener)
     client.connect(args.mqtt_broker_host, port=args.mqtt_broker_port, keepalive=60)
     client.loop_forever()
 
@@ -53,9 +53,12 @@ from pyzwaver.value import CompactifyParams, SENSOR_KIND_SWITCH_BINARY, SENSOR_K
 from pyzwaver import zmessage
 from pyzwaver.controller import Controller, EVENT_UPDATE_COMPLETE
 from pyzwaver.driver import Driver, MakeSerialDevice
-from pyzwaver.command import NodeDescription
+from pyzwaver.command import NodeDescription, StringifyCommand
 from pyzwaver.command_translator import CommandTranslator
+from pyzwaver.device_profile import ProfileCache
 from pyzwaver.node import Node, Nodeset, NODE_STATE_INTERVIEWED, NODE_STATE_DISCOVERED
+from pyzwaver.quirks import DEFAULT_QUIRKS
+from pyzwaver.refresh_scheduler import RefreshScheduler
 from pyzwaver import zwave as z
 from pyzwaver import command_helper as ch
 
@@ -754,6 +757,27 @@ tornado.options.define("serial_port",
                        type=str,
                        help="serial port")
 
+tornado.options.define("quirks",
+                       default=[],
+                       type=str,
+                       multiple=True,
+                       help="json files with additional device quirks")
+
+tornado.options.define("poll_interval",
+                       default=0.0,
+                       type=float,
+                       help="seconds after which dynamic values get polled, 0 disables polling")
+
+tornado.options.define("profiles",
+                       default="",
+                       type=str,
+                       help="json file caching the interview results per product")
+
+tornado.options.define("history",
+                       default=0,
+                       type=int,
+                       help="samples of history kept per sensor/meter/level, 0 disables it")
+
 OPTIONS = tornado.options.options
 
 
@@ -791,6 +815,7 @@ DRIVER: Driver = None
 CONTROLLER: Controller = None
 TRANSLATOR: CommandTranslator = None
 NODESET: Nodeset = None
+SCHEDULER: RefreshScheduler = None
 DB: Db = None
 
 # ======================================================================
@@ -846,12 +871,18 @@ class NodeUpdater(object):
             if count % 20 == 0:
                 for n in CONTROLLER.nodes:
                     node: Node = NODESET.GetNode(n)
+                    if OPTIONS.history:
+                        node.values.TrackDefaultHistory(OPTIONS.history)
                     if node.state < NODE_STATE_DISCOVERED:
                         TRANSLATOR.Ping(n, 3, False, "refresher")
                         time.sleep(0.5)
                     elif node.state < NODE_STATE_INTERVIEWED:
                         logging.warning("[%d] (%s) trigger static", n, node.state)
                         node.RefreshStaticValues()
+                    elif SCHEDULER:
+                        SCHEDULER.WatchDynamicValues(node, time.time(), OPTIONS.poll_interval)
+            if SCHEDULER:
+                SCHEDULER.Tick(time.time())
             count += 1
             time.sleep(1.0)
 
@@ -1184,7 +1215,7 @@ class NodeActionHandler(BaseHandler):
                 size = int(token.pop(0))
                 value = int(token.pop(0))
                 print(num, size, value)
-                node.BatchCommandSubmitFilteredFast(ch.ConfigurationSet(num, size, value))
+                node.SetParameters([(num, size, value)])
             elif cmd == "association_remove":
                 group = int(token.pop(0))
                 n = int(token.pop(0))
@@ -1257,6 +1288,15 @@ class ControllerActionHandler(BaseHandler):
         self.finish()
 
 
+def RenderHistory(node: Node, start):
+    out = []
+    for key, subkey, h in sorted(node.values.Histories(), key=lambda x: str(x[:2])):
+        out.append({"key": StringifyCommand(key),
+                    "subkey": subkey,
+                    "samples": h.Range(start)})
+    return out
+
+
 class JsonHandler(BaseHandler):
 
     def set_default_headers(self):
@@ -1290,6 +1330,10 @@ class JsonHandler(BaseHandler):
                 else:
                     node = NODESET.GetNode(num)
                     out = RenderNode(node, DB)
+            elif cmd == "history":
+                num = int(token.pop(0))
+                secs = float(token.pop(0)) if token else 24 * 3600
+                out = RenderHistory(NODESET.GetNode(num), time.time() - secs)
             else:
                 logging.error("unknown command %s", token)
             self.write(json.dumps(out, sort_keys=True, indent=4))
@@ -1383,7 +1427,7 @@ class MyFormatter(logging.Formatter):
 
 
 def main():
-    global DRIVER, CONTROLLER, TRANSLATOR, NODESET, DB
+    global DRIVER, CONTROLLER, TRANSLATOR, NODESET, DB, SCHEDULER
     tornado.options.parse_command_line()
     # use --logging command line option to control verbosity
     logger = logging.getLogger()
@@ -1410,11 +1454,17 @@ def main():
         DRIVER, pairing_timeout_secs=OPTIONS.pairing_timeout_secs)
     CONTROLLER.Initialize()
     CONTROLLER.WaitUntilInitialized()
+    CONTROLLER.EnableWatchdog(ControllerEventCallback)
     CONTROLLER.UpdateRoutingInfo()
     DRIVER.WaitUntilAllPreviousMessagesHaveBeenHandled()
     print(CONTROLLER)
+    for path in OPTIONS.quirks:
+        DEFAULT_QUIRKS.LoadFile(path)
     TRANSLATOR = CommandTranslator(DRIVER)
-    NODESET = Nodeset(TRANSLATOR, CONTROLLER.GetNodeId())
+    profiles = ProfileCache(OPTIONS.profiles) if OPTIONS.profiles else None
+    NODESET = Nodeset(TRANSLATOR, CONTROLLER.GetNodeId(), profiles)
+    if OPTIONS.poll_interval > 0:
+        SCHEDULER = RefreshScheduler(NODESET)
 
     cp = CONTROLLER.props.product
     NODESET.put(
@@ -5,16 +5,26 @@ from . import command_translator
 from . import controller
 from . import driver
 from . import node
+from . import quirks
 from . import value
 from . import zmessage
 from . import zwave
 
-__all__ = ['command',
+__all__ = ['airtime',
+           'command',
            'command_helper',
            'command_translator',
            'controller',
+           'device_profile',
            'driver',
+           'history',
+           'interview',
            'node',
+           'quirks',
+           'ratelimit',
+           'refresh_scheduler',
+           'subscription',
+           'transport_service',
            'value',
            'zmessage',
            'zwave']
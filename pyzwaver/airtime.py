@@ -0,0 +1,188 @@
+#!/usr/bin/python3
+# Copyright 2016 Robert Muth <robert@muth.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 3
+# of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+"""
+airtime.py estimates how long messages occupy the radio and limits the
+duty cycle, globally and per node, using token buckets measured in seconds
+of airtime.
+
+The estimate covers the frame and its ACK at the speed of the node:
+
+  * 9.6 kbit/s: 10 bytes preamble, 1 byte checksum
+  * 40 kbit/s: 10 bytes preamble, 1 byte checksum
+  * 100 kbit/s: 40 bytes preamble, 2 bytes crc16
+
+plus the start of frame byte and 9 bytes of MAC header. Routing and the
+retries of the stick itself are not visible to us, the ones of the driver
+are accounted for.
+"""
+
+import collections
+import threading
+
+from pyzwaver import zwave as z
+from pyzwaver.ratelimit import TokenBucket
+
+# fraction of time the radio may be busy with our messages
+MAX_DUTY_CYCLE = 0.3
+NODE_MAX_DUTY_CYCLE = 0.1
+# burst allowances in seconds of airtime
+MAX_BURST_SECS = 1.0
+NODE_MAX_BURST_SECS = 0.25
+# utilization is reported over this window
+UTILIZATION_WINDOW_SECS = 60.0
+
+# assumed until we learn better from the protocol info
+DEFAULT_SPEED = 9600
+
+# the baud bits of the protocol info, c.f. CommandTranslator._ProcessProtocolInfo
+_BAUD_TO_SPEED = {1: 9600, 2: 40000, 3: 100000}
+
+# speed -> (preamble, checksum) bytes
+_FRAME_OVERHEAD = {
+    9600: (10, 1),
+    40000: (10, 1),
+    100000: (40, 2),
+}
+_SOF_AND_HEADER = 1 + 9
+
+
+def SpeedFromProtocolInfo(data):
+    """data is the payload of the API_ZW_GET_NODE_PROTOCOL_INFO response"""
+    if not data:
+        return 0
+    return _BAUD_TO_SPEED.get((data[0] & 0x38) >> 3, 0)
+
+
+def FrameAirtime(length, speed):
+    """Seconds needed for a frame carrying length bytes of command and its ACK"""
+    preamble, checksum = _FRAME_OVERHEAD.get(speed, _FRAME_OVERHEAD[DEFAULT_SPEED])
+    frame = preamble + _SOF_AND_HEADER + length + checksum
+    ack = preamble + _SOF_AND_HEADER + checksum
+    return 8.0 * (frame + ack) / speed
+
+
+def CommandLength(payload):
+    """Returns the length of the command carried by a serial message, 0 for
+    messages which do not go out over the air"""
+    if payload is None or len(payload) < 6:
+        return 0
+    func = payload[3]
+    if func == z.API_ZW_SEND_DATA:
+        return payload[5]
+    if func == z.API_ZW_SEND_DATA_MULTI:
+        index = 5 + payload[4]
+        return payload[index] if index < len(payload) else 0
+    return 0
+
+
+class AirtimeBudget:
+    """Accounts for the airtime of messages and decides when the next
+    message for a node may go out.
+
+    Reserve() charges a single transmission before a message is sent,
+    Record() the retries once the message is done.
+    """
+
+    def __init__(self, max_duty_cycle=MAX_DUTY_CYCLE, node_duty_cycle=NODE_MAX_DUTY_CYCLE,
+                 max_burst=MAX_BURST_SECS, node_max_burst=NODE_MAX_BURST_SECS,
+                 window=UTILIZATION_WINDOW_SECS):
+        self._lock = threading.Lock()
+        self._global = TokenBucket(max_duty_cycle, max_burst)
+        self._node_duty_cycle = node_duty_cycle
+        self._node_max_burst = node_max_burst
+        self._window = window
+        # n -> TokenBucket
+        self._buckets = {}
+        # n -> bits/sec
+        self._speeds = {}
+        # (ts, n, airtime) of the messages within the window
+        self._recent = collections.deque()
+        # n -> total seconds of airtime
+        self.totals = collections.Counter()
+
+    def SetSpeed(self, n, speed):
+        if speed:
+            self._speeds[n] = speed
+
+    def Speed(self, n):
+        return self._speeds.get(n, DEFAULT_SPEED)
+
+    def Estimate(self, n, payload, attempts=1):
+        length = CommandLength(payload)
+        if length == 0:
+            return 0.0
+        return attempts * FrameAirtime(length, self.Speed(n))
+
+    def _Bucket(self, n):
+        b = self._buckets.get(n)
+        if b is None:
+            b = TokenBucket(self._node_duty_cycle, self._node_max_burst)
+            self._buckets[n] = b
+        return b
+
+    def Delay(self, now, n, payload):
+        """Returns (global, node) seconds to wait before payload may be sent"""
+        airtime = self.Estimate(n, payload)
+        if airtime == 0.0:
+            return 0.0, 0.0
+        with self._lock:
+            # a message larger than the burst must not wait forever
+            return (self._global.Delay(now, min(airtime, self._global.burst)),
+                    self._Bucket(n).Delay(now, min(airtime, self._node_max_burst)))
+
+    def Reserve(self, now, n, payload):
+        airtime = self.Estimate(n, payload)
+        if airtime == 0.0:
+            return
+        with self._lock:
+            self._global.Charge(now, airtime)
+            self._Bucket(n).Charge(now, airtime)
+
+    def Record(self, now, n, payload, retries):
+        airtime = self.Estimate(n, payload)
+        if airtime == 0.0:
+            return
+        with self._lock:
+            if retries:
+                self._global.Charge(now, retries * airtime)
+                self._Bucket(n).Charge(now, retries * airtime)
+            airtime *= 1 + retries
+            self._recent.append((now, n, airtime))
+            self.totals[n] += airtime
+            self._Expire(now)
+
+    def _Expire(self, now):
+        cutoff = now - self._window
+        while self._recent and self._recent[0][0] < cutoff:
+            self._recent.popleft()
+
+    def Utilization(self, now):
+        """Returns a map from node to the fraction of the window its messages
+        occupied the radio"""
+        out = collections.Counter()
+        with self._lock:
+            self._Expire(now)
+            for _, n, airtime in self._recent:
+                out[n] += airtime / self._window
+        return out
+
+    def UtilizationString(self, now):
+        u = self.Utilization(now)
+        return "airtime utilization: total: %.1f%% by node: %s" % (
+            100.0 * sum(u.values()),
+            " ".join("%d:%.1f%%" % (n, 100.0 * x) for n, x in sorted(u.items())))
@@ -21,9 +21,14 @@ command.py contain code for parsing and assembling API_APPLICATION_COMMAND_reque
 It also contains some logic pertaining to the node state machine.
 """
 
+import collections
+import collections.abc
+import keyword
 import logging
+import threading
 
 from pyzwaver import zwave as z
+from pyzwaver.quirks import DEFAULT_QUIRKS
 
 CUSTOM_COMMAND_APPLICATION_UPDATE = (256, 1)
 CUSTOM_COMMAND_PROTOCOL_INFO = (256, 2)
@@ -73,20 +78,7 @@ def NodeDescription(basic_generic_specific):
 # Parse Helpers
 # ======================================================================
 def _GetSignedValue(data):
-    value = 0
-    negative = (data[0] & 0x80) != 0
-    for d in data:
-        value <<= 8
-        if negative:
-            value += ~d
-        else:
-            value += d
-
-    if negative:
-        value += 1
-        return -value
-    else:
-        return value
+    return int.from_bytes(bytes(data), "big", signed=True)
 
 
 def _GetReading(m, index, units_extra):
@@ -122,7 +114,7 @@ def _ParseMeter(m, index):
         "exp": exp,
         "rate": rate,
     }
-    if index + size >= len(m):
+    if index + size > len(m):
         raise ValueError("cannot parse value")
     mantissa = m[index: index + size]
     index += size
@@ -182,7 +174,7 @@ def _ParseStringWithLength(m, index):
 def _ParseStringWithLengthAndEncoding(m, index):
     encoding = m[index] >> 5
     size = m[index] & 0x1f
-    return 1 + size, {"encoding": encoding, "text": m[index + 1:index + 1 + size]}
+    return index + 1 + size, {"encoding": encoding, "text": m[index + 1:index + 1 + size]}
 
 
 def _ParseListRest(m, index):
@@ -211,20 +203,11 @@ def _ParseNonce(m, index):
 
 
 def _GetIntLittleEndian(m):
-    x = 0
-    shift = 0
-    for i in m:
-        x += i << shift
-        shift += 8
-    return x
+    return int.from_bytes(bytes(m), "little")
 
 
 def _GetIntBigEndian(m):
-    x = 0
-    for i in m:
-        x <<= 8
-        x += i
-    return x
+    return int.from_bytes(bytes(m), "big")
 
 
 def _ParseRestLittleEndianInt(m, index):
@@ -311,6 +294,33 @@ def _ParseExtensions(m, index):
                     "_plaintext": unencrypted, "_message_size": len(m)}
 
 
+def _ParseConfigurationProperties(m, index):
+    c = m[index]
+    fmt = (c >> 3) & 7
+    size = c & 7
+    index += 1
+    out = {"format": fmt, "size": size,
+           "readonly": bool(c & 0x40), "altering": bool(c & 0x80)}
+    # size 0 means there is no such parameter, only the next one is reported
+    if size:
+        if len(m) < index + 3 * size:
+            raise ValueError("malformed configuration properties")
+        # format 0 is signed, all others are unsigned
+        getter = _GetSignedValue if fmt == 0 else _GetIntBigEndian
+        for name in ("min", "max", "default"):
+            out[name] = getter(m[index:index + size])
+            index += size
+    if len(m) < index + 2:
+        raise ValueError("malformed configuration properties")
+    out["next"] = m[index] * 256 + m[index + 1]
+    index += 2
+    if index < len(m):
+        # v4 and up
+        out["flags"] = m[index]
+        index += 1
+    return index, out
+
+
 # ======================================================================
 # Assemble Helpers
 # ======================================================================
@@ -324,17 +334,17 @@ def _MakeDate(date):
 def _MakeSensor(args):
     m = args["mantissa"]
     c = args["exp"] << 5 | args["unit"] << 3 | len(m)
-    return [c] + m
+    return [c] + list(m)
 
 
 def _MakeMeter(args):
-    c1 = (args["unit"] & 4) << 7 | args["rate"] << 5 | (args["type"] & 0x1f)
+    c1 = (args["unit"] & 4) << 5 | args["rate"] << 5 | (args["type"] & 0x1f)
     c2 = args["exp"] << 5 | (args["unit"] & 3) << 3 | len(args["mantissa"])
     delta = []
     if "dt" in args:
         dt = args["dt"]
         delta = [dt >> 8, dt & 0xff]
-    return [c1, c2] + args["mantissa"] + delta + args.get("mantissa2", [])
+    return [c1, c2] + list(args["mantissa"]) + delta + list(args.get("mantissa2", []))
 
 
 def _MakeByte(b):
@@ -356,13 +366,13 @@ def _MakeName(_w):
 
 
 def _MakeList(lst):
-    return lst
+    return list(lst)
 
 
 def _MakeNonce(lst):
     if len(lst) != 8:
         raise ValueError("bad nonce parameter of length %d" % len(lst))
-    return lst
+    return list(lst)
 
 
 def _MakeValue(v):
@@ -377,7 +387,7 @@ def _MakeValue(v):
 def _MakeString(v):
     m = v["text"]
     c = (v["encoding"] << 5) | len(m)
-    return [c] + m
+    return [c] + list(m)
 
 
 def _MakeStringWithLength(v):
@@ -434,6 +444,19 @@ def _MakeExtensions(v):
     return out
 
 
+def _MakeConfigurationProperties(v):
+    size = v["size"]
+    out = [(v.get("altering") and 0x80 or 0) | (v.get("readonly") and 0x40 or 0) |
+           (v["format"] & 7) << 3 | size]
+    if size:
+        for name in ("min", "max", "default"):
+            out += list((v[name] & ((1 << 8 * size) - 1)).to_bytes(size, "big"))
+    out += _MakeWord(v["next"])
+    if "flags" in v:
+        out.append(v["flags"])
+    return out
+
+
 _OPTIONAL_COMPONENTS = {'b', 't'}
 
 # Whenever you augment this make sure there is a test case in
@@ -449,6 +472,7 @@ _PARSE_ACTIONS = {
     "M": (_ParseMeter, _MakeMeter),
     # "N": (_ParseName, _MakeName),
     "O": (_ParseNonce, _MakeNonce),
+    "P": (_ParseConfigurationProperties, _MakeConfigurationProperties),
     "R": (_ParseRestLittleEndianInt, _MakeLittleEndianInt),  # as integer
     # "T": _ParseSizedLittleEndianInt,
     "V": (_ParseValue, _MakeValue),
@@ -469,8 +493,7 @@ def _GetParameterDescriptors(m):
     return z.SUBCMD_TO_PARSE_TABLE[key]
 
 
-def ParseCommand(m):
-    """ParseCommand decodes an API_APPLICATION_COMMAND request into a map of values"""
+def _ParseCommandInterpreted(m):
     table = _GetParameterDescriptors(m)
 
     if table is None:
@@ -492,15 +515,13 @@ def ParseCommand(m):
     return out
 
 
-def AssembleCommand(key, args):
+def _AssembleCommandInterpreted(key, args):
     table = z.SUBCMD_TO_PARSE_TABLE[key[0] * 256 + key[1]]
     assert table is not None
     data = [
         key[0],
         key[1]
     ]
-    # logging.debug("${raw_cmd[0]} ${raw_cmd[1]}: table length:
-    # ${table.length}")
     for t in table:
         kind = t[0]
         name = t[2:-1]
@@ -512,40 +533,479 @@ def AssembleCommand(key, args):
     return data
 
 
-def MaybePatchCommand(m):
-    # if m[0] == z.MultiInstance and m[1] == z.MultiInstance_Encap:
-    #    logging.warning("received MultiInstance_Encap for instance")
-    #    return m[4:]
-
-    if ((m[0], m[1]) == z.SensorMultilevel_Report and
-            m[2] == 1 and
-            ((m[3] & 7) > len(m) - 4)):
-        x = 1 << 5 | (0 << 3) | 2
-        # [49, 5, 1, 127, 1, 10] => [49, 5, 1, X, 1, 10]
-        logging.error(
-            "A fixing up SensorMultilevel_Report %s: [3] %02x-> %02x", Hexify(m), m[3], x)
-        m[3] = x
-
-    if ((m[0], m[1]) == z.SensorMultilevel_Report and
-            m[2] == 1 and
-            (m[3] & 0x10) != 0):
-        x = m[3] & 0xe7
-        logging.error(
-            "B fixing up SensorMultilevel_Report %s: [3] %02x-> %02x", Hexify(m), m[3], x)
-        m[3] = x
-
-    if (m[0], m[1]) == z.Version_CommandClassReport and len(m) == 3:
-        m.append(1)
-    # if (m[0], m[1]) == z.SensorMultilevel_Report and (m[3] & 7) not in (1, 2, 4):
-    #     size = m[3] & 7
-    #     if size == 3:
-    #         size = 2
-    #     elif size == 7:
-    #         size = 1
-    #     elif size == 6:
-    #         size = 2
-    #     x = m[3] & 0xf8 | size
-    #     logging.error(
-    #         "C fixing up SensorMultilevel_Report %s: [3] %02x-> %02x", Hexify(m), m[3], x)
-    #     m[3] = x
+# ======================================================================
+# Records
+# ======================================================================
+# Parsed values are kept for a long time (c.f. NodeValues) so instead of
+# dicts they are stored as immutable records with one slot per field of
+# the parse table. Nested dicts (meter readings, sized values, ...) become
+# records as well and lists become tuples.
+# Records are read-only Mappings so code written against the dicts keeps
+# working. Fields can also be read as attributes, a trailing underscore is
+# added if the name clashes with a keyword or a Mapping method, e.g. "class_".
+
+class Record(collections.abc.Mapping):
+    """Base class of the generated, immutable record types"""
+    __slots__ = ()
+    # command key or None for nested records
+    KEY = None
+    # field name -> slot name in wire order
+    _SLOTS = {}
+
+    def __getitem__(self, name):
+        slot = self._SLOTS.get(name)
+        if slot is None:
+            raise KeyError(name)
+        try:
+            return getattr(self, slot)
+        except AttributeError:
+            # absent optional field
+            raise KeyError(name) from None
+
+    def __iter__(self):
+        for name, slot in self._SLOTS.items():
+            if hasattr(self, slot):
+                yield name
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __setattr__(self, name, value):
+        raise TypeError("%s is immutable" % type(self).__name__)
+
+    __delattr__ = __setattr__
+
+    def __hash__(self):
+        return hash((self.KEY, tuple(self.items())))
+
+    def __repr__(self):
+        return repr(self.AsDict())
+
+    def AsDict(self) -> dict:
+        """Returns plain dicts and lists, e.g. for json"""
+        return {name: _PlainValue(v) for name, v in self.items()}
+
+
+_SET_SLOT = object.__setattr__
+
+
+def _SlotName(name):
+    if keyword.iskeyword(name) or hasattr(Record, name):
+        return name + "_"
+    return name
+
+
+def _MakeRecordType(name, key, fields):
+    slots = {f: _SlotName(f) for f in fields}
+    return type(name, (Record,), {"__slots__": tuple(slots.values()),
+                                  "KEY": key, "_SLOTS": slots})
+
+
+def _MakeRecordTypes(tables):
+    out = {}
+    for key, table in tables.items():
+        fields = list(dict.fromkeys(t[2:-1] for t in table))
+        if not all(f.isidentifier() for f in fields):
+            continue
+        out[key] = _MakeRecordType(z.SUBCMD_TO_STRING[key], (key >> 8, key & 0xff), fields)
+    return out
+
+
+_RECORD_TYPES = _MakeRecordTypes(z.SUBCMD_TO_PARSE_TABLE)
+
+# field names -> record type for nested values
+_NESTED_RECORD_TYPES = {}
+
+
+def _NestedRecord(d: dict):
+    fields = tuple(d)
+    cls = _NESTED_RECORD_TYPES.get(fields)
+    if cls is None:
+        cls = _MakeRecordType("Values", None, fields)
+        _NESTED_RECORD_TYPES[fields] = cls
+    return _FillRecord(cls, d)
+
+
+def _RecordValue(v):
+    t = type(v)
+    if t is int or t is bytes or t is str or t is float or v is None:
+        return v
+    if t is list or t is tuple:
+        out = tuple(v)
+        for x in out:
+            if type(x) is not int:
+                return tuple(map(_RecordValue, out))
+        return out
+    if isinstance(v, dict):
+        return _NestedRecord(v)
+    if isinstance(v, Record):
+        return v
+    if isinstance(v, set):
+        return frozenset(v)
+    return v
+
+
+def _PlainValue(v):
+    if isinstance(v, Record):
+        return v.AsDict()
+    if type(v) is tuple:
+        return [_PlainValue(x) for x in v]
+    if type(v) is frozenset:
+        # json has no sets
+        return sorted(v)
+    return v
+
+
+def _FillRecord(cls, d):
+    r = cls.__new__(cls)
+    slots = cls._SLOTS
+    for name, v in d.items():
+        if type(v) is not int:
+            v = _RecordValue(v)
+        _SET_SLOT(r, slots[name], v)
+    return r
+
+
+def RecordType(key):
+    """Returns the record type for the command key or None"""
+    return _RECORD_TYPES.get(key[0] * 256 + key[1])
+
+
+def MakeRecord(key, values):
+    """Converts the values of a command (usually a dict) into a record.
+    Values of commands without parse table (e.g. custom ones) are returned as is.
+    """
+    if isinstance(values, Record) or key[0] > 255:
+        return values
+    cls = _RECORD_TYPES.get(key[0] * 256 + key[1])
+    if cls is None:
+        return values
+    return _FillRecord(cls, values)
+
+
+# ======================================================================
+# Codec Compiler
+# ======================================================================
+# At import time every parse table is turned into a (parse, assemble, record)
+# triple where record parses directly into a Record.
+# Tables consisting of bytes and words only are compiled into straight line
+# code indexing the message directly, the others into a loop over
+# precomputed (name, parser, maker, optional) tuples.
+# Tables using kinds without an entry in _PARSE_ACTIONS are left to the
+# interpreter.
+
+_FIXED_SIZE_KINDS = {"B": 1, "W": 2}
+
+
+def _CompileFixed(key, fields):
+    cls = _RECORD_TYPES[key]
+    size = 2
+    parse_items = []
+    record_items = []
+    make_items = []
+    checks = []
+    for n, (kind, name) in enumerate(fields):
+        if kind == "B":
+            item = "m[%d]" % size
+            make_items.append("a%d" % n)
+        else:
+            item = "m[%d] * 256 + m[%d]" % (size, size + 1)
+            make_items += ["(a%d >> 8) & 0xff" % n, "a%d & 0xff" % n]
+        parse_items.append("%r: %s" % (name, item))
+        record_items.append("    _set(r, %r, %s)" % (cls._SLOTS[name], item))
+        checks += ["    a%d = args.get(%r)" % (n, name),
+                   "    if a%d is None:" % n,
+                   "        raise ValueError(%r)" % ("missing args for [%s]" % name)]
+        size += _FIXED_SIZE_KINDS[kind]
+
+    size_check = []
+    if size > 2:
+        size_check = ["    if len(m) < %d:" % size,
+                      "        raise ValueError(%r)" % ("cannot parse %s" % z.SUBCMD_TO_STRING[key])]
+    src = ["def parse(m):"] + size_check
+    src += ["    return {%s}" % ", ".join(parse_items),
+            "",
+            "def record(m):"]
+    src += size_check
+    src += ["    r = _new(_cls)"] + record_items + ["    return r",
+                                                  "",
+                                                  "def assemble(args):"]
+    src += checks
+    src += ["    return [%s]" % ", ".join(["%d" % (key >> 8), "%d" % (key & 0xff)] + make_items)]
+    env = {"_new": object.__new__, "_cls": cls, "_set": _SET_SLOT}
+    exec("\n".join(src), env)
+    return env["parse"], env["assemble"], env["record"]
+
+
+def _CompileGeneric(key, fields):
+    actions = tuple((name, _PARSE_ACTIONS[kind][0], _PARSE_ACTIONS[kind][1],
+                     kind in _OPTIONAL_COMPONENTS) for kind, name in fields)
+    header = [key >> 8, key & 0xff]
+
+    def parse(m):
+        out = {}
+        index = 2
+        try:
+            for name, parser, _, optional in actions:
+                index, value = parser(m, index)
+                if value is None:
+                    if not optional:
+                        raise ValueError("missing value for %s" % name)
+                else:
+                    out[name] = value
+        except IndexError:
+            # not all parsers check the length - report truncation uniformly
+            raise ValueError("truncated %s" % z.SUBCMD_TO_STRING[key])
+        return out
+
+    def assemble(args):
+        data = header[:]
+        for name, _, maker, optional in actions:
+            v = args.get(name)
+            if v is None and not optional:
+                raise ValueError("missing args for [%s]" % name)
+            data += maker(v)
+        return data
+
+    cls = _RECORD_TYPES[key]
+
+    def record(m):
+        return _FillRecord(cls, parse(m))
+
+    return parse, assemble, record
+
+
+def _CompileCodecs(tables):
+    out = {}
+    for key, table in tables.items():
+        fields = [(t[0], t[2:-1]) for t in table]
+        if any(kind not in _PARSE_ACTIONS for kind, _ in fields) or key not in _RECORD_TYPES:
+            continue
+        if all(kind in _FIXED_SIZE_KINDS for kind, _ in fields):
+            out[key] = _CompileFixed(key, fields)
+        else:
+            out[key] = _CompileGeneric(key, fields)
+    return out
+
+
+_CODECS = _CompileCodecs(z.SUBCMD_TO_PARSE_TABLE)
+
+
+def ParseCommand(m):
+    """ParseCommand decodes an API_APPLICATION_COMMAND request into a map of values"""
+    if len(m) < 2:
+        logging.error("malformed command %s", m)
+        raise ValueError("unknown command")
+    codec = _CODECS.get(m[0] * 256 + m[1])
+    if codec is None:
+        return _ParseCommandInterpreted(m)
+    return codec[0](m)
+
+
+def AssembleCommand(key, args):
+    codec = _CODECS.get(key[0] * 256 + key[1])
+    if codec is None:
+        return _AssembleCommandInterpreted(key, args)
+    return codec[1](args)
+
+
+def ParseRecord(m) -> Record:
+    """Like ParseCommand() but returns a record"""
+    if len(m) < 2:
+        logging.error("malformed command %s", m)
+        raise ValueError("unknown command")
+    codec = _CODECS.get(m[0] * 256 + m[1])
+    if codec is None:
+        return MakeRecord((m[0], m[1]), _ParseCommandInterpreted(m))
+    return codec[2](m)
+
+
+# ======================================================================
+# Assemble Cache
+# ======================================================================
+# Refreshes send the same queries with the same arguments to every node
+# over and over, so assembled commands are memoized per (key, args).
+
+ASSEMBLE_CACHE_SIZE = 4096
+
+
+def _ArgsKey(v):
+    if isinstance(v, dict):
+        return dict, tuple(sorted((k, _ArgsKey(x)) for k, x in v.items()))
+    if isinstance(v, (list, tuple)):
+        return list, tuple(_ArgsKey(x) for x in v)
+    if isinstance(v, (set, frozenset)):
+        return set, frozenset(v)
+    return v
+
+
+class AssembleCache:
+    """Memoizes finish(AssembleCommand(key, args)) per (key, args).
+
+    The results are shared so finish must return something immutable.
+    """
+
+    def __init__(self, finish=tuple, size=ASSEMBLE_CACHE_SIZE):
+        self._finish = finish
+        self._size = size
+        self._entries = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def Get(self, key, args):
+        try:
+            # fast path for the common case of flat arguments
+            k = (key, tuple(args.items()))
+            out = self._entries.get(k)
+        except TypeError:
+            k = (key, _ArgsKey(args))
+            out = self._entries.get(k)
+        if out is None:
+            out = self._finish(AssembleCommand(key, args))
+            if len(self._entries) >= self._size:
+                self._entries.clear()
+            self._entries[k] = out
+        return out
+
+
+_ASSEMBLE_CACHE = AssembleCache()
+
+
+def AssembleCommandCached(key, args) -> tuple:
+    """Like AssembleCommand() but memoized. The result is shared, hence a tuple."""
+    return _ASSEMBLE_CACHE.Get(key, args)
+
+
+# ======================================================================
+# Parse Cache
+# ======================================================================
+# Meters and sensors tend to send byte identical reports over and over.
+# The optional cache maps the raw command to the parsed record which is
+# immutable and hence can be shared between all consumers.
+
+PARSE_CACHE_SIZE = 1024
+
+
+class ParseCache:
+    """Bounded LRU cache from raw commands to parsed records"""
+
+    def __init__(self, size=PARSE_CACHE_SIZE):
+        self._size = size
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __str__(self):
+        return "entries: %d/%d hits: %d misses: %d rate: %.1f%%" % (
+            len(self._entries), self._size, self.hits, self.misses, 100.0 * self.HitRate())
+
+    def HitRate(self):
+        return self.hits / max(1, self.hits + self.misses)
+
+    def Parse(self, data, quirks=None):
+        """Like ParseRecord() after applying quirks but the result is shared"""
+        raw = bytes(data)
+        key = (quirks, raw)
+        with self._lock:
+            values = self._entries.get(key)
+            if values is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return values
+            self.misses += 1
+        # parse outside the lock, errors are not cached
+        values = ParseRecord(_ApplyQuirks(list(raw), quirks))
+        with self._lock:
+            self._entries[key] = values
+            if len(self._entries) > self._size:
+                self._entries.popitem(last=False)
+        return values
+
+
+_PARSE_CACHE = None
+
+
+def EnableParseCache(size=PARSE_CACHE_SIZE) -> ParseCache:
+    """Turns on memoization of parsed commands, returns the cache for stats"""
+    global _PARSE_CACHE
+    _PARSE_CACHE = ParseCache(size)
+    return _PARSE_CACHE
+
+
+def DisableParseCache():
+    global _PARSE_CACHE
+    _PARSE_CACHE = None
+
+
+def _ApplyQuirks(m, quirks):
+    if quirks:
+        for q in quirks:
+            m = q.Apply(m)
     return m
+
+
+class CommandValues(collections.abc.Mapping):
+    """Read-only map of the values of a raw command which is only decoded
+    when the values are first accessed.
+
+    Listeners which merely route by node and command key never pay for the
+    parsing.
+    quirks are the Quirks (c.f. QuirkRegistry.Lookup()) applied before parsing.
+    endpoint, security and path describe the encapsulation the command
+    arrived in, c.f. command_translator.Decapsulate().
+    """
+    __slots__ = ("_data", "_quirks", "_values", "_failed", "endpoint", "security", "path")
+
+    def __init__(self, data, quirks=None, endpoint=0, security=None, path=()):
+        self._data = data
+        self._quirks = quirks
+        self._values = None
+        self._failed = False
+        self.endpoint = endpoint
+        self.security = security
+        self.path = path
+
+    def Decoded(self):
+        return self._values is not None
+
+    def Failed(self):
+        """True if decoding was attempted and raised"""
+        return self._failed
+
+    def Decode(self) -> Record:
+        if self._values is None:
+            cache = _PARSE_CACHE
+            try:
+                if cache is not None:
+                    self._values = cache.Parse(self._data, self._quirks)
+                else:
+                    self._values = ParseRecord(_ApplyQuirks(list(self._data), self._quirks))
+            except Exception:
+                self._failed = True
+                raise
+        return self._values
+
+    def AsDict(self) -> dict:
+        return self.Decode().AsDict()
+
+    def __getitem__(self, name):
+        return self.Decode()[name]
+
+    def __iter__(self):
+        return iter(self.Decode())
+
+    def __len__(self):
+        return len(self.Decode())
+
+    def __repr__(self):
+        return repr(self.Decode())
+
+
+def MaybePatchCommand(m, product: tuple = None):
+    """Applies the default quirks, c.f. quirks.py, to the raw command m (a list)"""
+    return DEFAULT_QUIRKS.Patch(m, product)
@@ -20,8 +20,12 @@ command.py contain code for parsing and assembling API_APPLICATION_COMMAND_reque
 
 It also contains some logic pertaining to the node state machine.
 """
+from pyzwaver import command
 from pyzwaver import zwave as z
 
+# Largest command which still fits into a single (non secure) frame
+MAX_COMMAND_SIZE = 46
+
 DYNAMIC_PROPERTY_QUERIES = [
     # Basic should be first
     (z.Basic_Get, {}),
@@ -176,6 +180,70 @@ def ConfigurationSet(param, size, val, request_update=True):
     return c
 
 
+# Configuration v3+
+CONFIGURATION_BULK_DEFAULT = 0x80
+CONFIGURATION_BULK_HANDSHAKE = 0x40
+# Configuration_PropertiesReport flags (v4+), read-only and altering
+# capabilities are reported in the format byte instead
+CONFIGURATION_PROPERTY_ADVANCED = 0x01
+CONFIGURATION_PROPERTY_NO_BULK = 0x02
+
+
+def _ConfigurationRuns(params, max_count):
+    """Groups (parameter, size, ...) tuples into runs of consecutive parameters
+    of the same size with at most max_count(size) members"""
+    runs = []
+    for p in sorted(params):
+        if runs:
+            last = runs[-1]
+            if (last[-1][0] + 1 == p[0] and last[-1][1] == p[1] and
+                    len(last) < max_count(p[1])):
+                last.append(p)
+                continue
+        runs.append([p])
+    return runs
+
+
+def ConfigurationPropertiesQueries(params):
+    return [(z.Configuration_PropertiesGet, {"parameter": p}) for p in params]
+
+
+def ConfigurationBulkQueries(sizes):
+    """sizes maps parameter -> size"""
+    return [(z.Configuration_BulkGet, {"parameter": run[0][0], "count": len(run)})
+            for run in _ConfigurationRuns(sizes.items(), lambda _: 255)]
+
+
+def ConfigurationBulkSet(params, handshake=True):
+    """params is a list of (parameter, size, value). With handshake the node
+    confirms with a Configuration_BulkReport, otherwise we ask for one."""
+    c = []
+    # 6 bytes of header
+    for run in _ConfigurationRuns(params, lambda size: (MAX_COMMAND_SIZE - 6) // size):
+        first, size = run[0][0], run[0][1]
+        data = []
+        for _, _, value in run:
+            data += list((value & ((1 << 8 * size) - 1)).to_bytes(size, "big"))
+        flags = size | (CONFIGURATION_BULK_HANDSHAKE if handshake else 0)
+        c.append((z.Configuration_BulkSet,
+                  {"parameter": first, "count": len(run), "flags": flags, "values": data}))
+        if not handshake:
+            c.append((z.Configuration_BulkGet, {"parameter": first, "count": len(run)}))
+    return c
+
+
+def SplitConfigurationBulkReport(v):
+    """Returns the (parameter, size, value) triples of a Configuration_BulkReport"""
+    size = v["flags"] & 7
+    data = v["values"]
+    if size == 0:
+        return []
+    count = min(v["count"], len(data) // size)
+    first = v["parameter"]
+    return [(first + i, size, int.from_bytes(bytes(data[i * size:(i + 1) * size]), "big"))
+            for i in range(count)]
+
+
 def AssociationAdd(group, n):
     return [(z.Association_Set, {"group": group, "nodes": [n]}),
             (z.Association_Get, {"group": group})]
@@ -184,3 +252,100 @@ def AssociationAdd(group, n):
 def AssociationRemove(group, n):
     return [(z.Association_Remove, {"group": n, "nodes": [n]}),
             (z.Association_Get, {"group": group})]
+
+
+# Plain queries which may be bundled into a MultiCmd_Encap.
+# Security, Supervision and MultiCmd commands must never be bundled: they are
+# sent on their own and their reports are matched per command.
+_BUNDLEABLE_GETS = frozenset([
+    z.Alarm_Get,
+    z.Alarm_SupportedGet,
+    z.AssociationGroupInformation_InfoGet,
+    z.AssociationGroupInformation_ListGet,
+    z.AssociationGroupInformation_NameGet,
+    z.Association_Get,
+    z.Association_GroupingsGet,
+    z.Basic_Get,
+    z.Battery_Get,
+    z.CentralScene_SupportedGet,
+    z.Clock_Get,
+    z.ColorSwitch_Get,
+    z.ColorSwitch_SupportedGet,
+    z.Configuration_BulkGet,
+    z.Configuration_Get,
+    z.Configuration_PropertiesGet,
+    z.DoorLockLogging_SupportedGet,
+    z.DoorLock_ConfigurationGet,
+    z.DoorLock_Get,
+    z.Firmware_MetadataGet,
+    z.Indicator_Get,
+    z.Lock_Get,
+    z.ManufacturerSpecific_DeviceSpecificGet,
+    z.ManufacturerSpecific_Get,
+    z.Meter_Get,
+    z.Meter_SupportedGet,
+    z.MultiChannel_CapabilityGet,
+    z.MultiChannel_EndPointGet,
+    z.NodeNaming_Get,
+    z.NodeNaming_LocationGet,
+    z.Powerlevel_Get,
+    z.Protection_Get,
+    z.SceneActuatorConf_Get,
+    z.SensorAlarm_Get,
+    z.SensorAlarm_SupportedGet,
+    z.SensorBinary_Get,
+    z.SensorMultilevel_Get,
+    z.SensorMultilevel_SupportedGet,
+    z.SwitchAll_Get,
+    z.SwitchBinary_Get,
+    z.SwitchMultilevel_Get,
+    z.SwitchMultilevel_SupportedGet,
+    z.SwitchToggleBinary_Get,
+    z.ThermostatMode_Get,
+    z.ThermostatMode_SupportedGet,
+    z.ThermostatSetpoint_SupportedGet,
+    z.TimeParameters_Get,
+    z.UserCode_NumberGet,
+    z.Version_CommandClassGet,
+    z.Version_Get,
+    z.ZwavePlusInfo_Get,
+])
+
+
+def MultiCommandBundles(commands, max_size=MAX_COMMAND_SIZE):
+    """Folds runs of consecutive Gets into MultiCmd_Encap commands of at most
+    max_size bytes. Everything else is passed through in order."""
+    out = []
+    bundle = []
+    size = 3
+
+    def flush():
+        if len(bundle) == 1:
+            out.append(bundle[0][0])
+        elif bundle:
+            data = []
+            for _, raw in bundle:
+                data += [len(raw), *raw]
+            out.append((z.MultiCmd_Encap, {"count": len(bundle), "commands": data}))
+        bundle.clear()
+
+    for c in commands:
+        raw = None
+        if c[0] in _BUNDLEABLE_GETS:
+            try:
+                raw = command.AssembleCommandCached(c[0], c[1])
+            except Exception as _e:
+                # leave it to the caller to report
+                pass
+        if raw is None:
+            flush()
+            size = 3
+            out.append(c)
+            continue
+        if size + 1 + len(raw) > max_size or len(bundle) == 255:
+            flush()
+            size = 3
+        bundle.append((c, raw))
+        size += 1 + len(raw)
+    flush()
+    return out
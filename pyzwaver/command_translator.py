@@ -29,9 +29,13 @@ from typing import List
 
 from pyzwaver import zmessage
 from pyzwaver import command
+from pyzwaver import command_helper
+from pyzwaver import subscription
+from pyzwaver import transport_service
 from pyzwaver import zwave as z
 # from pyzwaver import zsecurity
 from pyzwaver.driver import Driver
+from pyzwaver.quirks import DEFAULT_QUIRKS, QuirkRegistry
 
 
 def Hexify(t):
@@ -50,6 +54,80 @@ _BAUD = [
 ]
 
 
+# ======================================================================
+# Decapsulation
+# ======================================================================
+
+SECURITY_S2 = "S2"
+
+# used for TransportService segment requests/completions and retransmissions
+_TRANSPORT_XMIT = (z.TRANSMIT_OPTION_ACK |
+                   z.TRANSMIT_OPTION_AUTO_ROUTE |
+                   z.TRANSMIT_OPTION_EXPLORE)
+
+
+def _SplitMultiCmd(data):
+    count = data[2]
+    index = 3
+    out = []
+    for _ in range(count):
+        size = data[index]
+        if size < 2 or index + 1 + size > len(data):
+            raise ValueError("malformed MultiCmd_Encap")
+        out.append(data[index + 1:index + 1 + size])
+        index += 1 + size
+    return out
+
+
+def Decapsulate(n, data: memoryview, decrypt=None):
+    """Peels all encapsulation layers off the command data in a single pass.
+
+    Only memoryview slices are taken, nothing is copied - except for
+    decrypted payloads. decrypt(n, data) -> bytes or None is used for
+    Security2_MessageEncapsulation; without it such commands pass through.
+
+    Returns a list of (command, endpoint, security, path) where path is the
+    tuple of the encapsulation keys peeled off, outermost first.
+    A MultiCmd_Encap yields one entry per embedded command.
+    """
+    out = []
+    todo = [(data, 0, None, ())]
+    while todo:
+        data, endpoint, security, path = todo.pop()
+        while data is not None and len(data) >= 2:
+            key = (data[0], data[1])
+            if key == z.MultiChannel_ChannelEncap and len(data) >= 6:
+                endpoint = data[2] & 0x7f
+                data = data[4:]
+            elif key == z.MultiChannel_Encap and len(data) >= 5:
+                endpoint = data[2]
+                data = data[3:]
+            elif key == z.CRC16Encap_Encap and len(data) >= 6:
+                if zmessage.Crc16(data[:-2]) != data[-2] << 8 | data[-1]:
+                    logging.error("[%d] dropping command with bad crc16: %s", n, Hexify(data))
+                    data = None
+                    break
+                data = data[2:-2]
+            elif key == z.MultiCmd_Encap and len(data) >= 3:
+                path = path + (key,)
+                for c in reversed(_SplitMultiCmd(data)):
+                    todo.append((c, endpoint, security, path))
+                data = None
+                break
+            elif key == z.Security2_MessageEncapsulation and decrypt is not None:
+                plaintext = decrypt(n, data)
+                if plaintext is None:
+                    break
+                data = memoryview(plaintext)
+                security = SECURITY_S2
+            else:
+                break
+            path = path + (key,)
+        if data is not None:
+            out.append((data, endpoint, security, path))
+    return out
+
+
 class CommandTranslator(object):
     """CommandTranslator is responsible for translating between the wire representantion
      of "commands" (raw messages) and the equivalent dictionary representation.
@@ -63,25 +141,62 @@ class CommandTranslator(object):
 
     """
 
-    def __init__(self, driver: Driver):
+    def __init__(self, driver: Driver, quirks: QuirkRegistry = DEFAULT_QUIRKS):
         self._driver = driver
         self._listeners = []
+        self._subscriptions = subscription.SubscriptionIndex()
+        self._quirks = quirks
+        # node -> (manufacturer, type, product) used to select device specific quirks
+        self._products = {}
+        self._decrypt = None
+        # wire format of recently sent commands minus node, xmit and callback id
+        self._templates = command.AssembleCache(zmessage.MakeRawCommandTemplate)
+        # segmentation/reassembly of commands exceeding a single frame
+        self._transport = transport_service.TransportService(self._SendTransportCommand)
         driver.AddListener(self)
 
     def AddListener(self, l):
         self._listeners.append(l)
 
+    def Subscribe(self, callback, n=None, cls=None, key=None):
+        """callback(n, ts, key, values) is called for the commands matching
+        the given node, command class and/or key. Returns a handle for
+        Unsubscribe()."""
+        return self._subscriptions.Subscribe(callback, n, cls, key)
+
+    def Unsubscribe(self, handle):
+        self._subscriptions.Unsubscribe(handle)
+
+    def SetDecryptor(self, decrypt):
+        """decrypt(n, data) -> plaintext or None unwraps Security2_MessageEncapsulation"""
+        self._decrypt = decrypt
+
+    def SetProductInfo(self, n, product: tuple):
+        """Usually learned from ManufacturerSpecific_Report but may be restored"""
+        self._products[n] = product
+
     def _PushToListeners(self, n, ts, key, value):
         for l in self._listeners:
             l.put(n, ts, key, value)
+        for callback in self._subscriptions.Match(n, key):
+            callback(n, ts, key, value)
 
-    def _SendMessageMulti(self, nn, m, priority: tuple, handler):
-        mesg = zmessage.Message(m, priority, handler, nn[0])
-        self._driver.SendMessage(mesg)
+    def _SendMessageMulti(self, nn, m, priority: tuple, handler, tag=None):
+        mesg = zmessage.Message(m, priority, handler, nn[0], tag=tag)
+        return self._driver.SendMessage(mesg)
+
+    def Barrier(self, nodes=None, lane=None):
+        """Returns a future completing once the pending commands for nodes are done"""
+        return self._driver.Barrier(nodes=nodes, lane=lane)
 
-    def SendMultiCommand(self, nodes: List[int], key, values, priority: tuple, xmit: int):
+    def PurgeCommands(self, node=None, lane=None, tag=None):
+        """Withdraws queued messages, c.f. Driver.PurgeMessages()"""
+        return self._driver.PurgeMessages(node=node, lane=lane, tag=tag)
+
+    def SendMultiCommand(self, nodes: List[int], key, values, priority: tuple, xmit: int,
+                         tag=None):
         try:
-            raw_cmd = command.AssembleCommand(key, values)
+            raw_cmd = command.AssembleCommandCached(key, values)
         except Exception as e:
             logging.error("cannot assemble command for %s %s %s",
                           command.StringifyCommand(key),
@@ -96,7 +211,7 @@ class CommandTranslator(object):
             logging.debug("@@handler invoked")
 
         m = zmessage.MakeRawCommandMultiWithId(nodes, raw_cmd, xmit)
-        self._SendMessageMulti(nodes, m, priority, handler)
+        return self._SendMessageMulti(nodes, m, priority, handler, tag)
 
     def _ProcessProtocolInfo(self, n, data):
         a, b, _, basic, generic, specific = struct.unpack(">BBBBBB", data)
@@ -132,13 +247,27 @@ class CommandTranslator(object):
         self._PushToListeners(
             n, time.time(), command.CUSTOM_COMMAND_PROTOCOL_INFO, out)
 
-    def _SendMessage(self, n, m, priority: tuple, handler):
-        mesg = zmessage.Message(m, priority, handler, n)
+    def _SendMessage(self, n, m, priority: tuple, handler, tag=None):
+        mesg = zmessage.Message(m, priority, handler, n, tag=tag)
         self._driver.SendMessage(mesg)
+        return mesg
+
+    def _SendTransportCommand(self, n, raw_cmd):
+        def handler(_):
+            logging.debug("@@handler invoked")
 
-    def SendCommand(self, n: int, key: tuple, values: dict, priority: tuple, xmit: int):
+        m = zmessage.MakeRawCommandWithId(n, raw_cmd, _TRANSPORT_XMIT)
+        return self._SendMessage(n, m, zmessage.NodePriorityHi(n), handler)
+
+    def SendCommand(self, n: int, key: tuple, values: dict, priority: tuple, xmit: int,
+                    tag=None, segment=False):
+        """Returns the queued message which may be cancelled or None on error
+
+        With segment set, commands not fitting into a single frame are sent
+        as TransportService segments and the last segment is returned.
+        """
         try:
-            raw_cmd = command.AssembleCommand(key, values)
+            template = self._templates.Get(key, values)
         except Exception as _e:
             logging.error("cannot assemble command for %s %s %s",
                           command.StringifyCommand(key),
@@ -152,8 +281,20 @@ class CommandTranslator(object):
         def handler(_):
             logging.debug("@@handler invoked")
 
-        m = zmessage.MakeRawCommandWithId(n, raw_cmd, xmit)
-        self._SendMessage(n, m, priority, handler)
+        size = template[1][0]
+        if size > command_helper.MAX_COMMAND_SIZE:
+            if not segment:
+                logging.warning("[%d] %s has %d bytes and may not fit into a frame",
+                                n, command.StringifyCommand(key), size)
+            else:
+                mesg = None
+                for raw_cmd in self._transport.Segment(n, template[1][1:]):
+                    m = zmessage.MakeRawCommandWithId(n, raw_cmd, xmit)
+                    mesg = self._SendMessage(n, m, priority, handler, tag)
+                return mesg
+
+        m = zmessage.MakeRawCommandWithIdFromTemplate(n, template, xmit)
+        return self._SendMessage(n, m, priority, handler, tag)
 
     def _RequestNodeInfo(self, n, retries):
         """This usually triggers send "API_ZW_APPLICATION_UPDATE:"""
@@ -220,26 +361,61 @@ class CommandTranslator(object):
 
             self._UpdateIsFailedNode(n, handler)
 
-    def _HandleMessageApplicationCommand(self, ts, m):
-        _ = m[4]  # status
-        n = m[5]
-        size = m[6]
-        try:
-            data = [int(x) for x in m[7:7 + size]]
-            data = command.MaybePatchCommand(data)
-            value = command.ParseCommand(data)
-            if value is None:
-                logging.error("[%d] parsing failed for %s", n, Hexify(data))
+    def _HandleMessageApplicationCommand(self, ts, m: zmessage.Frame):
+        n = m.Node()
+        data = m.Command()
+        if data is None or len(data) < 2:
+            logging.error("[%d] malformed command: %s", n, m)
+            return
+        if transport_service.IsTransportService(data):
+            data = self._transport.Receive(ts, n, data)
+            if data is None:
+                # waiting for more segments
                 return
-        except Exception as _e:
-            logging.error("[%d] cannot parse: %s", n,
-                          zmessage.PrettifyRawMessage(m))
-            print("-" * 60)
-            traceback.print_exc(file=sys.stdout)
-            print("-" * 60)
+            data = memoryview(data)
+        try:
+            commands = Decapsulate(n, data, self._decrypt)
+        except (ValueError, IndexError) as _e:
+            logging.error("[%d] cannot decapsulate: %s", n, m)
             return
+        for data, endpoint, security, path in commands:
+            self._PushCommand(ts, n, m, data, endpoint, security, path)
 
-        self._PushToListeners(n, ts, (data[0], data[1]), value)
+    def _PushCommand(self, ts, n, m, data, endpoint, security, path):
+        if len(data) < 2 or data[0] * 256 + data[1] not in z.SUBCMD_TO_PARSE_TABLE:
+            logging.error("[%d] unknown command: %s", n, m)
+            return
+        key = (data[0], data[1])
+        # decoding is deferred until a listener looks at the values
+        values = command.CommandValues(data, self._quirks.Lookup(key, self._products.get(n)),
+                                       endpoint, security, path)
+        if key == z.ManufacturerSpecific_Report and endpoint == 0:
+            try:
+                values.Decode()
+            except Exception as _e:
+                self._ReportParseError(n, m)
+                return
+            self._products[n] = (values.get("manufacturer", 0), values.get("type", 0),
+                                 values.get("product", 0))
+        handlers = [l.put for l in self._listeners] + self._subscriptions.Match(n, key)
+        for handler in handlers:
+            try:
+                handler(n, ts, key, values)
+            except Exception as _e:
+                if values.Failed():
+                    # the handler triggered the decoding, nobody else can use the values
+                    self._ReportParseError(n, m)
+                    return
+                logging.error("[%d] listener failed on %s", n, command.StringifyCommand(key))
+                print("-" * 60)
+                traceback.print_exc(file=sys.stdout)
+                print("-" * 60)
+
+    def _ReportParseError(self, n, m):
+        logging.error("[%d] cannot parse: %s", n, m)
+        print("-" * 60)
+        traceback.print_exc(file=sys.stdout)
+        print("-" * 60)
 
     def _HandleMessageApplicationUpdate(self, ts, m):
         kind = m[4]
@@ -278,6 +454,8 @@ class CommandTranslator(object):
             assert False
 
     def put(self, ts, m):
+        if not isinstance(m, zmessage.Frame):
+            m = zmessage.Frame(m)
         if m[3] == z.API_APPLICATION_COMMAND_HANDLER:
             self._HandleMessageApplicationCommand(ts, m)
         elif m[3] == z.API_ZW_APPLICATION_UPDATE:
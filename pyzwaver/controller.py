@@ -21,6 +21,7 @@ controller.py contains code for dealing with the controller node in a zwave netw
 
 import logging
 import struct
+import threading
 import time
 
 from pyzwaver.driver import Driver
@@ -42,6 +43,7 @@ ACTIVITY_REMOVE_NODE = "RemoveNode"
 ACTIVITY_SET_LEARN_MODE = "SetLearnMode"
 ACTIVITY_CHANGE_CONTROLLER = "ChangeController"
 ACTIVITY_CONTROLLER_UPDATE = "ControllerUpdate"
+ACTIVITY_STICK_RECOVERY = "StickRecovery"
 
 EVENT_PAIRING_ABORTED = "Aborted"
 EVENT_PAIRING_CONTINUE = "InProgress"
@@ -52,6 +54,14 @@ EVENT_PAIRING_STARTED = "Started"
 EVENT_UPDATE_STARTED = "Started"
 EVENT_UPDATE_COMPLETE = "Complete"
 
+EVENT_RECOVERY_STARTED = "Started"
+EVENT_RECOVERY_SUCCESS = "Success"
+EVENT_RECOVERY_FAILED = "Failed"
+
+MAX_RECOVERY_ATTEMPTS = 3
+# time the stick needs to come back after a soft reset
+SOFT_RESET_SETTLE_SECS = 1.5
+
 
 def ExtractNodes(bits):
     assert len(bits) == _NUM_NODE_BITFIELD_BYTES
@@ -219,6 +229,8 @@ class Controller:
         self.failed_nodes = set()
         self.props = ControllerProperties()
         self.routes = {}
+        self._recovery_thread = None
+        self._recovery_event_cb = None
 
     def __str__(self):
         out = [
@@ -516,28 +528,40 @@ class Controller:
 
         self.SendCommandWithId(z.API_SERIAL_API_SOFT_RESET, [], handler)
 
+    def _Priority(self):
+        # messages issued by the recovery thread must bypass the (stuck) queue
+        if threading.current_thread() is self._recovery_thread:
+            return zmessage.RecoveryPriority()
+        return self.Priority()
+
     def SendCommand(self, func, data, handler):
         raw = zmessage.MakeRawMessage(func, data)
-        mesg = zmessage.Message(raw, self.Priority(), handler, -1)
+        mesg = zmessage.Message(raw, self._Priority(), handler, -1)
         self._mq.SendMessage(mesg)
 
     def SendCommandWithId(self, func, data, handler, timeout=2.0):
         raw = zmessage.MakeRawMessageWithId(func, data)
-        mesg = zmessage.Message(raw, self.Priority(), handler, -1, timeout=timeout)
+        mesg = zmessage.Message(raw, self._Priority(), handler, -1, timeout=timeout)
         self._mq.SendMessage(mesg)
 
     def SendCommandWithIdNoResponse(self, func, data, timeout=2.0):
         raw = zmessage.MakeRawMessageWithId(func, data)
-        mesg = zmessage.Message(raw, self.Priority(), None, -1, timeout=timeout,
-                                action_requ=[zmessage.ACTION_NONE],
-                                action_resp=[zmessage.ACTION_NONE])
+        mesg = zmessage.Message(raw, self._Priority(), None, -1, timeout=timeout,
+                                action_requ=zmessage.ACTIONS_NONE,
+                                action_resp=zmessage.ACTIONS_NONE)
         self._mq.SendMessage(mesg)
 
     def SendBarrierCommand(self, handler):
+        """Invokes the handler when all previous controller commands are done.
+
+        Messages for other nodes do not delay the handler.
+        Returns a future which can be waited on instead.
+        """
         logging.warning("SendBarrierCommand")
-        """Dummy Command to invoke the handler when all previous commands are done"""
-        mesg = zmessage.Message(None, self.Priority(), handler, None)
-        self._mq.SendMessage(mesg)
+        future = self._mq.Barrier(lane=self._Priority()[0])
+        if handler:
+            future.add_done_callback(lambda _: handler(None))
+        return future
 
     def Initialize(self):
         self.UpdateVersion()
@@ -550,6 +574,74 @@ class Controller:
         # promotes controller to "INITIALIZED"
         self.ApplNodeInformation()
 
+    # ============================================================
+    # Watchdog
+    # ============================================================
+    def EnableWatchdog(self, event_cb=None):
+        """Soft reset and re-initialize the stick when the driver reports a hang.
+
+        event_cb(ACTIVITY_STICK_RECOVERY, event, duration) is invoked
+        when a recovery starts and when it finishes.
+        """
+        self._recovery_event_cb = event_cb
+        self._mq.AddHangListener(self._OnStickHang)
+
+    def _ReportRecovery(self, event, duration):
+        if self._recovery_event_cb:
+            self._recovery_event_cb(ACTIVITY_STICK_RECOVERY, event, duration)
+
+    def _OnStickHang(self, ts):
+        # invoked from the driver's sending thread which must not block
+        self._recovery_thread = threading.Thread(target=self._RecoverFromHang,
+                                                 args=(ts,), name="StickRecovery")
+        self._recovery_thread.start()
+
+    def _WaitForPendingCommands(self):
+        self.SendBarrierCommand(None).result()
+
+    def _ProbeStick(self):
+        """Returns True if the stick answers a version request"""
+        answers = []
+
+        def handler(data):
+            if data:
+                self.props.SetVersion(*struct.unpack(">12sB", data[4:-1]))
+                answers.append(data)
+
+        self.SendCommand(z.API_ZW_GET_VERSION, [], handler)
+        self._WaitForPendingCommands()
+        return len(answers) > 0
+
+    def _RecoverFromHang(self, _ts):
+        logging.error("stick hang detected - starting recovery")
+        self._ReportRecovery(EVENT_RECOVERY_STARTED, 0.0)
+        success = False
+        attempt = 0
+        while attempt < MAX_RECOVERY_ATTEMPTS and not success:
+            attempt += 1
+            logging.warning("stick recovery attempt %d", attempt)
+            self.SoftReset()
+            self._WaitForPendingCommands()
+            time.sleep(SOFT_RESET_SETTLE_SECS)
+            success = self._ProbeStick()
+        if success:
+            # the essential parts of Initialize()
+            self.SetTimeouts(1000, 150)
+            self.ApplNodeInformation()
+            self._WaitForPendingCommands()
+        else:
+            logging.error("stick did not recover after %d attempts", attempt)
+        # resume the regular queue in either case - if the stick is still
+        # hung this will be detected again.
+        duration = self._mq.ResumeAfterRecovery(attempt, success)
+        self._recovery_thread = None
+        self._ReportRecovery(EVENT_RECOVERY_SUCCESS if success else EVENT_RECOVERY_FAILED,
+                             duration)
+
+    def Recoveries(self):
+        """Returns (start, duration, attempts, success) for each stick recovery"""
+        return self._mq.recoveries
+
     def WaitUntilInitialized(self):
         logging.info("Controller::WaitUntilInitialized")
         while self._state != CONTROLLER_STATE_INITIALIZED:
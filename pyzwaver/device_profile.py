@@ -0,0 +1,177 @@
+#!/usr/bin/python3
+# Copyright 2016 Robert Muth <robert@muth.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 3
+# of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+"""
+device_profile.py caches the static interview results of a product so that
+further nodes of the same product need not be interviewed from scratch.
+
+A profile is the list of static reports a node sent during its interview,
+e.g. command class versions, supported sensors and meters, association group
+info and configuration properties. It is keyed by the product from the
+ManufacturerSpecific_Report and the versions from the Version_Report.
+Reports specific to a single node, e.g. its serial number or associations,
+are not part of it.
+
+Profiles are kept in memory and optionally persisted in a json file.
+"""
+
+import json
+import logging
+import os
+
+from pyzwaver import command
+from pyzwaver import zwave as z
+
+
+def _Single(_v):
+    return None
+
+
+def _Field(name):
+    return lambda v: v[name]
+
+
+def _Groups(v):
+    return tuple(g[0] for g in v["groups"])
+
+
+# reports which are the same for all nodes of a product:
+# report -> function telling apart multiple reports of the same kind
+PROFILE_REPORTS = {
+    z.Version_CommandClassReport: _Field("class"),
+    z.SensorMultilevel_SupportedReport: _Single,
+    z.Meter_SupportedReport: _Single,
+    z.SwitchMultilevel_SupportedReport: _Single,
+    z.ColorSwitch_SupportedReport: _Single,
+    z.Alarm_SupportedReport: _Single,
+    z.SensorAlarm_SupportedReport: _Single,
+    z.ThermostatMode_SupportedReport: _Single,
+    z.ThermostatSetpoint_SupportedReport: _Single,
+    z.UserCode_NumberReport: _Single,
+    z.DoorLockLogging_SupportedReport: _Single,
+    z.CentralScene_SupportedReport: _Single,
+    z.ZwavePlusInfo_Report: _Single,
+    z.Firmware_MetadataReport: _Single,
+    z.MultiChannel_EndPointReport: _Single,
+    z.MultiChannel_CapabilityReport: _Field("endpoint"),
+    z.Association_GroupingsReport: _Single,
+    z.AssociationGroupInformation_NameReport: _Field("group"),
+    z.AssociationGroupInformation_InfoReport: _Groups,
+    z.AssociationGroupInformation_ListReport: _Field("group"),
+    z.Configuration_PropertiesReport: _Field("parameter"),
+}
+
+
+def ProfileKey(values):
+    """Returns the profile key for the NodeValues, None if not yet known"""
+    product = values.ProductInfo()
+    if product == (0, 0, 0):
+        return None
+    if values.HasCommandClass(z.Version) and not values.HasValue(z.Version_Report):
+        return None
+    return product + values.Versions()
+
+
+def _JsonDefault(o):
+    if isinstance(o, bytes):
+        return {"_bytes": o.hex()}
+    raise TypeError("cannot serialize %s" % type(o))
+
+
+def _JsonObject(d):
+    if len(d) == 1 and "_bytes" in d:
+        return bytes.fromhex(d["_bytes"])
+    return d
+
+
+class DeviceProfile:
+    __slots__ = ["key", "reports"]
+
+    def __init__(self, key, reports):
+        self.key = tuple(key)
+        # list of (command key, plain values)
+        self.reports = reports
+
+    def Classes(self):
+        return {v["class"] for k, v in self.reports if k == z.Version_CommandClassReport}
+
+    def Matches(self, values):
+        """Cheap sanity check: the node must announce the same command classes"""
+        return self.Classes() == set(values.Classes())
+
+    def Records(self):
+        return [(k, command.MakeRecord(k, v)) for k, v in self.reports]
+
+
+class ProfileRecorder:
+    """Collects the profile reports of a node while it is interviewed"""
+
+    def __init__(self):
+        # (key, tag) -> plain values
+        self._reports = {}
+
+    def Add(self, key, values):
+        tag = PROFILE_REPORTS.get(key)
+        if tag is None:
+            return
+        if isinstance(values, command.Record):
+            values = values.AsDict()
+        self._reports[(key, tag(values))] = values
+
+    def Profile(self, key):
+        return DeviceProfile(key, [(k, v) for (k, _), v in self._reports.items()])
+
+
+class ProfileCache:
+    """Maps profile keys to DeviceProfiles. With a path the profiles are
+    loaded from and saved to a json file."""
+
+    def __init__(self, path=None):
+        self._path = path
+        self._profiles = {}
+        if path and os.path.exists(path):
+            self.LoadFile(path)
+
+    def __len__(self):
+        return len(self._profiles)
+
+    def Lookup(self, values):
+        key = ProfileKey(values)
+        if key is None:
+            return None
+        return self._profiles.get(key)
+
+    def Add(self, profile: DeviceProfile):
+        self._profiles[profile.key] = profile
+        if self._path:
+            self.SaveFile(self._path)
+
+    def LoadFile(self, path):
+        with open(path) as fp:
+            entries = json.load(fp, object_hook=_JsonObject)
+        for e in entries:
+            p = DeviceProfile(e["key"], [(tuple(k), v) for k, v in e["reports"]])
+            self._profiles[p.key] = p
+        logging.warning("loaded %d device profiles from %s", len(entries), path)
+
+    def SaveFile(self, path):
+        entries = [{"key": list(p.key), "reports": [[list(k), v] for k, v in p.reports]}
+                   for p in self._profiles.values()]
+        tmp = path + ".tmp"
+        with open(tmp, "w") as fp:
+            json.dump(entries, fp, default=_JsonDefault)
+        os.replace(tmp, path)
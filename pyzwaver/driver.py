@@ -19,15 +19,19 @@
 driver.py contains the code interacting directly with serial device
 """
 
+import concurrent.futures
+import heapq
 import logging
+import random
 import serial
 import threading
 import time
 import collections
 import queue
 
-from typing import List, Tuple
+from typing import Iterable, List, Tuple
 
+from pyzwaver import airtime
 from pyzwaver import zwave as z
 from pyzwaver import zmessage
 
@@ -75,11 +79,11 @@ def MessageStatsString(history):
             sum_duration += duration
     out = [
         "processed: %d  with-can: %d (total can: %d) avg-time: %dms" %
-        (count, with_can, total_can, sum_duration // count),
+        (count, with_can, total_can, sum_duration // max(count, 1)),
         "by state:"
     ]
     for n in sorted(by_state.keys()):
-        out.append(" %-20s: %4d" % (n, by_state[n]))
+        out.append(" %-20s: %4d" % (zmessage.MESSAGE_STATE_TO_STRING[n], by_state[n]))
 
     out.append("by node:")
     for n in sorted(by_node_cnt.keys()):
@@ -103,14 +107,19 @@ def _ProcessReceivedMessage(ts, inflight: zmessage.Message, m):
     """
     # logging.debug("rx buffer: %s", buf)
     if m[0] == z.NAK:
-        return DO_NOTHING, ""
+        if inflight is None:
+            logging.error("nothing to re-send after NAK")
+            return DO_NOTHING, "stray"
+        logging.error("re-sending message after NAK ==== %s",
+                      zmessage.PrettifyRawMessage(inflight.payload))
+        return DO_RETRY, "nak"
     elif m[0] == z.CAN:
         if inflight is None:
             logging.error("nothing to re-send after CAN")
             return DO_NOTHING, "stray"
         logging.error("re-sending message after CAN ==== %s",
                       zmessage.PrettifyRawMessage(inflight.payload))
-        return DO_RETRY, ""
+        return DO_RETRY, "can"
 
     elif m[0] == z.ACK:
         if inflight is None:
@@ -144,6 +153,300 @@ def _ProcessReceivedMessage(ts, inflight: zmessage.Message, m):
         return DO_NOTHING, "bad-unknown-start-byte"
 
 
+# Frame level timing of the Serial API:
+# A data frame which has not been ACKed by the stick within ACK_TIMEOUT_SECS
+# is re-transmitted. The same happens after a NAK or a CAN.
+# Re-transmissions are delayed by a bounded exponential back off with jitter
+# and are limited per message and globally (per RETRY_BUDGET_WINDOW_SECS).
+ACK_TIMEOUT_SECS = 1.6
+RETRY_BACKOFF_BASE_SECS = 0.1
+RETRY_BACKOFF_MAX_SECS = 1.0
+RETRY_JITTER = 0.25
+MAX_RETRIES_PER_MESSAGE = 3
+MAX_RETRIES_PER_WINDOW = 30
+RETRY_BUDGET_WINDOW_SECS = 10.0
+
+_EVENT_ACK_TIMEOUT = 0
+_EVENT_RESEND = 1
+
+
+class Retransmitter:
+    """
+    Retransmitter owns all re-sends of the inflight message.
+
+    The receiving thread merely reports what it sees (ACK, NAK, CAN)
+    and never blocks. Resends and ACK timeouts are handled by a dedicated
+    thread which processes a heap of timed events.
+
+    Counters for all the interesting events are kept in `stats`.
+    """
+
+    def __init__(self, send_raw, ack_timeout=ACK_TIMEOUT_SECS,
+                 backoff_base=RETRY_BACKOFF_BASE_SECS,
+                 backoff_max=RETRY_BACKOFF_MAX_SECS,
+                 jitter=RETRY_JITTER,
+                 max_retries=MAX_RETRIES_PER_MESSAGE,
+                 max_retries_per_window=MAX_RETRIES_PER_WINDOW,
+                 window=RETRY_BUDGET_WINDOW_SECS):
+        self._send_raw = send_raw
+        self._ack_timeout = ack_timeout
+        self._backoff_base = backoff_base
+        self._backoff_max = backoff_max
+        self._jitter = jitter
+        self._max_retries = max_retries
+        self._max_retries_per_window = max_retries_per_window
+        self._window = window
+        self._recent_retries = collections.deque()
+        # message currently waiting for the ACK from the stick and the
+        # sequence number of its ACK timeout event, older ones are stale
+        self._awaiting_ack = None
+        self._awaiting_seq = 0
+        self._events = []
+        self._seq = 0
+        self.last_ack = 0.0
+        self._cond = threading.Condition()
+        self._terminate = False
+        self.stats = collections.Counter()
+        self._thread = threading.Thread(target=self._RetransmitterThread,
+                                        name="DriverRetransmit")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __str__(self):
+        return "retransmissions: " + " ".join(
+            "%s:%d" % (k, v) for k, v in sorted(self.stats.items()))
+
+    def _Schedule(self, deadline, kind, m):
+        # caller must hold self._cond
+        self._seq += 1
+        heapq.heappush(self._events, (deadline, self._seq, kind, m))
+        self._cond.notify()
+
+    def Backoff(self, attempt):
+        delay = min(self._backoff_max, self._backoff_base * (2 ** attempt))
+        return delay * (1.0 + random.uniform(-self._jitter, self._jitter))
+
+    def Sent(self, ts, m: zmessage.Message):
+        """Must be called whenever the payload of m was written to the device"""
+        m.SetTimeoutFrom(ts, self._ack_timeout)
+        with self._cond:
+            self._awaiting_ack = m
+            self._Schedule(ts + self._ack_timeout, _EVENT_ACK_TIMEOUT, m)
+            self._awaiting_seq = self._seq
+
+    def Acked(self, ts, m: zmessage.Message):
+        self.last_ack = ts
+        with self._cond:
+            if self._awaiting_ack is not m:
+                return
+            self._awaiting_ack = None
+        m.SetTimeoutFrom(ts)
+
+    def _WithinGlobalBudget(self, ts):
+        while self._recent_retries and self._recent_retries[0] < ts - self._window:
+            self._recent_retries.popleft()
+        if len(self._recent_retries) >= self._max_retries_per_window:
+            return False
+        self._recent_retries.append(ts)
+        return True
+
+    def Retry(self, ts, m: zmessage.Message, reason):
+        """Schedules a resend of m. Returns False if m was aborted instead."""
+        self.stats[reason] += 1
+        with self._cond:
+            if self._awaiting_ack is m:
+                self._awaiting_ack = None
+            if m.can >= self._max_retries:
+                self.stats["exhausted-message-budget"] += 1
+                budget_ok = False
+            elif not self._WithinGlobalBudget(ts):
+                self.stats["exhausted-global-budget"] += 1
+                budget_ok = False
+            else:
+                budget_ok = True
+                m.IncRetry()
+                delay = self.Backoff(m.can - 1)
+                # do not let the message time out while we wait
+                m.SetTimeoutFrom(ts, delay + self._ack_timeout)
+                self._Schedule(ts + delay, _EVENT_RESEND, m)
+        if not budget_ok:
+            logging.error("giving up on message after %d retries: %s",
+                          m.can, zmessage.PrettifyRawMessage(m.payload))
+            if m.state == zmessage.MESSAGE_STATE_STARTED:
+                m.Complete(ts, None, zmessage.MESSAGE_STATE_ABORTED)
+        return budget_ok
+
+    def Terminate(self):
+        with self._cond:
+            self._terminate = True
+            self._cond.notify()
+
+    def _RetransmitterThread(self):
+        logging.warning("_RetransmitterThread started")
+        while True:
+            with self._cond:
+                while not self._terminate:
+                    if self._events:
+                        timeout = self._events[0][0] - time.time()
+                        if timeout <= 0:
+                            break
+                    else:
+                        timeout = None
+                    self._cond.wait(timeout)
+                if self._terminate:
+                    break
+                _, seq, kind, m = heapq.heappop(self._events)
+                if m.state != zmessage.MESSAGE_STATE_STARTED:
+                    continue
+                if kind == _EVENT_ACK_TIMEOUT and (self._awaiting_ack is not m or
+                                                   seq != self._awaiting_seq):
+                    # ACKed or belongs to an earlier transmission
+                    continue
+            # do not hold the lock while talking to the device
+            ts = time.time()
+            if kind == _EVENT_ACK_TIMEOUT:
+                logging.error("no ACK received for %s",
+                              zmessage.PrettifyRawMessage(m.payload))
+                self.Retry(ts, m, "ack-timeout")
+            else:
+                self.stats["resent"] += 1
+                self._send_raw(m.payload, "re-try")
+                self.Sent(ts, m)
+        logging.warning("_RetransmitterThread terminated")
+
+
+# How often the sending thread re-checks the airtime budgets while messages
+# are held back
+THROTTLE_PAUSE_SECS = 0.01
+
+# Number of consecutive messages failing without a single ACK from the
+# stick before we consider the stick hung.
+HANG_THRESHOLD = 3
+
+
+class _Barrier:
+    __slots__ = ("waiting", "future")
+
+    def __init__(self, waiting):
+        self.waiting = waiting
+        self.future = concurrent.futures.Future()
+
+
+class PendingMessages:
+    """
+    PendingMessages keeps track of all messages handed to the driver which
+    are not done yet (queued or inflight) so that callers can wait for a
+    subset of them, e.g. all messages for a single node.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._by_node = collections.defaultdict(set)
+        self._barriers = collections.defaultdict(list)
+
+    def Add(self, m: zmessage.Message):
+        with self._lock:
+            self._by_node[m.node].add(m)
+
+    def Done(self, m: zmessage.Message):
+        ready = []
+        with self._lock:
+            self._by_node[m.node].discard(m)
+            barriers = self._barriers.get(m.node)
+            if not barriers:
+                return
+            for b in barriers:
+                b.waiting.discard(m)
+                if not b.waiting:
+                    ready.append(b)
+            if ready:
+                self._barriers[m.node] = [b for b in barriers if b.waiting]
+        for b in ready:
+            b.future.set_result(None)
+
+    def Barrier(self, nodes: Iterable[int] = None, lane=None) -> concurrent.futures.Future:
+        """Returns a future which completes once all currently pending messages
+        for the given nodes (all nodes if None) and lane (all lanes if None)
+        are done.
+        """
+        b = None
+        with self._lock:
+            if nodes is None:
+                nodes = list(self._by_node.keys())
+            waiting = set()
+            for n in nodes:
+                for m in self._by_node.get(n, ()):
+                    if lane is None or m.priority[0] == lane:
+                        waiting.add(m)
+            if waiting:
+                b = _Barrier(waiting)
+                for n in set(m.node for m in waiting):
+                    self._barriers[n].append(b)
+        if b is None:
+            f = concurrent.futures.Future()
+            f.set_result(None)
+            return f
+        return b.future
+
+
+class AirtimeGate:
+    """
+    Holds back the messages of nodes which exceeded their airtime budget.
+
+    Once a node has a held message all its further messages are held, too,
+    so the messages of a node still go out in queue order, e.g. a Set before
+    the Get checking it or the segments of a TransportService datagram.
+    """
+
+    def __init__(self, budget: airtime.AirtimeBudget):
+        self._budget = budget
+        self._lock = threading.Lock()
+        # node -> held messages in queue order
+        self._held = collections.OrderedDict()
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(held) for held in self._held.values())
+
+    def Hold(self, now, m: zmessage.Message):
+        """Returns True if m was held back"""
+        with self._lock:
+            held = self._held.get(m.node)
+            if held is None:
+                if self._budget.Delay(now, m.node, m.payload)[1] <= 0:
+                    return False
+                held = collections.deque()
+                self._held[m.node] = held
+            held.append(m)
+            return True
+
+    def Release(self, now):
+        """Returns the next held message of a node back within its budget"""
+        with self._lock:
+            for n, held in self._held.items():
+                if self._budget.Delay(now, n, held[0].payload)[1] > 0:
+                    continue
+                m = held.popleft()
+                if not held:
+                    del self._held[n]
+                return m
+        return None
+
+    def purge(self, predicate):
+        """Removes and returns all held messages matching predicate"""
+        out = []
+        with self._lock:
+            for n in list(self._held):
+                keep = collections.deque()
+                for m in self._held[n]:
+                    (out if predicate(m) else keep).append(m)
+                if keep:
+                    self._held[n] = keep
+                else:
+                    del self._held[n]
+        return out
+
+
 class MessageQueueOut:
     """
     MessageQueue for outbound messages. Tries to support
@@ -184,8 +487,29 @@ class MessageQueueOut:
         self._per_node_size[node] += 1
         self._q.put(((level, count, node), message))
 
-    def get(self):
-        priority, message = self._q.get()
+    def purge(self, predicate):
+        """Removes and returns all queued messages matching predicate"""
+        with self._q.mutex:
+            keep = []
+            purged = []
+            for entry in self._q.queue:
+                if predicate(entry[1]):
+                    purged.append(entry)
+                else:
+                    keep.append(entry)
+            if purged:
+                heapq.heapify(keep)
+                self._q.queue[:] = keep
+                for priority, _ in purged:
+                    self._per_node_size[priority[2]] -= 1
+        return [message for _, message in purged]
+
+    def get(self, timeout=None):
+        """Returns the next message, None if there is none within timeout"""
+        try:
+            priority, message = self._q.get(timeout=timeout)
+        except queue.Empty:
+            return None
         level = priority[0]
         if level == 2:
             self._hi_min = priority[1]
@@ -220,16 +544,32 @@ class Driver(object):
        recently sent message or
     """
 
-    def __init__(self, serialDevice):
+    def __init__(self, serialDevice, max_duty_cycle=airtime.MAX_DUTY_CYCLE,
+                 node_duty_cycle=airtime.NODE_MAX_DUTY_CYCLE):
         self._device = serialDevice
         self._out_queue = MessageQueueOut()  # stuff being send to the stick
         self._raw_history: List[Tuple[int, bool, zmessage.Message, str]] = []
-        # a message is copied into this once if makes it into _inflight.
-        self._history: List[zmessage.Message] = []
+        # a compact copy of every message which made it into _inflight
+        self._history: List[zmessage.ArchivedMessage] = []
         self._device_idle = True
         self._terminate = False  # True if we want to shut things down
+        self._terminating = False  # True once Terminate() was called
         self._in_queue = queue.Queue()  # stuff coming from the stick unrelated to _inflight
         self._listeners = []   # receive all the stuff from _in_queue
+        self._retransmitter = Retransmitter(self._SendRaw)
+        # hang detection: while hung only the recovery queue is served
+        self._hang_listeners = []
+        self._hung_since = None
+        self._consecutive_failures = 0
+        self._recovery_queue = queue.Queue()
+        # (start, duration, attempts, success) for each stick recovery
+        self.recoveries: List[tuple] = []
+        self._pending = PendingMessages()
+        self._last = None
+        self._inflight = None  # out bound message waiting for responses
+        self._delay = collections.defaultdict(int)
+        self._airtime = airtime.AirtimeBudget(max_duty_cycle, node_duty_cycle)
+        self._gate = AirtimeGate(self._airtime)
 
         # Make sure we flush old stuff
         self._ClearDevice()
@@ -247,19 +587,44 @@ class Driver(object):
                                                    name="DriverForward")
         self._forwarding_thread.start()
 
-        self._last = None
-        self._inflight = None  # out bound message waiting for responses
-        self._delay = collections.defaultdict(int)
-
     def __str__(self):
         out = [str(self._out_queue),
                "inflight: " + str(self._inflight),
+               str(self._retransmitter),
+               "hangs: %d recovery times: %s" % (
+                   len(self.recoveries), ["%.1fs" % r[1] for r in self.recoveries]),
+               self._airtime.UtilizationString(time.time()),
                MessageStatsString(self._history)]
         return "\n".join(out)
 
     def AddListener(self, l):
         self._listeners.append(l)
 
+    def AddHangListener(self, l):
+        """l(ts) is called (from the sending thread) when the stick appears to hang"""
+        self._hang_listeners.append(l)
+
+    def IsHung(self):
+        return self._hung_since is not None
+
+    def ResumeAfterRecovery(self, attempts=0, success=True):
+        """Resume processing of the regular queue. Returns the recovery time.
+
+        attempts and success describe the recovery, c.f. Controller._RecoverFromHang()
+        """
+        if self._hung_since is None:
+            return 0.0
+        duration = time.time() - self._hung_since
+        self.recoveries.append((self._hung_since, duration, attempts, success))
+        logging.warning("stick recovered after %.1fs", duration)
+        self._consecutive_failures = 0
+        self._hung_since = None
+        return duration
+
+    def AirtimeUtilization(self):
+        """Returns a map from node to the fraction of recent airtime it used"""
+        return self._airtime.Utilization(time.time())
+
     def HasInflight(self):
         return self._inflight is not None
 
@@ -267,25 +632,55 @@ class Driver(object):
         self._raw_history.append((ts, True, m, comment))
         logging.info("sent: %s", zmessage.PrettifyRawMessage(m))
 
-    def _LogReceived(self, ts, m, comment):
-        logging.info("recv: %s", zmessage.PrettifyRawMessage(m))
+    def _LogReceived(self, ts, m: zmessage.Frame, comment):
+        # the frame only prettifies itself if the message is actually logged
+        logging.info("recv: %s", m)
         self._raw_history.append((ts, False, m, comment))
 
-    def _RecordInflight(self, m):
-        self._history.append(m)
+    def _RecordInflight(self, m: zmessage.Message):
+        self._history.append(m.Archive())
 
-    def SendMessage(self, m: zmessage.Message):
-        self._out_queue.put(m.priority, m)
+    def SendMessage(self, m: zmessage.Message) -> zmessage.Message:
+        """Queues m for sending. m doubles as handle, e.g. for m.Cancel()"""
+        self._pending.Add(m)
+        if m.priority[0] == zmessage.RecoveryPriority()[0]:
+            self._recovery_queue.put(m)
+        else:
+            self._out_queue.put(m.priority, m)
+        return m
 
-    def WaitUntilAllPreviousMessagesHaveBeenHandled(self):
-        lock: threading.Lock = threading.Lock()
-        lock.acquire()
-        # send dummy message to clear out pipe
-        mesg = zmessage.Message(
-            None, zmessage.LowestPriority(), lambda _: lock.release(), None)
-        self.SendMessage(mesg)
-        # wait until semaphore is released by callback
-        lock.acquire()
+    def PurgeMessages(self, node=None, lane=None, tag=None):
+        """Cancels all queued messages matching all the given criteria.
+
+        lane is the first component of the message priority, c.f.
+        zmessage.NodePriorityLo() and friends.
+        Returns the number of cancelled messages.
+        """
+
+        def matches(m: zmessage.Message):
+            return ((node is None or m.node == node) and
+                    (lane is None or m.priority[0] == lane) and
+                    (tag is None or m.tag == tag))
+
+        ts = time.time()
+        count = 0
+        for m in self._out_queue.purge(matches) + self._gate.purge(matches):
+            if m.Cancel(ts):
+                count += 1
+            self._pending.Done(m)
+        logging.warning("purged %d messages (node: %s lane: %s tag: %s)",
+                        count, node, lane, tag)
+        return count
+
+    def Barrier(self, nodes: Iterable[int] = None, lane=None) -> concurrent.futures.Future:
+        """Returns a future which completes when all messages sent so far for
+        the given nodes and/or lane are done. Messages for other nodes do not
+        delay it. Use asyncio.wrap_future() to await it from asyncio code.
+        """
+        return self._pending.Barrier(nodes, lane)
+
+    def WaitUntilAllPreviousMessagesHaveBeenHandled(self, nodes: Iterable[int] = None):
+        self.Barrier(nodes).result()
 
     def Terminate(self):
         """
@@ -297,12 +692,22 @@ class Driver(object):
 
         def cb(_):
             self._terminate = True
+            self._retransmitter.Terminate()
             lock.release()
 
         # send listeners signal to shutdown
         self._in_queue.put((time.time(), None))
-        self.SendMessage(zmessage.Message(
-            None, zmessage.LowestPriority(), cb, None))
+        if self.IsHung():
+            # the regular queue is not served while hung, do not wait for it
+            self.PurgeMessages()
+            self.SendMessage(zmessage.Message(
+                None, zmessage.RecoveryPriority(), cb, None))
+        else:
+            self.SendMessage(zmessage.Message(
+                None, zmessage.LowestPriority(), cb, None))
+        # a hang detected from now on must not keep the sending thread away
+        # from the regular queue
+        self._terminating = True
         lock.acquire()
         logging.info("Driver terminated")
 
@@ -314,6 +719,7 @@ class Driver(object):
 
     def OutQueueString(self):
         out = ["queue length: %d" % self._out_queue.qsize(),
+               "held back for airtime: %d" % len(self._gate),
                "by node: %s" % str(self._out_queue)]
         return "\n".join(out)
 
@@ -337,6 +743,37 @@ class Driver(object):
             if self._delay[node] >= 0.01:
                 self._delay[node] -= 0.01
 
+    def _UpdateHangDetection(self, m: zmessage.Message):
+        if self._hung_since is not None:
+            return
+        if not m.WasAborted() or self._retransmitter.last_ack >= m.start:
+            self._consecutive_failures = 0
+            return
+        self._consecutive_failures += 1
+        if self._consecutive_failures < HANG_THRESHOLD:
+            return
+        logging.error("stick appears to hang: %d messages failed without ACK",
+                      self._consecutive_failures)
+        self._hung_since = time.time()
+        for l in self._hang_listeners:
+            l(self._hung_since)
+
+    def _NextMessage(self) -> zmessage.Message:
+        while self._hung_since is not None and not self._terminating:
+            try:
+                return self._recovery_queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        if not self._recovery_queue.empty():
+            return self._recovery_queue.get()
+        m = self._gate.Release(time.time())
+        if m is not None:
+            return m
+        m = self._out_queue.get(THROTTLE_PAUSE_SECS if len(self._gate) else None)
+        if m is None or (m.payload is not None and self._gate.Hold(time.time(), m)):
+            return None
+        return m
+
     def _DriverSendingThread(self):
         """
         Forwards message from _mq to device
@@ -344,30 +781,53 @@ class Driver(object):
         logging.warning("_DriverSendingThread started")
         lock = threading.Lock()
         while not self._terminate:
-            inflight = self._out_queue.get()  # type: zmessage.Message
-            if inflight.payload is None:
-                logging.warning("received empty message")
-                inflight.Start(time.time(), lock)
-                inflight.Complete(time.time(), None,
-                                  zmessage.MESSAGE_STATE_COMPLETED)
+            inflight = self._NextMessage()
+            if inflight is None:
                 continue
-            self._inflight = inflight
-            self._RecordInflight(inflight)
-
-            inflight.Start(time.time(), lock)
-            time.sleep(self._delay[inflight.node])
-
-            self._SendRaw(inflight.payload, "")
-            # Now wait for this message to complete by
-            # waiting for lock to get released again
-            lock.acquire()
-            # dynamically adjust delay per node
-            self._AdjustDelay(inflight.node, inflight.WasAborted())
-            self._inflight = None
-            lock.release()
+            self._WaitForAirtime(inflight)
+            self._SendAndWait(inflight, lock)
+            self._pending.Done(inflight)
 
         logging.warning("_DriverSendingThread terminated")
 
+    def _WaitForAirtime(self, m: zmessage.Message):
+        """Enforces the global airtime budget, the per node budgets are
+        handled by the AirtimeGate"""
+        if m.payload is None or m.priority[0] == zmessage.RecoveryPriority()[0]:
+            return
+        global_delay, _ = self._airtime.Delay(time.time(), m.node, m.payload)
+        if global_delay > 0:
+            logging.info("airtime budget exhausted, pausing %.3fs", global_delay)
+            time.sleep(global_delay)
+
+    def _SendAndWait(self, inflight: zmessage.Message, lock):
+        if inflight.payload is None:
+            logging.warning("received empty message")
+            if inflight.Start(time.time(), lock):
+                inflight.Complete(time.time(), None,
+                                  zmessage.MESSAGE_STATE_COMPLETED)
+            return
+        if not inflight.Start(time.time(), lock):
+            # cancelled while waiting in the queue
+            return
+        self._inflight = inflight
+
+        time.sleep(self._delay[inflight.node])
+
+        self._airtime.Reserve(time.time(), inflight.node, inflight.payload)
+        self._SendRaw(inflight.payload, "")
+        self._retransmitter.Sent(time.time(), inflight)
+        # Now wait for this message to complete by
+        # waiting for lock to get released again
+        lock.acquire()
+        # dynamically adjust delay per node
+        self._AdjustDelay(inflight.node, inflight.WasAborted())
+        self._inflight = None
+        lock.release()
+        self._RecordInflight(inflight)
+        self._airtime.Record(time.time(), inflight.node, inflight.payload, inflight.can)
+        self._UpdateHangDetection(inflight)
+
     def _ClearDevice(self):
         self._device.write(zmessage.RAW_MESSAGE_NAK)
         self._device.write(zmessage.RAW_MESSAGE_NAK)
@@ -392,18 +852,23 @@ class Driver(object):
                 if not m:
                     continue
             buf = buf[len(m):]
+            # from here on the message is shared so make it immutable
+            m = zmessage.Frame(m)
             ts = time.time()
-            next_action, comment = _ProcessReceivedMessage(
-                ts, self._inflight, m)
+            inflight = self._inflight
+            if inflight is not None and m[0] == z.ACK:
+                self._retransmitter.Acked(ts, inflight)
+            next_action, comment = _ProcessReceivedMessage(ts, inflight, m)
             self._LogReceived(ts, m, comment)
+            if (inflight is not None and m[0] == z.SOF and m[2] == z.RESPONSE and
+                    m[3] == z.API_ZW_GET_NODE_PROTOCOL_INFO):
+                # the speed determines the airtime of messages to the node
+                self._airtime.SetSpeed(inflight.node, airtime.SpeedFromProtocolInfo(m[4:-1]))
             if next_action == DO_ACK:
                 self._SendRaw(zmessage.RAW_MESSAGE_ACK)
             elif next_action == DO_RETRY:
-                # Does this help?
-                # TODO: analyze
-                time.sleep(0.01)
-                self._inflight.IncRetry()
-                self._SendRaw(self._inflight.payload, "re-try")
+                # never block here - the retransmitter will resend later
+                self._retransmitter.Retry(ts, inflight, comment)
             elif next_action == DO_PROPAGATE:
                 self._SendRaw(zmessage.RAW_MESSAGE_ACK)
                 self._in_queue.put((ts, m))
@@ -0,0 +1,95 @@
+#!/usr/bin/python3
+# Copyright 2016 Robert Muth <robert@muth.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 3
+# of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+"""
+history.py keeps a bounded history of (timestamp, numeric value) samples
+for a node value, e.g. a sensor reading, a meter or a switch level.
+
+Samples are kept in two array('d') so a buffer of the default capacity
+takes about 32kB. Once a buffer is full every other sample of its older
+half is dropped, so older samples get sparser instead of being dropped
+altogether: the recent past is kept at full resolution while the buffer
+still reaches back to its first sample.
+"""
+
+import array
+import bisect
+
+DEFAULT_CAPACITY = 2048
+
+
+class ValueHistory:
+    """Time ordered samples of a single value"""
+    __slots__ = ["capacity", "_ts", "_vals", "downsampled"]
+
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        assert capacity >= 4
+        self.capacity = capacity
+        self._ts = array.array("d")
+        self._vals = array.array("d")
+        # number of downsampling passes
+        self.downsampled = 0
+
+    def __len__(self):
+        return len(self._ts)
+
+    def _Downsample(self):
+        """Halves the resolution of the older half of the samples"""
+        half = len(self._ts) // 2
+        half -= half % 2
+        self._ts[:half] = self._ts[0:half:2]
+        self._vals[:half] = self._vals[0:half:2]
+        self.downsampled += 1
+
+    def Add(self, ts, value):
+        if len(self._ts) >= self.capacity:
+            self._Downsample()
+        if self._ts and ts < self._ts[-1]:
+            # out of order, e.g. replayed messages - keep the order intact
+            i = bisect.bisect_right(self._ts, ts)
+            self._ts.insert(i, ts)
+            self._vals.insert(i, value)
+            return
+        self._ts.append(ts)
+        self._vals.append(value)
+
+    def Range(self, start, end=None):
+        """Returns the (ts, value) samples with start <= ts <= end"""
+        lo = bisect.bisect_left(self._ts, start)
+        hi = len(self._ts) if end is None else bisect.bisect_right(self._ts, end)
+        return list(zip(self._ts[lo:hi], self._vals[lo:hi]))
+
+    def Last(self):
+        if not self._ts:
+            return None
+        return self._ts[-1], self._vals[-1]
+
+
+def NumericValue(v):
+    """Extracts the number from a value as stored by NodeValues, None if
+    there is none"""
+    if isinstance(v, (int, float)):
+        return v
+    try:
+        x = v.get("_value")
+        if x is None:
+            x = v.get("level")
+    except AttributeError:
+        return None
+    if isinstance(x, (int, float)):
+        return x
+    return None
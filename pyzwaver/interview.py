@@ -0,0 +1,328 @@
+#!/usr/bin/python3
+# Copyright 2016 Robert Muth <robert@muth.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 3
+# of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+"""
+interview.py plans the queries used to interview a node.
+
+The interview is split into steps. A step only applies if the node
+supports its command class in a version which understands the queries.
+Steps may depend on other steps:
+
+* after: the queries of the other step must have been sent first
+* needs: the other step must be complete as its reports shape the queries
+
+Static steps are tracked per query so that repeating the interview only
+re-sends what is still missing. Semi static and dynamic steps are sent in
+full on every refresh. On demand steps are tracked like static ones but
+are never part of the regular interview, they are only sent when asked for
+by name.
+"""
+
+import logging
+
+from pyzwaver import command_helper as ch
+from pyzwaver import zwave as z
+from pyzwaver.command import StringifyCommand
+
+INTERVIEW_STATIC = "static"
+INTERVIEW_SEMI_STATIC = "semi-static"
+INTERVIEW_DYNAMIC = "dynamic"
+INTERVIEW_ON_DEMAND = "on-demand"
+
+# kinds whose queries are only re-sent while unanswered
+_TRACKED_KINDS = (INTERVIEW_STATIC, INTERVIEW_ON_DEMAND)
+
+# an unanswered query is re-sent after this
+INTERVIEW_RETRY_SECS = 20.0
+# and given up after this many attempts so it does not block other steps
+INTERVIEW_MAX_TRIES = 3
+
+STEP_READY = "ready"
+STEP_SKIPPED = "skipped"
+STEP_BLOCKED = "blocked"
+STEP_PENDING = "pending"
+STEP_ISSUED = "issued"
+STEP_COMPLETE = "complete"
+
+_DONE = (STEP_SKIPPED, STEP_COMPLETE)
+_SENT = (STEP_SKIPPED, STEP_COMPLETE, STEP_ISSUED)
+
+# version of command classes we have not heard about yet, c.f. node._NO_VERSION
+_UNKNOWN_VERSION = -1
+
+# queries only understood by later versions of their command class
+MIN_VERSIONS = {
+    z.SensorMultilevel_SupportedGet: 5,
+    z.Meter_SupportedGet: 2,
+    z.SwitchMultilevel_SupportedGet: 3,
+    z.Alarm_SupportedGet: 2,
+    z.MultiChannel_EndPointGet: 2,
+    z.ManufacturerSpecific_DeviceSpecificGet: 2,
+}
+
+_REPORTS = {}
+
+
+def ReportFor(key):
+    """Returns the key of the report answering the Get"""
+    report = _REPORTS.get(key)
+    if report is None:
+        k = z.STRING_TO_SUBCMD[StringifyCommand(key)[:-3] + "Report"]
+        report = (k >> 8, k & 0xff)
+        _REPORTS[key] = report
+    return report
+
+
+# queries whose report is stored per subkey: the argument holding the subkey
+_ANSWER_SUBKEYS = {
+    z.Version_CommandClassGet: "class",
+    z.ManufacturerSpecific_DeviceSpecificGet: "type",
+    z.Association_Get: "group",
+    z.AssociationGroupInformation_NameGet: "group",
+    z.AssociationGroupInformation_InfoGet: "group",
+    z.AssociationGroupInformation_ListGet: "group",
+    z.MultiChannel_CapabilityGet: "endpoint",
+    z.SceneActuatorConf_Get: "scene",
+}
+
+
+def _Answered(values, key, args):
+    report = ReportFor(key)
+    if not args:
+        return values.HasValue(report) or len(values.GetMap(report)) > 0
+    field = _ANSWER_SUBKEYS.get(key)
+    if field is not None:
+        e = values.GetMap(report).get(args[field])
+        if key == z.Version_CommandClassGet:
+            return e is not None and e[1] != _UNKNOWN_VERSION
+        return e is not None
+    # the report only answers the query if it echoes all the arguments
+    v = values.Get(report)
+    return v is not None and all(v.get(k) == a for k, a in args.items())
+
+
+def _QueryKey(key, args):
+    return key, tuple(sorted(args.items()))
+
+
+class Step:
+    """A group of queries dealing with one feature of a command class.
+
+    queries is either a list of (key, args) or a function returning such a
+    list given the NodeValues.
+    """
+    __slots__ = ["name", "kind", "cls", "min_version", "after", "needs", "_queries"]
+
+    def __init__(self, name, kind, queries, cls=None, min_version=1, after=(), needs=()):
+        self.name = name
+        self.kind = kind
+        self._queries = queries
+        if cls is None:
+            cls = queries[0][0][0]
+        self.cls = cls
+        self.min_version = min_version
+        self.after = after
+        self.needs = needs
+
+    def Queries(self, values):
+        if callable(self._queries):
+            return self._queries(values)
+        return self._queries
+
+
+def _CommandVersionQueries(values):
+    return ch.CommandVersionQueries(sorted(values.Classes()))
+
+
+def _SensorValueQueries(values):
+    sensors = values.SensorSupported()
+    if not sensors:
+        return [(z.SensorMultilevel_Get, {})]
+    return [(z.SensorMultilevel_Get, {"sensor": s}) for s in sorted(sensors)]
+
+
+def _MeterValueQueries(values):
+    scales = values.MeterSupported()
+    if not scales:
+        return [(z.Meter_Get, {})]
+    return [(z.Meter_Get, {"scale": s << 3}) for s in sorted(scales)]
+
+
+def _ColorValueQueries(values):
+    return ch.ColorQueries(sorted(values.ColorSwitchSupported()))
+
+
+def _AssociationQueries(values):
+    return ch.AssociationQueries(values.AssociationGroupIds())
+
+
+def _MultiChannelCapabilityQueries(values):
+    return ch.MultiChannelEndpointQueries(values.MultiChannelEndPointIds())
+
+
+def _SceneConfigurationQueries(_values):
+    # scene 0 is the current scene, c.f. DYNAMIC_PROPERTY_QUERIES
+    return ch.SceneActuatorConfiguration(range(1, 256))
+
+
+def _MakeSteps():
+    steps = [Step("versions", INTERVIEW_STATIC, _CommandVersionQueries, cls=z.Version)]
+    by_key = {}
+    for key, args in ch.STATIC_PROPERTY_QUERIES:
+        if key not in by_key:
+            by_key[key] = []
+            steps.append(Step(StringifyCommand(key), INTERVIEW_STATIC, by_key[key],
+                              cls=key[0], min_version=MIN_VERSIONS.get(key, 1)))
+        by_key[key].append((key, args))
+    # This must be last as we use this as an indicator for the
+    # NODE_STATE_INTERVIEWED
+    steps.append(Step("product", INTERVIEW_STATIC, [(z.ManufacturerSpecific_Get, {})],
+                      after=tuple(s.name for s in steps)))
+
+    steps.append(Step("associations", INTERVIEW_SEMI_STATIC, _AssociationQueries,
+                      cls=z.Association))
+    steps.append(Step("multi-channel-capabilities", INTERVIEW_SEMI_STATIC,
+                      _MultiChannelCapabilityQueries, cls=z.MultiChannel))
+
+    for key, args in ch.DYNAMIC_PROPERTY_QUERIES:
+        steps.append(Step(StringifyCommand(key), INTERVIEW_DYNAMIC, [(key, args)]))
+    steps.append(Step("sensor-values", INTERVIEW_DYNAMIC, _SensorValueQueries,
+                      cls=z.SensorMultilevel,
+                      needs=(StringifyCommand(z.SensorMultilevel_SupportedGet),)))
+    steps.append(Step("meter-values", INTERVIEW_DYNAMIC, _MeterValueQueries, cls=z.Meter,
+                      needs=(StringifyCommand(z.Meter_SupportedGet),)))
+    steps.append(Step("color-values", INTERVIEW_DYNAMIC, _ColorValueQueries,
+                      cls=z.ColorSwitch,
+                      needs=(StringifyCommand(z.ColorSwitch_SupportedGet),)))
+
+    steps.append(Step("scene-configurations", INTERVIEW_ON_DEMAND, _SceneConfigurationQueries,
+                      cls=z.SceneActuatorConf))
+    return steps
+
+
+STEPS = _MakeSteps()
+
+# reports which unblock steps of an already interviewed node
+UNBLOCKING_REPORTS = {
+    z.SensorMultilevel_SupportedReport: ["sensor-values"],
+    z.Meter_SupportedReport: ["meter-values"],
+    z.ColorSwitch_SupportedReport: ["color-values"],
+}
+
+
+class InterviewPlanner:
+    """Decides which interview queries a node should be sent next.
+
+    There is one planner per node. It remembers when each query was sent so
+    retries only cover the queries which are still unanswered.
+    """
+
+    def __init__(self, steps=None, retry_secs=INTERVIEW_RETRY_SECS,
+                 max_tries=INTERVIEW_MAX_TRIES):
+        self._steps = STEPS if steps is None else steps
+        self._retry_secs = retry_secs
+        self._max_tries = max_tries
+        # (key, args) -> (ts, tries)
+        self._sent = {}
+
+    def _InFlight(self, q, now):
+        sent = self._sent.get(q)
+        return sent is not None and now - sent[0] < self._retry_secs
+
+    def _GivenUp(self, q, now):
+        sent = self._sent.get(q)
+        return (sent is not None and sent[1] >= self._max_tries and
+                now - sent[0] >= self._retry_secs)
+
+    def _Version(self, values, cls, now):
+        v = values.CommandVersion(cls)
+        if v == _UNKNOWN_VERSION and (
+                not values.HasCommandClass(z.Version) or
+                self._GivenUp(_QueryKey(z.Version_CommandClassGet, {"class": cls}), now)):
+            # nobody is going to tell us, assume the basics
+            return 1
+        return v
+
+    def _State(self, step, values, now):
+        if not values.HasCommandClass(step.cls):
+            return STEP_SKIPPED
+        v = self._Version(values, step.cls, now)
+        if v == _UNKNOWN_VERSION:
+            return STEP_BLOCKED if step.min_version > 1 else STEP_READY
+        if v < step.min_version:
+            return STEP_SKIPPED
+        return STEP_READY
+
+    def _Walk(self, values, now, kind, names):
+        status = {}
+        out = []
+        for step in self._steps:
+            state = self._State(step, values, now)
+            if state == STEP_READY and (
+                    any(status.get(d) not in _DONE for d in step.needs) or
+                    any(status.get(d) not in _SENT for d in step.after)):
+                state = STEP_BLOCKED
+            if state != STEP_READY:
+                status[step.name] = state
+                continue
+            queries = step.Queries(values)
+            refresh = step.kind not in _TRACKED_KINDS
+            missing = []
+            for key, args in queries:
+                q = _QueryKey(key, args)
+                if not _Answered(values, key, args) and not self._GivenUp(q, now):
+                    missing.append((q, key, args))
+            if step.kind == kind and (names is None or step.name in names):
+                if refresh:
+                    due = [(_QueryKey(key, args), key, args) for key, args in queries]
+                else:
+                    due = [m for m in missing if not self._InFlight(m[0], now)]
+                for q, key, args in due:
+                    _, tries = self._sent.get(q, (0, 0))
+                    self._sent[q] = now, tries + 1
+                    out.append((key, args))
+            if not missing:
+                status[step.name] = STEP_COMPLETE
+            elif all(self._InFlight(m[0], now) for m in missing):
+                status[step.name] = STEP_ISSUED
+            else:
+                status[step.name] = STEP_PENDING
+        return status, out
+
+    def Plan(self, values, kind, now, names=None):
+        """Returns the queries of the given kind which are due.
+
+        names optionally restricts the plan to the steps listed.
+        """
+        status, out = self._Walk(values, now, kind, names)
+        blocked = [n for n, s in status.items() if s == STEP_BLOCKED]
+        if blocked:
+            logging.info("interview steps blocked: %s", blocked)
+        return out
+
+    def Progress(self, values, now):
+        """Returns a map from step name to its status"""
+        status, _ = self._Walk(values, now, None, None)
+        return status
+
+    def IsComplete(self, values, now, kind=INTERVIEW_STATIC):
+        """True if all steps of the given kind are answered, skipped or given up"""
+        status, _ = self._Walk(values, now, None, None)
+        return all(status[s.name] in _DONE for s in self._steps if s.kind == kind)
+
+    def Reset(self):
+        self._sent.clear()
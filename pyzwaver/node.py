@@ -19,17 +19,27 @@
 
 """
 
+import array
+import collections.abc
 import logging
+import threading
+import time
+import types
 from typing import Set, Mapping
 
 from pyzwaver import zwave as z
+from pyzwaver import command
 from pyzwaver import command_helper as ch
+from pyzwaver import device_profile
+from pyzwaver import history
+from pyzwaver import interview
+from pyzwaver import subscription
 from pyzwaver.zmessage import NodePriorityHi, NodePriorityLo
 from pyzwaver.command_translator import CommandTranslator
 from pyzwaver.command import StringifyCommand, StringifyCommandClass, IsCustom, CUSTOM_COMMAND_PROTOCOL_INFO, \
-    CUSTOM_COMMAND_APPLICATION_UPDATE, CUSTOM_COMMAND_ACTIVE_SCENE
+    CUSTOM_COMMAND_APPLICATION_UPDATE, CUSTOM_COMMAND_ACTIVE_SCENE, CommandValues
 from pyzwaver.value import GetSensorMeta, GetMeterMeta, SENSOR_KIND_BATTERY, SENSOR_KIND_SWITCH_MULTILEVEL, \
-    SENSOR_KIND_SWITCH_BINARY
+    SENSOR_KIND_SWITCH_BINARY, VALUE_CHANGERS
 
 SECURE_MODE = False
 
@@ -77,6 +87,9 @@ _COMMANDS_WITH_MAP_VALUES = {
     z.Version_CommandClassReport: lambda v: [(v["class"], v["version"])],
     z.Meter_Report: _ExtractMeter,
     z.Configuration_Report: lambda v: [(v["parameter"], v["value"])],
+    # size 0 means the parameter does not exist
+    z.Configuration_PropertiesReport: lambda v: [(v["parameter"], v["properties"])]
+    if v["properties"]["size"] else [],
     z.SensorMultilevel_Report: _ExtractSensor,
     z.Association_Report: lambda v: [(v["group"], v)],
     z.AssociationGroupInformation_NameReport: lambda v: [(v["group"], v["name"])],
@@ -85,15 +98,17 @@ _COMMANDS_WITH_MAP_VALUES = {
     z.SceneActuatorConf_Report: lambda v: [(v["scene"], v)],
     z.UserCode_Report: lambda v: [(v["user"], v)],
     z.MultiChannel_CapabilityReport: lambda v: [(v["endpoint"], v)],
+    # device type and serial number
+    z.ManufacturerSpecific_DeviceSpecificReport: lambda v: [(v["type"], v)],
 }
 
 _COMMANDS_WITH_SPECIAL_ACTIONS = {
     #
-    z.ManufacturerSpecific_Report: lambda _ts, node, _values:
-    node.MaybeChangeState(NODE_STATE_INTERVIEWED),
+    z.ManufacturerSpecific_Report: lambda ts, node, _values:
+    node.HandleProductReport(ts),
     #
     z.SceneActuatorConf_Report: lambda ts, node, values:
-    node.values.Set(ts, CUSTOM_COMMAND_ACTIVE_SCENE, values),
+    node.Store(ts, CUSTOM_COMMAND_ACTIVE_SCENE, values),
     #
     z.Security2_KexReport: lambda _ts, node, _values:
     node.MaybeChangeState(NODE_STATE_KEX_REPORT),
@@ -103,6 +118,71 @@ _COMMANDS_WITH_SPECIAL_ACTIONS = {
     #
     z.Security2_NonceGet: lambda _ts, node, values:
     node.SendNonce(values["seq"]),
+    #
+    z.Supervision_Report: lambda ts, node, values:
+    node.HandleSupervisionReport(ts, values),
+    #
+    z.Configuration_PropertiesReport: lambda _ts, node, values:
+    node.HandleConfigurationProperties(values),
+    #
+    z.Configuration_BulkReport: lambda ts, node, values:
+    node.HandleConfigurationBulkReport(ts, values),
+    #
+    z.Version_CommandClassReport: lambda _ts, node, _values:
+    node.ContinueInterview(),
+    #
+    z.SensorMultilevel_SupportedReport: lambda _ts, node, _values:
+    node.HandleSupportedReport(z.SensorMultilevel_SupportedReport),
+    #
+    z.Meter_SupportedReport: lambda _ts, node, _values:
+    node.HandleSupportedReport(z.Meter_SupportedReport),
+    #
+    z.ColorSwitch_SupportedReport: lambda _ts, node, _values:
+    node.HandleSupportedReport(z.ColorSwitch_SupportedReport),
+}
+
+# Configuration_Properties/Bulk* were added in this version
+_CONFIGURATION_BULK_VERSION = 3
+
+SUPERVISION_STATUS_NO_SUPPORT = 0x00
+SUPERVISION_STATUS_WORKING = 0x01
+SUPERVISION_STATUS_FAIL = 0x02
+SUPERVISION_STATUS_SUCCESS = 0xff
+
+# ask for a final report if the node reports WORKING first
+_SUPERVISION_STATUS_UPDATES = 0x80
+
+# sessions without a final report fall back to the Gets after this, a
+# WORKING report extends this by the duration it announces
+SUPERVISION_TIMEOUT_SECS = 10.0
+
+
+def _DurationSecs(duration):
+    """Decodes a duration byte: seconds up to 0x7f, minutes above, 0xfe is unknown"""
+    if duration <= 0x7f:
+        return duration
+    if duration <= 0xfd:
+        return (duration - 0x7f) * 60
+    return 0
+
+
+def _IsLevel(args):
+    # 0xff means "on"/"restore the last level", the resulting level is unknown
+    return args["level"] <= 99
+
+
+def _IsBinaryLevel(args):
+    return args["level"] in (0, 0xff)
+
+
+# Sets which can be confirmed via Supervision:
+# Set -> (Report whose value is implied by a successful Set, fields copied over,
+#         predicate telling whether the Set args determine the report at all)
+_SUPERVISED_SETS = {
+    z.Basic_Set: (z.Basic_Report, ("level",), _IsLevel),
+    z.SwitchBinary_Set: (z.SwitchBinary_Report, ("level",), _IsBinaryLevel),
+    z.SwitchMultilevel_Set: (z.SwitchMultilevel_Report, ("level",), _IsLevel),
+    z.Configuration_Set: (z.Configuration_Report, ("parameter", "value"), lambda _args: True),
 }
 
 XMIT_OPTIONS_NO_ROUTE = (z.TRANSMIT_OPTION_ACK |
@@ -116,6 +196,65 @@ XMIT_OPTIONS_SECURE = (z.TRANSMIT_OPTION_ACK |
                        z.TRANSMIT_OPTION_AUTO_ROUTE)
 
 
+# derived views of NodeValues which are cached until one of their keys changes
+_VIEW_VALUES = "values"
+_VIEW_SENSORS = "sensors"
+_VIEW_METERS = "meters"
+_VIEW_MISC_SENSORS = "misc_sensors"
+_VIEW_ASSOCIATIONS = "associations"
+
+_VIEWS_BY_KEY = {
+    z.SensorMultilevel_Report: (_VIEW_SENSORS,),
+    z.Meter_Report: (_VIEW_METERS,),
+    z.SwitchMultilevel_Report: (_VIEW_MISC_SENSORS,),
+    z.SwitchBinary_Report: (_VIEW_MISC_SENSORS,),
+    z.Battery_Report: (_VIEW_MISC_SENSORS,),
+    z.Association_Report: (_VIEW_ASSOCIATIONS,),
+    z.AssociationGroupInformation_NameReport: (_VIEW_ASSOCIATIONS,),
+    z.AssociationGroupInformation_InfoReport: (_VIEW_ASSOCIATIONS,),
+    z.AssociationGroupInformation_ListReport: (_VIEW_ASSOCIATIONS,),
+}
+
+# numeric values NodeValues.TrackDefaultHistory() keeps the history of
+HISTORY_KEYS = [
+    z.SensorMultilevel_Report,
+    z.Meter_Report,
+    z.SwitchMultilevel_Report,
+    z.SwitchBinary_Report,
+    z.Battery_Report,
+]
+
+# command keys and subkeys are shared by all NodeValues rather than
+# having a copy of the same tuple per node
+_INTERNED = {}
+
+
+def _Intern(k):
+    return _INTERNED.setdefault(k, k)
+
+
+class _MapView(collections.abc.Mapping):
+    """Read-only map: subkey -> (ts, value) over the slots of NodeValues"""
+    __slots__ = ["_values", "_m"]
+
+    def __init__(self, values, m):
+        self._values = values
+        self._m = m
+
+    def __getitem__(self, subkey):
+        slot = self._m[subkey]
+        return self._values._ts[slot], self._values._data[slot]
+
+    def __iter__(self):
+        return iter(self._m)
+
+    def __len__(self):
+        return len(self._m)
+
+
+_EMPTY_MAP = types.MappingProxyType({})
+
+
 def BitsToSetWithOffset(x, offset):
     out = set()
     pos = 0
@@ -141,34 +280,127 @@ class NodeValues:
     """
 
     def __init__(self):
+        # key -> slot
         self._values = {}
+        # key -> {subkey -> slot}
         self._maps = {}
+        # per slot timestamp and value
+        self._ts = array.array("d")
+        self._data = []
+        # view name -> cached result of Values(), Sensors(), etc.
+        self._views = {}
+        # opt-in history: key -> capacity
+        self._history_capacity = {}
+        # (key, subkey) -> history.ValueHistory
+        self._history = {}
+
+    def _Slot(self, ts, v):
+        self._ts.append(ts)
+        self._data.append(v)
+        return len(self._data) - 1
+
+    def _Invalidate(self, key):
+        if self._views:
+            for name in _VIEWS_BY_KEY.get(key, ()):
+                self._views.pop(name, None)
+
+    def _View(self, name, compute):
+        """Returns the cached result of compute(), callers must not modify it"""
+        out = self._views.get(name)
+        if out is None:
+            out = compute()
+            self._views[name] = out
+        return out
 
     def HasValue(self, key: tuple):
         return key in self._values
 
     def Set(self, ts, key: tuple, v):
+        """Stores v and returns the value it replaced, None if there was none"""
         if v is None:
-            return
-        self._values[key] = ts, v
+            return None
+        old = None
+        slot = self._values.get(key)
+        if slot is None:
+            self._values[_Intern(key)] = self._Slot(ts, v)
+        else:
+            old = self._data[slot]
+            self._ts[slot] = ts
+            self._data[slot] = v
+        self._views.pop(_VIEW_VALUES, None)
+        self._Invalidate(key)
+        if key in self._history_capacity:
+            self._AddSample(ts, key, None, v)
+        return old
 
     def SetMapEntry(self, ts, key: tuple, subkey, v):
+        """Stores v and returns the value it replaced, None if there was none"""
         if v is None:
-            return
+            return None
+        old = None
         m = self._maps.get(key)
         if m is None:
             m = {}
-            self._maps[key] = m
-        m[subkey] = ts, v
+            self._maps[_Intern(key)] = m
+        slot = m.get(subkey)
+        if slot is None:
+            m[_Intern(subkey)] = self._Slot(ts, v)
+        else:
+            old = self._data[slot]
+            self._ts[slot] = ts
+            self._data[slot] = v
+        self._Invalidate(key)
+        if key in self._history_capacity:
+            self._AddSample(ts, key, subkey, v)
+        return old
+
+    def TrackHistory(self, key: tuple, capacity=history.DEFAULT_CAPACITY):
+        """Keeps the numeric history of key, for map keys of every subkey"""
+        self._history_capacity[key] = capacity
+
+    def TrackDefaultHistory(self, capacity=history.DEFAULT_CAPACITY):
+        for key in HISTORY_KEYS:
+            self.TrackHistory(key, capacity)
+
+    def _AddSample(self, ts, key, subkey, v):
+        x = history.NumericValue(v)
+        if x is None:
+            return
+        h = self._history.get((key, subkey))
+        if h is None:
+            h = history.ValueHistory(self._history_capacity[key])
+            self._history[(_Intern(key), _Intern(subkey))] = h
+        h.Add(ts, x)
+
+    def History(self, key: tuple, subkey=None):
+        """Returns the history.ValueHistory of the value, None if not tracked"""
+        return self._history.get((key, subkey))
+
+    def Histories(self):
+        return [(key, subkey, h) for (key, subkey), h in self._history.items()]
 
     def Get(self, key: tuple) -> map:
-        v = self._values.get(key)
-        if v is not None:
-            return v[1]
+        slot = self._values.get(key)
+        if slot is not None:
+            return self._data[slot]
         return None
 
-    def GetMap(self, key: tuple) -> map:
-        return self._maps.get(key, {})
+    def GetMap(self, key: tuple) -> Mapping:
+        """Returns a read-only map: subkey -> (ts, value)"""
+        m = self._maps.get(key)
+        if m is None:
+            return _EMPTY_MAP
+        return _MapView(self, m)
+
+    def Timestamp(self, key: tuple, subkey=None):
+        """Returns when the value (or map entry) was last received, None if never"""
+        if subkey is None:
+            slot = self._values.get(key)
+        else:
+            slot = self._maps.get(key, {}).get(subkey)
+        if slot is None:
+            return None
+        return self._ts[slot]
 
     def ColorSwitchSupported(self):
         v = self.Get(z.ColorSwitch_SupportedReport)
@@ -213,6 +445,19 @@ class NodeValues:
             return 0, 0, 0
         return v.get("manufacturer", 0), v.get("type", 0), v.get("product", 0)
 
+    def ProtocolFlags(self):
+        v = self.Get(CUSTOM_COMMAND_PROTOCOL_INFO)
+        if not v:
+            return set()
+        return v["flags"]
+
+    def Speed(self):
+        """Returns the bits/sec the node supports, 0 if unknown"""
+        for f in self.ProtocolFlags():
+            if f.endswith("_baud") and f[0].isdigit():
+                return int(f.split("_")[0])
+        return 0
+
     def DeviceType(self):
         v = self.Get(CUSTOM_COMMAND_PROTOCOL_INFO)
         if not v:
@@ -230,6 +475,12 @@ class NodeValues:
             n = v["count"]
         return list(range(1, n + 1)) + [255]
 
+    def CommandVersion(self, cls):
+        e = self.GetMap(z.Version_CommandClassReport).get(cls)
+        if not e:
+            return 0
+        return e[1]
+
     def HasCommandClass(self, cls):
         m = self.GetMap(z.Version_CommandClassReport)
         e = m.get(cls)
@@ -259,26 +510,34 @@ class NodeValues:
         return [(no, val["size"], val["value"])
                 for no, (_, val) in m.items()]
 
+    def ConfigurationProperties(self):
+        m = self.GetMap(z.Configuration_PropertiesReport)
+        return {no: val for no, (_, val) in m.items()}
+
     def SceneActuatorConfiguration(self):
         m = self.GetMap(z.SceneActuatorConf_Report)
         return [(no, val["level"], val["delay"])
                 for no, (_, val) in m.items()]
 
     def Values(self):
-        return [(key, StringifyCommand(key), val)
-                for key, (_, val) in self._values.items()]
+        return self._View(_VIEW_VALUES, lambda: [
+            (key, StringifyCommand(key), self._data[slot])
+            for key, slot in self._values.items()])
 
     def Sensors(self):
-        m = self.GetMap(z.SensorMultilevel_Report)
-        return [(key, *GetSensorMeta(*key), val["_value"])
-                for key, (_, val) in m.items()]
+        return self._View(_VIEW_SENSORS, lambda: [
+            (key, *GetSensorMeta(*key), val["_value"])
+            for key, (_, val) in self.GetMap(z.SensorMultilevel_Report).items()])
 
     def Meters(self):
-        m = self.GetMap(z.Meter_Report)
-        return [(key, *GetMeterMeta(*key), val["_value"])
-                for key, (_, val) in m.items()]
+        return self._View(_VIEW_METERS, lambda: [
+            (key, *GetMeterMeta(*key), val["_value"])
+            for key, (_, val) in self.GetMap(z.Meter_Report).items()])
 
     def MiscSensors(self):
+        return self._View(_VIEW_MISC_SENSORS, self._MiscSensors)
+
+    def _MiscSensors(self):
         out = []
         v = self.Get(z.SwitchMultilevel_Report)
         if v is not None:
@@ -295,6 +554,9 @@ class NodeValues:
         return out
 
     def Associations(self):
+        return self._View(_VIEW_ASSOCIATIONS, self._Associations)
+
+    def _Associations(self):
         groups = self.GetMap(z.Association_Report)
         names = self.GetMap(z.AssociationGroupInformation_NameReport)
         infos = self.GetMap(z.AssociationGroupInformation_InfoReport)
@@ -345,6 +607,15 @@ class NodeValues:
         return "\n".join(out)
 
 
+def _StoreValues(values: NodeValues, ts, key, v):
+    """Returns the stored entries as a list of (subkey, old, new)"""
+    items_extractor = _COMMANDS_WITH_MAP_VALUES.get(key)
+    if items_extractor:
+        return [(k, values.SetMapEntry(ts, key, k, x), x)
+                for k, x in items_extractor(v)]
+    return [(None, values.Set(ts, key, v), v)]
+
+
 class Node:
     """A Node represents a single node in a network.
 
@@ -352,7 +623,7 @@ class Node:
     Outgoing commands are send to the CommandTranslator.
     """
 
-    def __init__(self, n, translator: CommandTranslator, is_controller):
+    def __init__(self, n, translator: CommandTranslator, is_controller, profiles=None):
         assert n >= 1
         self.n = n
         self.is_controller = is_controller
@@ -362,11 +633,26 @@ class Node:
         self._controls = set()
         #
         self.values = NodeValues()
+        # values reported by multi channel endpoints: endpoint -> NodeValues
+        self.endpoints = {}
         self.is_controller = is_controller
         self.last_contact = 0
         self.secure_pair = SECURE_MODE
         self._tmp_key_ccm = None
         self._tmp_personalization_string = None
+        # (key, subkey, old, new) stored while put() runs, None otherwise
+        self._stored = None
+        # session id -> (deadline, set key, set args, fallback gets, priority, xmit)
+        self._supervision = {}
+        self._supervision_session = 0
+        # sessions expire from a timer thread as well
+        self._supervision_lock = threading.Lock()
+        self._interview = interview.InterviewPlanner()
+        # device_profile.ProfileCache shared by all nodes
+        self._profiles = profiles
+        # collects the reports for a new profile, None once interviewed
+        self._recorder = None if profiles is None else device_profile.ProfileRecorder()
+        self._identifying = False
 
     def IsSelf(self):
         return self.is_controller
@@ -405,27 +691,129 @@ class Node:
     def __str__(self):
         return self.BasicString() + "\n" + str(self.values)
 
-    def BatchCommandSubmitFiltered(self, commands, priority: tuple, xmit: int):
+    def BatchCommandSubmitFiltered(self, commands, priority: tuple, xmit: int, tag=None):
+        """Returns the handles of the queued messages"""
         for c in commands:
             if len(c) != 2:
                 logging.error("BAD COMMAND: %s", c)
                 assert False
 
+        commands = [c for c in commands if self.values.HasCommandClass(c[0][0])]
+        if self._supervision:
+            self._ExpireSupervisionSessions(time.time())
+        if self.values.HasCommandClass(z.Supervision):
+            commands = self._Supervise(commands, priority, xmit)
+        if len(commands) > 1 and self.values.HasCommandClass(z.MultiCmd):
+            # save round trips - the reports get unbundled by the translator
+            commands = ch.MultiCommandBundles(commands)
+
+        # large commands, e.g. user code tables, get segmented if possible
+        segment = self.values.HasCommandClass(z.TransportService)
+        handles = []
         for key, values in commands:
-            if not self.values.HasCommandClass(key[0]):
-                continue
-
             # if self._IsSecureCommand(cmd[0], cmd[1]):
             #    self._secure_messaging.Send(cmd)
             #    continue
 
-            self._translator.SendCommand(self.n, key, values, priority, xmit)
+            h = self._translator.SendCommand(self.n, key, values, priority, xmit, tag,
+                                             segment)
+            if h is not None:
+                handles.append(h)
+        return handles
+
+    def _Supervise(self, commands, priority: tuple, xmit: int):
+        """Wraps supported Sets into Supervision_Get. The Gets directly following
+        such a Set are held back and only sent if the Set is not confirmed."""
+        out = []
+        i = 0
+        while i < len(commands):
+            key, values = commands[i]
+            i += 1
+            if key not in _SUPERVISED_SETS:
+                out.append((key, values))
+                continue
+            fallback = []
+            while i < len(commands) and StringifyCommand(commands[i][0]).endswith("Get"):
+                fallback.append(commands[i])
+                i += 1
+            try:
+                raw = command.AssembleCommandCached(key, values)
+            except Exception as _e:
+                # leave it to SendCommand to report
+                out.append((key, values))
+                out += fallback
+                continue
+            with self._supervision_lock:
+                self._supervision_session = (self._supervision_session + 1) % 64
+                session = self._supervision_session
+                self._supervision[session] = (time.time() + SUPERVISION_TIMEOUT_SECS,
+                                              key, values, fallback, priority, xmit)
+            self._StartSupervisionTimer(SUPERVISION_TIMEOUT_SECS)
+            out.append((z.Supervision_Get,
+                        {"session": _SUPERVISION_STATUS_UPDATES | session, "command": raw}))
+        return out
+
+    def _SupervisionFallback(self, entry):
+        _, _, _, fallback, priority, xmit = entry
+        if fallback:
+            self.BatchCommandSubmitFiltered(fallback, priority, xmit)
+
+    def _StartSupervisionTimer(self, secs):
+        timer = threading.Timer(secs, self._SupervisionTimeout)
+        timer.daemon = True
+        timer.start()
+
+    def _SupervisionTimeout(self):
+        self._ExpireSupervisionSessions(time.time())
+
+    def _ExpireSupervisionSessions(self, now):
+        # the fallbacks are submitted only after all expired sessions are
+        # removed since submitting expires sessions, too
+        with self._supervision_lock:
+            expired = [(session, entry) for session, entry in self._supervision.items()
+                       if now >= entry[0]]
+            for session, _ in expired:
+                del self._supervision[session]
+        for _, entry in expired:
+            logging.warning("[%d] no supervision report for %s", self.n,
+                            StringifyCommand(entry[1]))
+            self._SupervisionFallback(entry)
+
+    def HandleSupervisionReport(self, ts, values):
+        session = values["session"] & 0x3f
+        status = values["status"]
+        if status == SUPERVISION_STATUS_WORKING:
+            # a final report will follow once the node is done, wait for it
+            secs = _DurationSecs(values["duration"]) + SUPERVISION_TIMEOUT_SECS
+            with self._supervision_lock:
+                entry = self._supervision.get(session)
+                if entry is None:
+                    return
+                self._supervision[session] = (time.time() + secs,) + entry[1:]
+            self._StartSupervisionTimer(secs)
+            return
+        with self._supervision_lock:
+            entry = self._supervision.pop(session, None)
+        if entry is None:
+            return
+        key, args = entry[1], entry[2]
+        if status != SUPERVISION_STATUS_SUCCESS:
+            logging.warning("[%d] supervised %s failed with status %d", self.n,
+                            StringifyCommand(key), status)
+            self._SupervisionFallback(entry)
+            return
+        report, fields, determined = _SUPERVISED_SETS[key]
+        if not determined(args):
+            # e.g. restore the last level: ask the node for the result
+            self._SupervisionFallback(entry)
+            return
+        self.Store(ts, report, command.MakeRecord(report, {f: args[f] for f in fields}))
 
-    def BatchCommandSubmitFilteredSlow(self, commands, xmit=XMIT_OPTIONS):
-        self.BatchCommandSubmitFiltered(commands, NodePriorityLo(self.n), xmit)
+    def BatchCommandSubmitFilteredSlow(self, commands, xmit=XMIT_OPTIONS, tag=None):
+        return self.BatchCommandSubmitFiltered(commands, NodePriorityLo(self.n), xmit, tag)
 
-    def BatchCommandSubmitFilteredFast(self, commands, xmit=XMIT_OPTIONS):
-        self.BatchCommandSubmitFiltered(commands, NodePriorityHi(self.n), xmit)
+    def BatchCommandSubmitFilteredFast(self, commands, xmit=XMIT_OPTIONS, tag=None):
+        return self.BatchCommandSubmitFiltered(commands, NodePriorityHi(self.n), xmit, tag)
 
     # def _IsSecureCommand(self, key0, key1):
     #    if key0 == z.Security:
@@ -450,41 +838,148 @@ class Node:
 
     def RefreshAllCommandVersions(self):
         self.BatchCommandSubmitFilteredSlow(
-            ch.CommandVersionQueries(range(255)))
+            ch.CommandVersionQueries(self.values.Classes()))
 
     def RefreshAllSceneActuatorConfigurations(self):
         # append 0 to set current scene at very end
         self.BatchCommandSubmitFilteredSlow(
             ch.SceneActuatorConfiguration(list(range(1, 256)) + [0]))
 
+    def InterviewSceneActuatorConfigurations(self):
+        """Only asks for the scene configurations we have not heard about"""
+        self._Interview(interview.INTERVIEW_ON_DEMAND, ["scene-configurations"])
+
+    def _SupportsConfigurationBulk(self):
+        return self.values.CommandVersion(z.Configuration) >= _CONFIGURATION_BULK_VERSION
+
     def RefreshAllParameters(self):
         logging.warning("[%d] RefreshAllParameter", self.n)
+        if not self._SupportsConfigurationBulk():
+            self.BatchCommandSubmitFilteredSlow(
+                ch.ParameterQueries(range(255)))
+        elif self.values.ConfigurationProperties():
+            self.RefreshParameterValues()
+        else:
+            # walk the chain of parameters starting with the first one,
+            # c.f. HandleConfigurationProperties()
+            self.BatchCommandSubmitFilteredSlow(ch.ConfigurationPropertiesQueries([0]))
+
+    def RefreshParameterValues(self):
+        """Reads the parameters discovered via Configuration_PropertiesReport"""
+        bulk = {}
+        single = []
+        for no, props in self.values.ConfigurationProperties().items():
+            if props.get("flags", 0) & ch.CONFIGURATION_PROPERTY_NO_BULK:
+                single.append(no)
+            else:
+                bulk[no] = props["size"]
         self.BatchCommandSubmitFilteredSlow(
-            ch.ParameterQueries(range(255)))
+            ch.ConfigurationBulkQueries(bulk) + ch.ParameterQueries(p for p in single if p < 256))
+
+    def HandleConfigurationProperties(self, values):
+        nxt = values["properties"]["next"]
+        if nxt > values["parameter"]:
+            self.BatchCommandSubmitFilteredSlow(ch.ConfigurationPropertiesQueries([nxt]))
+        else:
+            # end of the chain
+            self.RefreshParameterValues()
+
+    def HandleConfigurationBulkReport(self, ts, values):
+        for no, size, value in ch.SplitConfigurationBulkReport(values):
+            report = {"parameter": no, "value": {"size": size, "value": value}}
+            self.Store(ts, z.Configuration_Report,
+                       command.MakeRecord(z.Configuration_Report, report))
+
+    def SetParameters(self, params):
+        """params is a list of (parameter, size, value)"""
+        bulk = []
+        c = []
+        props = self.values.ConfigurationProperties()
+        for no, size, value in params:
+            p = props.get(no)
+            if (self._SupportsConfigurationBulk() and
+                    not (p and p.get("flags", 0) & ch.CONFIGURATION_PROPERTY_NO_BULK)):
+                bulk.append((no, size, value))
+            else:
+                c += ch.ConfigurationSet(no, size, value)
+        # the handshake makes the node confirm with a Configuration_BulkReport
+        return self.BatchCommandSubmitFilteredFast(ch.ConfigurationBulkSet(bulk) + c)
+
+    def _Interview(self, kind, names=None):
+        return self.BatchCommandSubmitFilteredSlow(
+            self._interview.Plan(self.values, kind, time.time(), names))
+
+    def InterviewProgress(self):
+        return self._interview.Progress(self.values, time.time())
+
+    def ContinueInterview(self):
+        # versions unblock the queries of later command class versions
+        if self.state == NODE_STATE_DISCOVERED:
+            self._Interview(interview.INTERVIEW_STATIC)
+
+    def HandleSupportedReport(self, key):
+        if self.state >= NODE_STATE_INTERVIEWED:
+            self._Interview(interview.INTERVIEW_DYNAMIC, interview.UNBLOCKING_REPORTS[key])
 
     def RefreshDynamicValues(self):
         logging.warning("[%d] RefreshDynamic", self.n)
-        c = (ch.DYNAMIC_PROPERTY_QUERIES +
-             ch.SensorMultiLevelQueries(self.values.SensorSupported()) +
-             ch.MeterQueries(self.values.MeterSupported()) +
-             ch.ColorQueries(self.values.ColorSwitchSupported()))
-        self.BatchCommandSubmitFilteredSlow(c)
+        self._Interview(interview.INTERVIEW_DYNAMIC)
 
     def RefreshStaticValues(self):
+        """Only sends the static queries which are still unanswered"""
         logging.warning("[%d] RefreshStatic", self.n)
-        c = (ch.STATIC_PROPERTY_QUERIES +
-             ch.CommandVersionQueries(self.values.Classes()) +
-             # This must be last as we use this as an indicator for the
-             # NODE_STATE_INTERVIEWED
-             [(z.ManufacturerSpecific_Get, {})])
+        if self._identifying:
+            self._Identify()
+            return
+        self._Interview(interview.INTERVIEW_STATIC)
+        self._MaybeFinishInterview()
 
-        self.BatchCommandSubmitFilteredSlow(c)
+    def _StartInterview(self):
+        if self._profiles is None:
+            self.RefreshStaticValues()
+        else:
+            # the product may already be known from another node
+            self._identifying = True
+            self._Identify()
+
+    def _Identify(self):
+        self.BatchCommandSubmitFilteredSlow([(z.Version_Get, {}), (z.ManufacturerSpecific_Get, {})])
+
+    def HandleProductReport(self, ts):
+        if not self._identifying:
+            if self._recorder is None or self.state != NODE_STATE_DISCOVERED:
+                self._recorder = None
+                self.MaybeChangeState(NODE_STATE_INTERVIEWED)
+            return
+        self._identifying = False
+        profile = self._profiles.Lookup(self.values)
+        if profile is None or not profile.Matches(self.values):
+            # the full interview it is, c.f. _MaybeFinishInterview()
+            self.RefreshStaticValues()
+            return
+        logging.warning("[%d] using device profile %s", self.n, profile.key)
+        for key, v in profile.Records():
+            self.Store(ts, key, v)
+        self._recorder = None
+        # only the queries specific to this node are left
+        self._Interview(interview.INTERVIEW_STATIC)
+        self.MaybeChangeState(NODE_STATE_INTERVIEWED)
+
+    def _MaybeFinishInterview(self):
+        """With profiles the interview is over once all static queries are done"""
+        if (self._recorder is None or self._identifying or
+                self.state != NODE_STATE_DISCOVERED or
+                not self._interview.IsComplete(self.values, time.time())):
+            return
+        key = device_profile.ProfileKey(self.values)
+        if key is not None:
+            self._profiles.Add(self._recorder.Profile(key))
+        self._recorder = None
+        self.MaybeChangeState(NODE_STATE_INTERVIEWED)
 
     def RefreshSemiStaticValues(self):
         logging.warning("[%d] RefreshSemiStatic", self.n)
-        c = (ch.AssociationQueries(self.values.AssociationGroupIds()) +
-             ch.MultiChannelEndpointQueries(self.values.MultiChannelEndPointIds()))
-        self.BatchCommandSubmitFilteredSlow(c)
+        self._Interview(interview.INTERVIEW_SEMI_STATIC)
 
     def SendNonce(self, seq):
         # TODO: using a fixed nonce is a total hack - fix this
@@ -507,7 +1002,7 @@ class Node:
                     logging.error("[%d] Sending KEX_GET", self.n)
                     self.BatchCommandSubmitFilteredFast([(z.Security2_KexGet, {})])
                 else:
-                    self.RefreshStaticValues()
+                    self._StartInterview()
         elif new_state == NODE_STATE_KEX_REPORT:
             v = self.values.Get(z.Security2_KexReport)
             # we currently only support S2 Unauthenticated Class
@@ -531,9 +1026,34 @@ class Node:
             self.RefreshDynamicValues()
             self.RefreshSemiStaticValues()
 
+    def Store(self, ts, key, values):
+        """Stores values in the NodeValues, i.e. also for keys other than the
+        one of the command being processed"""
+        stored = _StoreValues(self.values, ts, key, values)
+        if self._stored is not None:
+            self._stored += [(key, subkey, old, new) for subkey, old, new in stored]
+
     def put(self, ts, key, values):
+        """Processes a command sent by the node. Returns the values stored
+        as a list of (key, subkey, old, new), including the ones stored by
+        special actions, None if nothing was stored for the node itself."""
+        endpoint = 0
+        if isinstance(values, CommandValues):
+            endpoint = values.endpoint
+            # the node keeps all values so there is no point in deferring
+            values = values.Decode()
+        else:
+            values = command.MakeRecord(key, values)
         self.last_contact = ts
 
+        if endpoint:
+            ep = self.endpoints.get(endpoint)
+            if ep is None:
+                ep = NodeValues()
+                self.endpoints[endpoint] = ep
+            _StoreValues(ep, ts, key, values)
+            return
+
         if key == CUSTOM_COMMAND_APPLICATION_UPDATE:
             self._InitializeCommands(values["type"], values["commands"], values["controls"])
             self.MaybeChangeState(NODE_STATE_DISCOVERED)
@@ -548,16 +1068,20 @@ class Node:
         if key == z.MultiChannel_CapabilityReport:
             logging.warning("FOUND MULTICHANNEL ENDPOINT: %s", values)
 
-        items_extractor = _COMMANDS_WITH_MAP_VALUES.get(key)
-        if items_extractor:
-            for k, v in items_extractor(values):
-                self.values.SetMapEntry(ts, key, k, v)
-        else:
-            self.values.Set(ts, key, values)
-
-        special = _COMMANDS_WITH_SPECIAL_ACTIONS.get(key)
-        if special:
-            special(ts, self, values)
+        stored = self._stored = []
+        try:
+            self.Store(ts, key, values)
+            if self._recorder is not None:
+                self._recorder.Add(key, values)
+
+            special = _COMMANDS_WITH_SPECIAL_ACTIONS.get(key)
+            if special:
+                special(ts, self, values)
+            if self._recorder is not None:
+                self._MaybeFinishInterview()
+        finally:
+            self._stored = None
+        return stored
 
         # elif a == command.ACTION_STORE_SCENE:
         #    if value[0] == 0:
@@ -586,22 +1110,90 @@ class Nodeset(object):
     CommandTranslator.
     """
 
-    def __init__(self, translator: CommandTranslator, controller_n):
+    def __init__(self, translator: CommandTranslator, controller_n, profiles=None):
         self._controller_n = controller_n
         self._translator = translator
+        # optional device_profile.ProfileCache to speed up interviews
+        self._profiles = profiles
         self.nodes: Mapping[int: Node] = {}
+        self._change_listeners = []
+        self._change_subscriptions = subscription.SubscriptionIndex()
+        # key -> deadband, (n, key) -> deadband
+        self._deadbands = {}
+        # (n, key, subkey) -> last number passed to the change listeners
+        self._reported = {}
         translator.AddListener(self)
 
+    def AddChangeListener(self, l):
+        """l.changed(n, ts, key, subkey, old, new) is called whenever a value in
+        VALUE_CHANGERS actually changes. old is None for the first value."""
+        self._change_listeners.append(l)
+
+    def SubscribeChanges(self, callback, n=None, cls=None, key=None):
+        """Like AddChangeListener() but callback(n, ts, key, subkey, old, new)
+        is only called for changes matching the given node, command class
+        and/or key. Returns a handle for UnsubscribeChanges()."""
+        return self._change_subscriptions.Subscribe(callback, n, cls, key)
+
+    def UnsubscribeChanges(self, handle):
+        self._change_subscriptions.Unsubscribe(handle)
+
+    def SetDeadband(self, key, delta, n=None):
+        """Numeric changes of key of at most delta are not reported, e.g. the
+        noise of a power meter. Without n it applies to all nodes."""
+        self._deadbands[key if n is None else (n, key)] = delta
+
+    def _Deadband(self, n, key):
+        d = self._deadbands.get((n, key))
+        if d is None:
+            d = self._deadbands.get(key, 0)
+        return d
+
+    def _HasChanged(self, n, key, subkey, old, new):
+        x = history.NumericValue(new)
+        deadband = self._Deadband(n, key) if x is not None else 0
+        if deadband:
+            k = (n, key, subkey)
+            last = self._reported.get(k)
+            if last is not None and abs(x - last) <= deadband:
+                return False
+            self._reported[k] = x
+            return True
+        if old is None:
+            return True
+        y = history.NumericValue(old)
+        if x is not None and y is not None:
+            # ignore bookkeeping fields, e.g. the previous value of a meter
+            return x != y
+        return old != new
+
     def DropNode(self, n):
+        """Forgets about node n and withdraws all its queued messages"""
         del self.nodes[n]
+        for k in [k for k in self._reported if k[0] == n]:
+            del self._reported[k]
+        self._translator.PurgeCommands(node=n)
 
     def GetNode(self, n) -> Node:
         node = self.nodes.get(n)
         if node is None:
-            node = Node(n, self._translator, n == self._controller_n)
+            node = Node(n, self._translator, n == self._controller_n, self._profiles)
             self.nodes[n] = node
         return node
 
     def put(self, n, ts, key, values):
         node = self.GetNode(n)
-        node.put(ts, key, values)
+        stored = node.put(ts, key, values)
+        if not stored:
+            return
+        for key, subkey, old, new in stored:
+            if key not in VALUE_CHANGERS:
+                continue
+            callbacks = self._change_subscriptions.Match(n, key)
+            if not callbacks and not self._change_listeners:
+                continue
+            if self._HasChanged(n, key, subkey, old, new):
+                for l in self._change_listeners:
+                    l.changed(n, ts, key, subkey, old, new)
+                for callback in callbacks:
+                    callback(n, ts, key, subkey, old, new)
@@ -0,0 +1,218 @@
+#!/usr/bin/python3
+# Copyright 2016 Robert Muth <robert@muth.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 3
+# of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+"""
+quirks.py contains the registry of workarounds for devices which send
+malformed commands.
+
+A quirk patches the raw command before it is parsed. Quirks are keyed by
+the command key and optionally by the (manufacturer, type, product) triple
+reported via ManufacturerSpecific_Report, so commands without a quirk
+pay for a single dict lookup.
+
+Quirks can be written as python functions or, more commonly, described
+declaratively - which allows loading them from json files, e.g.
+
+    {"name": "version report without version",
+     "command": "Version_CommandClassReport",
+     "product": [134, 3, 6],
+     "when": {"length": 3},
+     "then": {"append": [1]}}
+
+"when" (all conditions must hold):
+    "length": n                          the command has n bytes
+    "equal": [[i, v], ...]               m[i] == v
+    "mask": [[i, mask, v], ...]          m[i] & mask == v
+    "size_exceeds": i                    the size in the low 3 bits of m[i]
+                                         exceeds the remaining bytes
+"then" (applied in this order):
+    "set": [[i, v], ...]                 m[i] = v
+    "and": [[i, mask], ...]              m[i] &= mask
+    "append": [v, ...]                   m += [v, ...]
+"""
+
+import json
+import logging
+
+from pyzwaver import zwave as z
+
+
+def _Hexify(t):
+    return ["%02x" % i for i in t]
+
+
+def _ParseInt(x):
+    if isinstance(x, str):
+        return int(x, 0)
+    return x
+
+
+class Quirk:
+    """A single workaround, fix mutates and returns the raw command (a list)"""
+    __slots__ = ("name", "key", "product", "_when", "_fix")
+
+    def __init__(self, name, key: tuple, fix, when=None, product: tuple = None):
+        self.name = name
+        self.key = key
+        self.product = product
+        self._when = when
+        self._fix = fix
+
+    def __str__(self):
+        return "%s %s %s" % (self.name, z.SUBCMD_TO_STRING.get(self.key[0] * 256 + self.key[1]),
+                             self.product)
+
+    def Apply(self, m):
+        if self._when is not None and not self._when(m):
+            return m
+        before = _Hexify(m)
+        m = self._fix(m)
+        logging.warning("quirk [%s] fixed up %s -> %s", self.name, before, _Hexify(m))
+        return m
+
+
+def _MakeCondition(when):
+    checks = []
+    if "length" in when:
+        length = _ParseInt(when["length"])
+        checks.append(lambda m: len(m) == length)
+    for i, v in when.get("equal", []):
+        i, v = _ParseInt(i), _ParseInt(v)
+        checks.append(lambda m, i=i, v=v: len(m) > i and m[i] == v)
+    for i, mask, v in when.get("mask", []):
+        i, mask, v = _ParseInt(i), _ParseInt(mask), _ParseInt(v)
+        checks.append(lambda m, i=i, mask=mask, v=v: len(m) > i and m[i] & mask == v)
+    if "size_exceeds" in when:
+        i = _ParseInt(when["size_exceeds"])
+        checks.append(lambda m: len(m) > i and (m[i] & 7) > len(m) - i - 1)
+
+    def condition(m):
+        for c in checks:
+            if not c(m):
+                return False
+        return True
+
+    return condition
+
+
+def _MakeFix(then):
+    sets = [(_ParseInt(i), _ParseInt(v)) for i, v in then.get("set", [])]
+    ands = [(_ParseInt(i), _ParseInt(mask)) for i, mask in then.get("and", [])]
+    append = [_ParseInt(v) for v in then.get("append", [])]
+
+    def fix(m):
+        for i, v in sets:
+            m[i] = v
+        for i, mask in ands:
+            m[i] &= mask
+        m += append
+        return m
+
+    return fix
+
+
+def QuirkFromRule(rule: dict) -> Quirk:
+    """Builds a Quirk from its declarative description"""
+    name = rule["command"]
+    if name not in z.STRING_TO_SUBCMD:
+        raise ValueError("unknown command in quirk %s: %s" % (rule.get("name"), name))
+    k = z.STRING_TO_SUBCMD[name]
+    product = rule.get("product")
+    if product is not None:
+        product = tuple(_ParseInt(x) for x in product)
+        if len(product) != 3:
+            raise ValueError("product must be (manufacturer, type, product): %s" % product)
+    return Quirk(rule.get("name", name), (k >> 8, k & 0xff), _MakeFix(rule.get("then", {})),
+                 _MakeCondition(rule.get("when", {})), product)
+
+
+class QuirkRegistry:
+    """Maps command keys and optional products to the applicable quirks"""
+
+    def __init__(self, rules=()):
+        # (key, product) -> list of Quirk, product is None for generic quirks
+        self._quirks = {}
+        # (key, product) -> tuple of all applicable quirks, recomputed lazily
+        self._lookup = {}
+        # keys having at least one quirk
+        self._keys = set()
+        self.AddRules(rules)
+
+    def __len__(self):
+        return sum(len(x) for x in self._quirks.values())
+
+    def __str__(self):
+        return "\n".join(str(q) for lst in self._quirks.values() for q in lst)
+
+    def Add(self, quirk: Quirk):
+        self._quirks.setdefault((quirk.key, quirk.product), []).append(quirk)
+        self._keys.add(quirk.key)
+        self._lookup = {}
+
+    def AddRules(self, rules):
+        for r in rules:
+            self.Add(QuirkFromRule(r))
+
+    def LoadFile(self, path):
+        """Adds the quirks from a json file containing a list of rules"""
+        with open(path) as fp:
+            rules = json.load(fp)
+        self.AddRules(rules)
+        logging.warning("loaded %d quirks from %s", len(rules), path)
+
+    def Lookup(self, key: tuple, product: tuple = None):
+        """Returns a tuple of the quirks applicable to key or None"""
+        if key not in self._keys:
+            return None
+        k = (key, product)
+        quirks = self._lookup.get(k)
+        if quirks is None:
+            quirks = tuple(self._quirks.get((key, None), []))
+            if product is not None:
+                quirks += tuple(self._quirks.get(k, []))
+            self._lookup[k] = quirks
+        return quirks or None
+
+    def Patch(self, m, product: tuple = None):
+        """Applies all applicable quirks to the raw command m (a list)"""
+        if len(m) < 2:
+            return m
+        quirks = self.Lookup((m[0], m[1]), product)
+        if quirks:
+            for q in quirks:
+                m = q.Apply(m)
+        return m
+
+
+# These used to be hard coded in command.MaybePatchCommand()
+BUILTIN_RULES = [
+    # [49, 5, 1, 127, 1, 10] => [49, 5, 1, X, 1, 10]
+    {"name": "sensor report with bad size",
+     "command": "SensorMultilevel_Report",
+     "when": {"equal": [[2, 1]], "size_exceeds": 3},
+     "then": {"set": [[3, 1 << 5 | 0 << 3 | 2]]}},
+    {"name": "sensor report with bad unit",
+     "command": "SensorMultilevel_Report",
+     "when": {"equal": [[2, 1]], "mask": [[3, 0x10, 0x10]]},
+     "then": {"and": [[3, 0xe7]]}},
+    {"name": "version report without version",
+     "command": "Version_CommandClassReport",
+     "when": {"length": 3},
+     "then": {"append": [1]}},
+]
+
+DEFAULT_QUIRKS = QuirkRegistry(BUILTIN_RULES)
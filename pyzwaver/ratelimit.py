@@ -0,0 +1,62 @@
+#!/usr/bin/python3
+# Copyright 2016 Robert Muth <robert@muth.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 3
+# of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+"""
+ratelimit.py contains the token bucket shared by the airtime budget
+(airtime.py) and the refresh scheduler (refresh_scheduler.py).
+"""
+
+
+class TokenBucket:
+    """Allows rate tokens per second with bursts of up to burst tokens"""
+
+    __slots__ = ("rate", "burst", "_tokens", "_ts")
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._ts = None
+
+    def _Refill(self, now):
+        if self._ts is not None and now > self._ts:
+            self._tokens = min(self.burst, self._tokens + (now - self._ts) * self.rate)
+        if self._ts is None or now > self._ts:
+            self._ts = now
+
+    def Available(self, now, n=1.0):
+        self._Refill(now)
+        return self._tokens >= n
+
+    def Take(self, now, n=1.0):
+        """Consumes n tokens if available"""
+        if not self.Available(now, n):
+            return False
+        self._tokens -= n
+        return True
+
+    def Charge(self, now, n):
+        """Consumes n tokens, possibly going into debt"""
+        self._Refill(now)
+        self._tokens -= n
+
+    def Delay(self, now, n=1.0):
+        """Returns the seconds until n tokens will be available"""
+        self._Refill(now)
+        if self._tokens >= n:
+            return 0.0
+        return (n - self._tokens) / self.rate
@@ -0,0 +1,211 @@
+#!/usr/bin/python3
+# Copyright 2016 Robert Muth <robert@muth.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 3
+# of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+"""
+refresh_scheduler.py keeps dynamic values fresh by polling them one by one
+instead of refreshing whole nodes in bursts.
+
+Every watched value, i.e. (node, report key, subkey), has a refresh interval.
+It is only polled once its NodeValues timestamp is older than that, so
+values the node reports on its own are never polled. Polls are spread with
+jitter and limited by a global and a per node polls/sec budget. The per
+node budget is scaled by the speed of the node from the protocol info.
+"""
+
+import heapq
+import itertools
+import logging
+import random
+
+from pyzwaver import command_helper as ch
+from pyzwaver import interview
+from pyzwaver import zwave as z
+from pyzwaver.ratelimit import TokenBucket
+
+# nodes which can be polled at any time: FLiRS nodes listen every 250ms or
+# 1000ms and are woken up by a beam, only sleeping nodes have to be skipped
+_REACHABLE_FLAGS = frozenset(["listening", "sensor_250ms", "sensor_1000ms"])
+
+DEFAULT_INTERVAL_SECS = 300.0
+# values are polled somewhere in [interval * (1 - jitter), interval]
+DEFAULT_JITTER = 0.2
+DEFAULT_GLOBAL_RATE = 2.0
+# for nodes running at _REFERENCE_SPEED
+DEFAULT_NODE_RATE = 0.5
+
+_REFERENCE_SPEED = 40000
+# assumed if the protocol info is missing
+_SLOWEST_SPEED = 9600
+
+
+def _SensorQuery(values, subkey):
+    if values.CommandVersion(z.SensorMultilevel) >= 5:
+        return z.SensorMultilevel_Get, {"sensor": subkey[0]}
+    return z.SensorMultilevel_Get, {}
+
+
+def _MeterQuery(values, subkey):
+    if values.CommandVersion(z.Meter) >= 2:
+        return z.Meter_Get, {"scale": subkey[1] << 3}
+    return z.Meter_Get, {}
+
+
+# reports kept as maps whose entries are polled individually
+_MAP_QUERIES = {
+    z.SensorMultilevel_Report: _SensorQuery,
+    z.Meter_Report: _MeterQuery,
+}
+
+# reports kept as single values -> query
+_SINGLE_QUERIES = {interview.ReportFor(key): (key, args)
+                   for key, args in ch.DYNAMIC_PROPERTY_QUERIES}
+
+
+class _Watch:
+    __slots__ = ["k", "interval", "phase"]
+
+    def __init__(self, k, interval, phase):
+        # (n, key, subkey)
+        self.k = k
+        self.interval = interval
+        self.phase = phase
+
+
+class RefreshScheduler:
+    """Polls watched values when they get stale.
+
+    Tick() needs to be called periodically, e.g. once a second.
+    """
+
+    def __init__(self, nodeset, global_rate=DEFAULT_GLOBAL_RATE,
+                 node_rate=DEFAULT_NODE_RATE, jitter=DEFAULT_JITTER, rng=None):
+        self._nodeset = nodeset
+        self._global = TokenBucket(global_rate, max(1.0, global_rate))
+        self._node_rate = node_rate
+        # n -> TokenBucket
+        self._node_buckets = {}
+        self._jitter = jitter
+        self._random = rng or random.Random()
+        # (n, key, subkey) -> _Watch
+        self._watches = {}
+        # (due, seq, _Watch), stale entries are skipped lazily
+        self._heap = []
+        self._seq = itertools.count()
+        self.stats = {"polled": 0, "fresh": 0, "deferred": 0, "asleep": 0}
+
+    def __len__(self):
+        return len(self._watches)
+
+    def _Push(self, due, w):
+        heapq.heappush(self._heap, (due, next(self._seq), w))
+
+    def _Timestamp(self, node, w):
+        _, key, subkey = w.k
+        return node.values.Timestamp(key, subkey)
+
+    def Watch(self, n, key, now, interval=DEFAULT_INTERVAL_SECS, subkey=None):
+        """Keeps the report key (and map subkey) of node n fresh"""
+        k = (n, key, subkey)
+        w = self._watches.get(k)
+        if w is not None and w.interval == interval:
+            return
+        w = _Watch(k, interval, 1.0 - self._jitter * self._random.random())
+        self._watches[k] = w
+        node = self._nodeset.nodes.get(n)
+        ts = None if node is None else self._Timestamp(node, w)
+        if ts is None:
+            # spread the first polls rather than sending them all at once
+            self._Push(now + self._random.random() * interval * self._jitter, w)
+        else:
+            self._Push(ts + interval * w.phase, w)
+
+    def Unwatch(self, n, key, subkey=None):
+        self._watches.pop((n, key, subkey), None)
+
+    def UnwatchNode(self, n):
+        for k in [k for k in self._watches if k[0] == n]:
+            del self._watches[k]
+        self._node_buckets.pop(n, None)
+
+    def WatchDynamicValues(self, node, now, interval=DEFAULT_INTERVAL_SECS):
+        """Watches all dynamic values the node has reported so far"""
+        for key in _SINGLE_QUERIES:
+            if node.values.HasValue(key):
+                self.Watch(node.n, key, now, interval)
+        for key in _MAP_QUERIES:
+            for subkey in node.values.GetMap(key):
+                self.Watch(node.n, key, now, interval, subkey)
+
+    def NodeRate(self, node):
+        speed = node.values.Speed() or _SLOWEST_SPEED
+        return self._node_rate * speed / _REFERENCE_SPEED
+
+    def _NodeBucket(self, node):
+        rate = self.NodeRate(node)
+        bucket = self._node_buckets.get(node.n)
+        if bucket is None or bucket.rate != rate:
+            bucket = TokenBucket(rate, 1.0)
+            self._node_buckets[node.n] = bucket
+        return bucket
+
+    def _Query(self, node, w):
+        _, key, subkey = w.k
+        if subkey is None:
+            return _SINGLE_QUERIES[key]
+        return _MAP_QUERIES[key](node.values, subkey)
+
+    def Tick(self, now):
+        """Sends the polls which are due and within budget, returns them"""
+        out = []
+        while self._heap and self._heap[0][0] <= now:
+            _, _, w = heapq.heappop(self._heap)
+            if self._watches.get(w.k) is not w:
+                continue
+            node = self._nodeset.nodes.get(w.k[0])
+            if node is None:
+                del self._watches[w.k]
+                continue
+            ts = self._Timestamp(node, w)
+            if ts is not None and now < ts + w.interval * w.phase:
+                # refreshed in the meantime, e.g. by an unsolicited report
+                self.stats["fresh"] += 1
+                self._Push(ts + w.interval * w.phase, w)
+                continue
+            flags = node.values.ProtocolFlags()
+            if flags and flags.isdisjoint(_REACHABLE_FLAGS):
+                # battery powered, the node has to wake up first
+                self.stats["asleep"] += 1
+                self._Push(now + w.interval * w.phase, w)
+                continue
+            bucket = self._NodeBucket(node)
+            if not bucket.Available(now):
+                self.stats["deferred"] += 1
+                self._Push(now + bucket.Delay(now), w)
+                continue
+            if not self._global.Take(now):
+                self.stats["deferred"] += 1
+                self._Push(now + self._global.Delay(now), w)
+                break
+            bucket.Take(now)
+            query = self._Query(node, w)
+            logging.info("[%d] polling stale %s", node.n, w.k)
+            node.BatchCommandSubmitFilteredSlow([query])
+            self.stats["polled"] += 1
+            out.append((node.n, query))
+            # poll again if there is no answer
+            self._Push(now + w.interval * w.phase, w)
+        return out
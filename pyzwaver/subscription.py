@@ -0,0 +1,90 @@
+#!/usr/bin/python3
+# Copyright 2016 Robert Muth <robert@muth.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 3
+# of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+"""
+subscription.py indexes callbacks by node, command class and command key so
+that an event only reaches the callbacks interested in it.
+
+A subscription leaves out any of node, class or key to match all of them,
+e.g. (node=5) gets everything from node 5 and (cls=z.Meter) all meter
+commands of all nodes. A key implies its class.
+
+Dispatching an event looks up the six possible patterns, so its cost only
+depends on the number of matching callbacks, not on the number of
+subscriptions.
+"""
+
+import itertools
+import threading
+
+
+class SubscriptionIndex:
+    """Maps (node, class, key) patterns to callbacks.
+
+    Subscribe() and Unsubscribe() replace the per pattern maps rather than
+    modifying them so Match() can run concurrently without a lock.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        # (n, cls, key) -> {handle -> callback}, None matches everything
+        self._index = {}
+        # handle -> pattern
+        self._patterns = {}
+
+    def __len__(self):
+        return len(self._patterns)
+
+    def Subscribe(self, callback, n=None, cls=None, key=None):
+        """Returns a handle for Unsubscribe()"""
+        if key is not None:
+            assert cls is None or cls == key[0]
+            cls = None
+        pattern = (n, cls, key)
+        with self._lock:
+            handle = next(self._ids)
+            entries = dict(self._index.get(pattern, {}))
+            entries[handle] = callback
+            self._index[pattern] = entries
+            self._patterns[handle] = pattern
+        return handle
+
+    def Unsubscribe(self, handle):
+        with self._lock:
+            pattern = self._patterns.pop(handle, None)
+            if pattern is None:
+                return
+            entries = dict(self._index[pattern])
+            del entries[handle]
+            if entries:
+                self._index[pattern] = entries
+            else:
+                del self._index[pattern]
+
+    def Match(self, n, key):
+        """Returns the callbacks subscribed to events of node n with key"""
+        index = self._index
+        if not index:
+            return []
+        out = []
+        for node in (n, None):
+            for pattern in ((node, None, key), (node, key[0], None), (node, None, None)):
+                entries = index.get(pattern)
+                if entries:
+                    out.extend(entries.values())
+        return out
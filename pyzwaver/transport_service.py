@@ -0,0 +1,303 @@
+#!/usr/bin/python3
+# Copyright 2016 Robert Muth <robert@muth.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 3
+# of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+"""
+transport_service.py implements the segmentation and reassembly of
+datagrams which do not fit into a single frame (TransportService v2).
+
+The upper 5 bits of the second byte select the command, the lower 3 bits
+carry the high bits of the datagram size, so these commands do not fit
+the parse tables and are handled here on the raw bytes:
+
+    FirstSegment:      55 c0|size_hi size_lo session<<4 payload crc16
+    SubsequentSegment: 55 e0|size_hi size_lo session<<4|offset_hi offset_lo payload crc16
+    SegmentRequest:    55 c8 session<<4|offset_hi offset_lo
+    SegmentComplete:   55 e8 session<<4
+    SegmentWait:       55 f0 pending_segments
+"""
+
+import logging
+import threading
+import time
+
+from pyzwaver import zmessage
+from pyzwaver import zwave as z
+
+TRANSPORT_FIRST_SEGMENT = 0xc0
+TRANSPORT_SUBSEQUENT_SEGMENT = 0xe0
+TRANSPORT_SEGMENT_REQUEST = 0xc8
+TRANSPORT_SEGMENT_COMPLETE = 0xe8
+TRANSPORT_SEGMENT_WAIT = 0xf0
+
+# payload per segment so that the largest segment (subsequent segments
+# have 7 bytes of overhead) still fits into a single frame
+MAX_SEGMENT_PAYLOAD = 39
+MAX_DATAGRAM_SIZE = 0x7ff
+
+# incomplete datagrams are dropped after this
+SESSION_TIMEOUT_SECS = 10.0
+# the receiver asks for the first missing segment, e.g. a lost last segment,
+# if no segment arrived for this long
+SEGMENT_RECEIVE_TIMEOUT_SECS = 0.8
+# upper bound on the memory held by incomplete datagrams, oldest go first
+MAX_PENDING_BYTES = 16 * 1024
+
+
+def IsTransportService(data):
+    return len(data) >= 2 and data[0] == z.TransportService
+
+
+def _WithCrc(out):
+    crc = zmessage.Crc16(out)
+    return out + [crc >> 8, crc & 0xff]
+
+
+def Segment(payload, session, max_payload=MAX_SEGMENT_PAYLOAD):
+    """Returns the list of raw segment commands for the datagram payload"""
+    size = len(payload)
+    assert size <= MAX_DATAGRAM_SIZE
+    hi = size >> 8
+    out = []
+    for offset in range(0, size, max_payload):
+        chunk = list(payload[offset:offset + max_payload])
+        if offset == 0:
+            head = [z.TransportService, TRANSPORT_FIRST_SEGMENT | hi, size & 0xff,
+                    session << 4]
+        else:
+            head = [z.TransportService, TRANSPORT_SUBSEQUENT_SEGMENT | hi, size & 0xff,
+                    session << 4 | offset >> 8, offset & 0xff]
+        out.append(_WithCrc(head + chunk))
+    return out
+
+
+def SegmentRequest(session, offset):
+    return [z.TransportService, TRANSPORT_SEGMENT_REQUEST,
+            session << 4 | offset >> 8, offset & 0xff]
+
+
+def SegmentComplete(session):
+    return [z.TransportService, TRANSPORT_SEGMENT_COMPLETE, session << 4]
+
+
+class _Incoming:
+    __slots__ = ["size", "data", "received", "tail", "ts", "timer", "requests"]
+
+    def __init__(self, ts, size):
+        self.size = size
+        self.data = bytearray(size)
+        # offset -> length of the segments seen so far
+        self.received = {}
+        # the segment ending the datagram was seen
+        self.tail = False
+        self.ts = ts
+        # receive timer, restarted with every segment
+        self.timer = None
+        # segment requests sent because of the receive timer
+        self.requests = 0
+
+    def StopTimer(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def Add(self, ts, offset, payload):
+        self.data[offset:offset + len(payload)] = payload
+        self.received[offset] = len(payload)
+        if offset + len(payload) == self.size:
+            self.tail = True
+        self.ts = ts
+
+    def FirstMissing(self):
+        """Returns the offset of the first gap or None if complete"""
+        pos = 0
+        for offset in sorted(self.received):
+            if offset > pos:
+                return pos
+            pos = max(pos, offset + self.received[offset])
+        return None if pos >= self.size else pos
+
+
+class TransportService:
+    """Segments outgoing and reassembles incoming TransportService datagrams.
+
+    send(n, raw_command) is used for segment requests/completions and for
+    retransmitting individual segments. Only the segments the receiver asks
+    for are retransmitted.
+    """
+
+    def __init__(self, send, timeout=SESSION_TIMEOUT_SECS,
+                 max_pending_bytes=MAX_PENDING_BYTES,
+                 receive_timeout=SEGMENT_RECEIVE_TIMEOUT_SECS):
+        self._send = send
+        self._timeout = timeout
+        self._receive_timeout = receive_timeout
+        # receive timers fire from their own threads
+        self._lock = threading.RLock()
+        self._max_pending_bytes = max_pending_bytes
+        # (n, session) -> _Incoming
+        self._incoming = {}
+        # (n, session) -> (ts, {offset: segment})
+        self._outgoing = {}
+        self._session = 0
+        self.stats = {"reassembled": 0, "expired": 0, "evicted": 0, "bad-crc": 0,
+                      "requested": 0, "resent": 0}
+
+    def PendingBytes(self):
+        return sum(s.size for s in self._incoming.values())
+
+    def Segment(self, n, payload, ts=None):
+        """Returns the segments for payload and remembers them for retransmission"""
+        if ts is None:
+            ts = time.time()
+        with self._lock:
+            self._Expire(ts)
+            self._session = (self._session + 1) % 16
+            segments = Segment(payload, self._session)
+            by_offset = {}
+            for s in segments:
+                by_offset[0 if s[1] & 0xf8 == TRANSPORT_FIRST_SEGMENT else
+                          (s[3] & 7) << 8 | s[4]] = s
+            self._outgoing[(n, self._session)] = (ts, by_offset)
+        return segments
+
+    def _Drop(self, key):
+        s = self._incoming.pop(key, None)
+        if s is not None:
+            s.StopTimer()
+
+    def _StartTimer(self, key, s):
+        s.StopTimer()
+        s.timer = threading.Timer(self._receive_timeout, self._ReceiveTimeout, [key, s])
+        s.timer.daemon = True
+        s.timer.start()
+
+    def _ReceiveTimeout(self, key, s):
+        with self._lock:
+            if self._incoming.get(key) is not s:
+                return
+            s.timer = None
+            missing = s.FirstMissing()
+            if missing is None:
+                return
+            logging.warning("[%d] no segment received, asking for %d:%d", key[0], key[1], missing)
+            self.stats["requested"] += 1
+            self._send(key[0], SegmentRequest(key[1], missing))
+            s.requests += 1
+            # keep asking until the datagram would expire anyway
+            if s.requests * self._receive_timeout < self._timeout:
+                self._StartTimer(key, s)
+
+    def Expire(self, ts):
+        with self._lock:
+            self._Expire(ts)
+
+    def _Expire(self, ts):
+        cutoff = ts - self._timeout
+        for k, s in list(self._incoming.items()):
+            if s.ts < cutoff:
+                logging.warning("[%d] dropping incomplete datagram, session %d", k[0], k[1])
+                self._Drop(k)
+                self.stats["expired"] += 1
+        for k, (sent, _) in list(self._outgoing.items()):
+            if sent < cutoff:
+                del self._outgoing[k]
+
+    def _MakeRoom(self, size):
+        pending = self.PendingBytes()
+        for k, s in sorted(self._incoming.items(), key=lambda x: x[1].ts):
+            if pending + size <= self._max_pending_bytes:
+                break
+            logging.warning("[%d] evicting incomplete datagram, session %d", k[0], k[1])
+            pending -= s.size
+            self._Drop(k)
+            self.stats["evicted"] += 1
+        return pending + size <= self._max_pending_bytes
+
+    def Receive(self, ts, n, data):
+        """Consumes a TransportService command.
+
+        Returns the reassembled datagram once the last missing segment arrived,
+        None otherwise.
+        """
+        with self._lock:
+            return self._Receive(ts, n, data)
+
+    def _Receive(self, ts, n, data):
+        self._Expire(ts)
+        cmd = data[1] & 0xf8
+        if cmd == TRANSPORT_FIRST_SEGMENT or cmd == TRANSPORT_SUBSEQUENT_SEGMENT:
+            return self._ReceiveSegment(ts, n, data, cmd == TRANSPORT_FIRST_SEGMENT)
+        elif cmd == TRANSPORT_SEGMENT_REQUEST and len(data) >= 4:
+            session = data[2] >> 4
+            offset = (data[2] & 7) << 8 | data[3]
+            _, segments = self._outgoing.get((n, session), (None, {}))
+            s = segments.get(offset)
+            if s is None:
+                logging.error("[%d] request for unknown segment %d:%d", n, session, offset)
+                return None
+            self.stats["resent"] += 1
+            self._send(n, s)
+        elif cmd == TRANSPORT_SEGMENT_COMPLETE and len(data) >= 3:
+            self._outgoing.pop((n, data[2] >> 4), None)
+        elif cmd == TRANSPORT_SEGMENT_WAIT:
+            logging.warning("[%d] receiver busy: %s", n, zmessage.Hexify(data))
+        else:
+            logging.error("[%d] unknown transport command: %s", n, zmessage.Hexify(data))
+        return None
+
+    def _ReceiveSegment(self, ts, n, data, first):
+        header = 4 if first else 5
+        if len(data) < header + 3:
+            logging.error("[%d] short segment: %s", n, zmessage.Hexify(data))
+            return None
+        if zmessage.Crc16(data[:-2]) != data[-2] << 8 | data[-1]:
+            logging.error("[%d] dropping segment with bad crc16: %s", n, zmessage.Hexify(data))
+            self.stats["bad-crc"] += 1
+            return None
+        size = (data[1] & 7) << 8 | data[2]
+        session = data[3] >> 4
+        if data[3] & 0x08:
+            # skip header extension
+            header += 1 + data[header]
+        offset = 0 if first else (data[3] & 7) << 8 | data[4]
+        payload = data[header:-2]
+        if offset + len(payload) > size:
+            logging.error("[%d] segment exceeds datagram: %s", n, zmessage.Hexify(data))
+            return None
+        key = (n, session)
+        s = self._incoming.get(key)
+        if s is None or s.size != size or (first and 0 in s.received):
+            self._Drop(key)
+            if not self._MakeRoom(size):
+                logging.error("[%d] datagram of %d bytes exceeds memory limit", n, size)
+                return None
+            s = _Incoming(ts, size)
+            self._incoming[key] = s
+        s.Add(ts, offset, payload)
+        missing = s.FirstMissing()
+        if missing is None:
+            self._Drop(key)
+            self.stats["reassembled"] += 1
+            self._send(n, SegmentComplete(session))
+            return bytes(s.data)
+        if s.tail:
+            # the sender is done, ask for the first hole - one at a time so
+            # only segments which were really lost get retransmitted
+            self.stats["requested"] += 1
+            self._send(n, SegmentRequest(session, missing))
+        self._StartTimer(key, s)
+        return None
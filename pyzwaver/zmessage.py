@@ -32,6 +32,11 @@ from pyzwaver import zwave as z
 # ==================================================
 
 
+def RecoveryPriority():
+    """Only used for messages restoring a hung stick - bypasses the queue"""
+    return 0, 0, -1
+
+
 def ControllerPriority():
     return 1, 0, -1
 
@@ -69,6 +74,27 @@ def Checksum(data):
     return checksum
 
 
+def _MakeCrc16Table():
+    table = []
+    for i in range(256):
+        crc = i << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x1021) if crc & 0x8000 else crc << 1
+        table.append(crc & 0xffff)
+    return table
+
+
+_CRC16_TABLE = _MakeCrc16Table()
+
+
+def Crc16(data):
+    """CRC-CCITT with initial value 0x1d0f as used by CRC16Encap and TransportService"""
+    crc = 0x1d0f
+    for b in data:
+        crc = ((crc << 8) & 0xffff) ^ _CRC16_TABLE[(crc >> 8) ^ b]
+    return crc
+
+
 def Hexify(t):
     return ["%02x" % i for i in t]
 
@@ -201,27 +227,42 @@ def MakeRawMessageWithId(func, data, cb_id=None):
 
 
 def MakeRawCommandWithId(node, data, xmit, cb_id=None):
-    out = [node, len(data)] + data + [xmit]
+    out = [node, len(data), *data, xmit]
     return MakeRawMessageWithId(z.API_ZW_SEND_DATA, out, cb_id)
 
 
 def MakeRawReplicationCommandWithId(node, data, xmit, cb_id=None):
-    out = [node, len(data)] + data + [xmit]
+    out = [node, len(data), *data, xmit]
     return MakeRawMessageWithId(z.API_ZW_REPLICATION_SEND_DATA, out, cb_id)
 
 
 def MakeRawCommandMultiWithId(nodes, data, xmit, cb_id=None):
-    out = [len(nodes)] + nodes + [len(data)] + data + [xmit]
+    out = [len(nodes), *nodes, len(data), *data, xmit]
     return MakeRawMessageWithId(z.API_ZW_SEND_DATA_MULTI, out, cb_id)
 
 
+def MakeRawCommandTemplate(data):
+    """Precomputes everything of MakeRawCommandWithId() but node, xmit and cb_id"""
+    size = len(data) + 7
+    body = bytes([len(data), *data])
+    head = bytes([z.SOF, size, z.REQUEST, z.API_ZW_SEND_DATA])
+    return head, body, Checksum([size, z.REQUEST, z.API_ZW_SEND_DATA, *body])
+
+
+def MakeRawCommandWithIdFromTemplate(node, template, xmit, cb_id=None):
+    if cb_id is None:
+        cb_id = CallbackId()
+    head, body, partial = template
+    return head + bytes((node,)) + body + bytes((xmit, cb_id, partial ^ node ^ xmit ^ cb_id))
+
+
 def MakeRawCommand(node, data, xmit):
-    out = [node, len(data)] + data + [xmit]
+    out = [node, len(data), *data, xmit]
     return MakeRawMessage(z.API_ZW_SEND_DATA, out)
 
 
 def MakeRawReplicationSendDataWithId(node, data, xmit, cb_id=None):
-    out = [node, len(data)] + data + [xmit]
+    out = [node, len(data), *data, xmit]
     return MakeRawMessageWithId(z.API_ZW_REPLICATION_SEND_DATA, out, cb_id)
 
 
@@ -229,24 +270,108 @@ RAW_MESSAGE_ACK = bytes([z.ACK])
 RAW_MESSAGE_NAK = bytes([z.NAK])
 RAW_MESSAGE_CAN = bytes([z.CAN])
 
+
+class Frame:
+    """Frame is an immutable inbound raw message as received from the stick.
+
+    It behaves like the underlying bytes (indexing, slicing, len) so it can be
+    handed to code expecting raw messages. In addition it exposes the header
+    fields and, for API_APPLICATION_COMMAND_HANDLER, the embedded command
+    as a memoryview, i.e. without copying.
+    """
+    __slots__ = ("raw", "_view", "_pretty")
+
+    def __init__(self, raw):
+        self.raw = bytes(raw)
+        self._view = memoryview(self.raw)
+        self._pretty = None
+
+    def __getitem__(self, index):
+        return self.raw[index]
+
+    def __len__(self):
+        return len(self.raw)
+
+    def __iter__(self):
+        return iter(self.raw)
+
+    def __bytes__(self):
+        return self.raw
+
+    def __eq__(self, other):
+        if isinstance(other, Frame):
+            return self.raw == other.raw
+        return self.raw == other
+
+    def __hash__(self):
+        return hash(self.raw)
+
+    def __str__(self):
+        if self._pretty is None:
+            self._pretty = PrettifyRawMessage(self.raw)
+        return self._pretty
+
+    def IsRequest(self):
+        return len(self.raw) > 3 and self.raw[2] == z.REQUEST
+
+    def Func(self):
+        if len(self.raw) < 4 or self.raw[0] != z.SOF:
+            return -1
+        return self.raw[3]
+
+    def Node(self):
+        """Source node of an application command or update, else -1"""
+        func = self.Func()
+        if len(self.raw) > 5 and (func == z.API_APPLICATION_COMMAND_HANDLER or
+                                  func == z.API_ZW_APPLICATION_UPDATE):
+            return self.raw[5]
+        return -1
+
+    def Command(self):
+        """The application command as a memoryview or None"""
+        if self.Func() != z.API_APPLICATION_COMMAND_HANDLER or len(self.raw) < 7:
+            return None
+        return self._view[7:7 + self.raw[6]]
+
+    def CommandKey(self):
+        """(class, subcommand) of the application command or None"""
+        if self.Func() != z.API_APPLICATION_COMMAND_HANDLER or len(self.raw) < 9:
+            return None
+        return self.raw[7], self.raw[8]
+
 # ==================================================
 # Message
 # ==================================================
 
 
-MESSAGE_STATE_CREATED = "Created"
-MESSAGE_STATE_STARTED = "Started"
-MESSAGE_STATE_COMPLETED = "Completed"
-MESSAGE_STATE_ABORTED = "Aborted"
-MESSAGE_STATE_TIMEOUT = "Timeout"
-MESSAGE_STATE_NOT_READY = "NotReady"
+MESSAGE_STATE_CREATED = 0
+MESSAGE_STATE_STARTED = 1
+MESSAGE_STATE_COMPLETED = 2
+MESSAGE_STATE_ABORTED = 3
+MESSAGE_STATE_TIMEOUT = 4
+MESSAGE_STATE_NOT_READY = 5
+MESSAGE_STATE_CANCELLED = 6
+
+MESSAGE_STATE_TO_STRING = {
+    MESSAGE_STATE_CREATED: "Created",
+    MESSAGE_STATE_STARTED: "Started",
+    MESSAGE_STATE_COMPLETED: "Completed",
+    MESSAGE_STATE_ABORTED: "Aborted",
+    MESSAGE_STATE_TIMEOUT: "Timeout",
+    MESSAGE_STATE_NOT_READY: "NotReady",
+    MESSAGE_STATE_CANCELLED: "Cancelled",
+}
 
-MESSAGE_STATES_FINAL = {
+MESSAGE_STATES_FINAL = frozenset([
     MESSAGE_STATE_COMPLETED,
     MESSAGE_STATE_NOT_READY,
     MESSAGE_STATE_ABORTED,
-    MESSAGE_STATE_TIMEOUT
-}
+    MESSAGE_STATE_TIMEOUT,
+    MESSAGE_STATE_CANCELLED,
+])
+
+# serializes Start() and Cancel()
+_START_CANCEL_LOCK = threading.Lock()
 
 # TODO: explain these in detail
 ACTION_INVALID = 0
@@ -260,15 +385,18 @@ ACTION_MATCH_CBID = 8
 ACTION_NO_REPORT = 9
 ACTION_REPORT_EQ = 10
 
+# Action descriptors are immutable tuples shared by all messages
+ACTIONS_NONE = (ACTION_NONE,)
+
 # maps inflight message type to the action taken when a matching response is received
 _RESPONSE_ACTION = {
-    z.API_ZW_REMOVE_FAILED_NODE_ID: [ACTION_REPORT_NE, 0],  # removal started
-    z.API_ZW_SET_DEFAULT: [ACTION_NONE],
+    z.API_ZW_REMOVE_FAILED_NODE_ID: (ACTION_REPORT_NE, 0),  # removal started
+    z.API_ZW_SET_DEFAULT: (ACTION_NONE,),
 }
 
 _REQUEST_ACTION = {
-    z.API_ZW_REMOVE_FAILED_NODE_ID: [ACTION_MATCH_CBID, 7],
-    z.API_ZW_SET_DEFAULT: [ACTION_MATCH_CBID, 6],
+    z.API_ZW_REMOVE_FAILED_NODE_ID: (ACTION_MATCH_CBID, 7),
+    z.API_ZW_SET_DEFAULT: (ACTION_MATCH_CBID, 6),
 }
 
 _COMMANDS_WITH_NO_ACTION = [
@@ -277,8 +405,8 @@ _COMMANDS_WITH_NO_ACTION = [
 ]
 
 for x in _COMMANDS_WITH_NO_ACTION:
-    _RESPONSE_ACTION[x] = [ACTION_NONE]
-    _REQUEST_ACTION[x] = [ACTION_NONE]
+    _RESPONSE_ACTION[x] = ACTIONS_NONE
+    _REQUEST_ACTION[x] = ACTIONS_NONE
 
 _COMMANDS_WITH_RESPONSE_ACTION_REPORT = [
     z.API_ZW_GET_SUC_NODE_ID,
@@ -300,19 +428,19 @@ _COMMANDS_WITH_RESPONSE_ACTION_REPORT = [
 ]
 
 for x in _COMMANDS_WITH_RESPONSE_ACTION_REPORT:
-    _RESPONSE_ACTION[x] = [ACTION_REPORT]
-    _REQUEST_ACTION[x] = [ACTION_NONE]
+    _RESPONSE_ACTION[x] = (ACTION_REPORT,)
+    _REQUEST_ACTION[x] = ACTIONS_NONE
 
 _COMMANDS_WITH_SIMPLE_RESPONSE_AND_REQUEST = {
-    z.API_ZW_SEND_DATA: [7, 9],
-    z.API_ZW_SEND_DATA_MULTI: [7],
-    z.API_ZW_SEND_NODE_INFORMATION: [7],
-    z.API_ZW_REPLICATION_SEND_DATA: [7],
+    z.API_ZW_SEND_DATA: (7, 9),
+    z.API_ZW_SEND_DATA_MULTI: (7,),
+    z.API_ZW_SEND_NODE_INFORMATION: (7,),
+    z.API_ZW_REPLICATION_SEND_DATA: (7,),
 }
 
 for x, y in _COMMANDS_WITH_SIMPLE_RESPONSE_AND_REQUEST.items():
-    _RESPONSE_ACTION[x] = [ACTION_REPORT_EQ, 1]
-    _REQUEST_ACTION[x] = [ACTION_MATCH_CBID] + y
+    _RESPONSE_ACTION[x] = (ACTION_REPORT_EQ, 1)
+    _REQUEST_ACTION[x] = (ACTION_MATCH_CBID,) + y
 
 _COMMANDS_WITH_MULTI_REQUESTS = [
     z.API_ZW_ADD_NODE_TO_NETWORK,
@@ -322,8 +450,13 @@ _COMMANDS_WITH_MULTI_REQUESTS = [
 ]
 
 for x in _COMMANDS_WITH_MULTI_REQUESTS:
-    _RESPONSE_ACTION[x] = [ACTION_NONE]
-    _REQUEST_ACTION[x] = [ACTION_MATCH_CBID_MULTI]
+    _RESPONSE_ACTION[x] = ACTIONS_NONE
+    _REQUEST_ACTION[x] = (ACTION_MATCH_CBID_MULTI,)
+
+# func -> (request action, response action), looked up once per message
+_ACTION_DESCRIPTORS = {
+    x: (_REQUEST_ACTION[x], _RESPONSE_ACTION[x]) for x in _REQUEST_ACTION
+}
 
 
 # TODO
@@ -351,19 +484,50 @@ for x in _COMMANDS_WITH_MULTI_REQUESTS:
 # zwave.API_ZW_REQUEST_NETWORK_UPDATE: [ACTION_REPORT_NE, -1],
 
 
+class ArchivedMessage:
+    """Compact record of a processed Message kept in the driver history"""
+
+    __slots__ = ("payload", "node", "start", "end", "can", "state")
+
+    def __init__(self, payload, node, start, end, can, state):
+        self.payload = payload
+        self.node = node
+        self.start = start
+        self.end = end
+        self.can = can
+        self.state = state
+
+    def WasAborted(self):
+        return (self.state in MESSAGE_STATES_FINAL and
+                self.state != MESSAGE_STATE_COMPLETED)
+
+    def __str__(self):
+        return "%s %s" % (MESSAGE_STATE_TO_STRING[self.state], PrettifyRawMessage(self.payload))
+
+
 class Message:
     """Message describes and outgoing message and the actions/callbacks used to determine
     when it has been fully processed.
 
+    A Message also serves as the handle for the caller after it was
+    passed to Driver.SendMessage(): it can be withdrawn via Cancel()
+    as long as it has not been started.
+    The optional tag can be used to purge groups of messages.
     """
 
+    __slots__ = ("payload", "priority", "node", "tag", "_callback", "_timeout",
+                 "_deadline", "start", "end", "can", "state", "_inflight_lock",
+                 "action_requ", "action_resp")
+
     def __init__(self, payload, priority: tuple, callback, node,
-                 timeout=1.0, action_requ=None, action_resp=None):
+                 timeout=1.0, action_requ=None, action_resp=None, tag=None):
         self.payload = payload
         self.priority = priority
         self.node = node
+        self.tag = tag
         self._callback = callback
         self._timeout = timeout
+        self._deadline = None
         self.start = None
         self.end = None
         self.can = 0
@@ -373,21 +537,35 @@ class Message:
         self.action_resp = action_resp
         if payload is None:
             return
-        func = payload[3]
-        # mode = payload[4]
-        if action_requ is None:
-            self.action_requ = _REQUEST_ACTION[func]
-        if action_resp is None:
-            self.action_resp = _RESPONSE_ACTION[func]
+        if action_requ is None or action_resp is None:
+            requ, resp = _ACTION_DESCRIPTORS[payload[3]]
+            if action_requ is None:
+                self.action_requ = requ
+            if action_resp is None:
+                self.action_resp = resp
+
+    def Archive(self) -> ArchivedMessage:
+        return ArchivedMessage(self.payload, self.node, self.start, self.end,
+                               self.can, self.state)
 
     def _Timeout(self):
         if self._inflight_lock is None:
             return
-        self.Complete(time.time(), None, MESSAGE_STATE_TIMEOUT)
+        now = time.time()
+        if now < self._deadline:
+            # the deadline was moved while we were waiting
+            threading.Timer(self._deadline - now, self._Timeout).start()
+            return
+        self.Complete(now, None, MESSAGE_STATE_TIMEOUT)
 
     def Start(self, ts, lock):
-        self.state = MESSAGE_STATE_STARTED
+        """Returns False if the message was cancelled and must not be sent"""
+        with _START_CANCEL_LOCK:
+            if self.state == MESSAGE_STATE_CANCELLED:
+                return False
+            self.state = MESSAGE_STATE_STARTED
         self.start = ts
+        self._deadline = ts + self._timeout
         self._inflight_lock = lock
         self._inflight_lock.acquire()
         threading.Timer(self._timeout, self._Timeout).start()
@@ -395,6 +573,31 @@ class Message:
             logging.warning("Multi request command started")
             # empty list means start, None means abort
             self._callback([])
+        return True
+
+    def Cancel(self, ts=None):
+        """Withdraws a message which has not been started yet.
+
+        The callback is invoked with None just like for a timeout.
+        Returns False if it is too late for that.
+        """
+        with _START_CANCEL_LOCK:
+            if self.state != MESSAGE_STATE_CREATED:
+                return False
+            self.state = MESSAGE_STATE_CANCELLED
+        self.end = ts if ts is not None else time.time()
+        # str(self) prettifies the payload only if debug logging is on
+        logging.debug("%s: %s", MESSAGE_STATE_TO_STRING[self.state], self)
+        if self._callback:
+            self._callback(None)
+        return True
+
+    def WasCancelled(self):
+        return self.state == MESSAGE_STATE_CANCELLED
+
+    def SetTimeoutFrom(self, ts, extra=0.0):
+        """Restart the timeout clock at ts, e.g. after a re-transmission."""
+        self._deadline = ts + self._timeout + extra
 
     def IncRetry(self):
         self.can += 1
@@ -406,11 +609,12 @@ class Message:
     def _CompleteNoMessage(self, ts, state):
         assert state in MESSAGE_STATES_FINAL
         if self._inflight_lock is None:
-            logging.warning("message already completed: ", self.state)
+            logging.warning("message already completed: %s",
+                            MESSAGE_STATE_TO_STRING[self.state])
             return
         self.state = state
         self.end = ts
-        logging.info("%s: %s", state, PrettifyRawMessage(self.payload))
+        logging.info("%s: %s", MESSAGE_STATE_TO_STRING[state], PrettifyRawMessage(self.payload))
         self._inflight_lock.release()
         self._inflight_lock = None
         return state
@@ -559,6 +559,7 @@ DoorLockLogging_SupportedGet = (0x4c, 0x01)
 DoorLockLogging_SupportedReport = (0x4c, 0x02)
 DoorLockLogging_Get = (0x4c, 0x03)
 DoorLockLogging_Report = (0x4c, 0x04)
+CRC16Encap_Encap = (0x56, 0x01)
 AssociationGroupInformation_NameGet = (0x59, 0x01)
 AssociationGroupInformation_NameReport = (0x59, 0x02)
 AssociationGroupInformation_InfoGet = (0x59, 0x03)
@@ -591,9 +592,16 @@ UserCode_Get = (0x63, 0x02)
 UserCode_Report = (0x63, 0x03)
 UserCode_NumberGet = (0x63, 0x04)
 UserCode_NumberReport = (0x63, 0x05)
+Supervision_Get = (0x6c, 0x01)
+Supervision_Report = (0x6c, 0x02)
 Configuration_Set = (0x70, 0x04)
 Configuration_Get = (0x70, 0x05)
 Configuration_Report = (0x70, 0x06)
+Configuration_BulkSet = (0x70, 0x07)
+Configuration_BulkGet = (0x70, 0x08)
+Configuration_BulkReport = (0x70, 0x09)
+Configuration_PropertiesGet = (0x70, 0x0e)
+Configuration_PropertiesReport = (0x70, 0x0f)
 Alarm_Get = (0x71, 0x04)
 Alarm_Report = (0x71, 0x05)
 Alarm_Set = (0x71, 0x06)
@@ -652,6 +660,7 @@ Indicator_Report = (0x87, 0x03)
 TimeParameters_Set = (0x8b, 0x01)
 TimeParameters_Get = (0x8b, 0x02)
 TimeParameters_Report = (0x8b, 0x03)
+MultiCmd_Encap = (0x8f, 0x01)
 Security_SupportedGet = (0x98, 0x02)
 Security_SupportedReport = (0x98, 0x03)
 Security_SchemeGet = (0x98, 0x04)
@@ -744,6 +753,7 @@ SUBCMD_TO_STRING = {
     0x4c02: 'DoorLockLogging_SupportedReport',
     0x4c03: 'DoorLockLogging_Get',
     0x4c04: 'DoorLockLogging_Report',
+    0x5601: 'CRC16Encap_Encap',
     0x5901: 'AssociationGroupInformation_NameGet',
     0x5902: 'AssociationGroupInformation_NameReport',
     0x5903: 'AssociationGroupInformation_InfoGet',
@@ -776,9 +786,16 @@ SUBCMD_TO_STRING = {
     0x6303: 'UserCode_Report',
     0x6304: 'UserCode_NumberGet',
     0x6305: 'UserCode_NumberReport',
+    0x6c01: 'Supervision_Get',
+    0x6c02: 'Supervision_Report',
     0x7004: 'Configuration_Set',
     0x7005: 'Configuration_Get',
     0x7006: 'Configuration_Report',
+    0x7007: 'Configuration_BulkSet',
+    0x7008: 'Configuration_BulkGet',
+    0x7009: 'Configuration_BulkReport',
+    0x700e: 'Configuration_PropertiesGet',
+    0x700f: 'Configuration_PropertiesReport',
     0x7104: 'Alarm_Get',
     0x7105: 'Alarm_Report',
     0x7106: 'Alarm_Set',
@@ -837,6 +854,7 @@ SUBCMD_TO_STRING = {
     0x8b01: 'TimeParameters_Set',
     0x8b02: 'TimeParameters_Get',
     0x8b03: 'TimeParameters_Report',
+    0x8f01: 'MultiCmd_Encap',
     0x9802: 'Security_SupportedGet',
     0x9803: 'Security_SupportedReport',
     0x9804: 'Security_SchemeGet',
@@ -930,6 +948,7 @@ STRING_TO_SUBCMD = {
     'DoorLockLogging_SupportedReport': 0x4c02,
     'DoorLockLogging_Get': 0x4c03,
     'DoorLockLogging_Report': 0x4c04,
+    'CRC16Encap_Encap': 0x5601,
     'AssociationGroupInformation_NameGet': 0x5901,
     'AssociationGroupInformation_NameReport': 0x5902,
     'AssociationGroupInformation_InfoGet': 0x5903,
@@ -962,9 +981,16 @@ STRING_TO_SUBCMD = {
     'UserCode_Report': 0x6303,
     'UserCode_NumberGet': 0x6304,
     'UserCode_NumberReport': 0x6305,
+    'Supervision_Get': 0x6c01,
+    'Supervision_Report': 0x6c02,
     'Configuration_Set': 0x7004,
     'Configuration_Get': 0x7005,
     'Configuration_Report': 0x7006,
+    'Configuration_BulkSet': 0x7007,
+    'Configuration_BulkGet': 0x7008,
+    'Configuration_BulkReport': 0x7009,
+    'Configuration_PropertiesGet': 0x700e,
+    'Configuration_PropertiesReport': 0x700f,
     'Alarm_Get': 0x7104,
     'Alarm_Report': 0x7105,
     'Alarm_Set': 0x7106,
@@ -1023,6 +1049,7 @@ STRING_TO_SUBCMD = {
     'TimeParameters_Set': 0x8b01,
     'TimeParameters_Get': 0x8b02,
     'TimeParameters_Report': 0x8b03,
+    'MultiCmd_Encap': 0x8f01,
     'Security_SupportedGet': 0x9802,
     'Security_SupportedReport': 0x9803,
     'Security_SchemeGet': 0x9804,
@@ -1208,6 +1235,9 @@ SUBCMD_TO_PARSE_TABLE = {
     0x4c03: ['B{count}'],  # Get (3)
     0x4c04: ['B{count}', 'C{date}', 'B{type}', 'B{user}', 'A{code}'],  # Report (4)
 
+    # CRC16Encap (0x56 = 86)
+    0x5601: ['L{data}'],  # Encap (1)
+
     # AssociationGroupInformation (0x59 = 89)
     0x5901: ['B{group}'],  # NameGet (1)
     0x5902: ['B{group}', 'A{name}'],  # NameReport (2)
@@ -1235,7 +1265,7 @@ SUBCMD_TO_PARSE_TABLE = {
     0x600a: ['B{endpoint}', 'B{generic}', 'B{specific}', 'L{classes}'],  # CapabilityReport (10)
     0x600b: [],  # ChannelEndPointFind (11)
     0x600c: [],  # ChannelEndPointFindReport (12)
-    0x600d: [],  # ChannelEncap (13)
+    0x600d: ['B{src}', 'B{dst}', 'L{command}'],  # ChannelEncap (13)
 
     # DoorLock (0x62 = 98)
     0x6201: ['B{status}'],  # Set (1)
@@ -1246,16 +1276,25 @@ SUBCMD_TO_PARSE_TABLE = {
     0x6206: ['B{timeout}', 'B{control}', 'B{min}', 'B{sec}'],  # ConfigurationReport (6)
 
     # UserCode (0x63 = 99)
-    0x6301: [],  # Set (1)
+    0x6301: ['B{user}', 'B{status}', 'L{code}'],  # Set (1)
     0x6302: ['B{user}'],  # Get (2)
     0x6303: ['B{user}', 'B{status}', 'L{code}'],  # Report (3)
     0x6304: [],  # NumberGet (4)
     0x6305: ['B{count}'],  # NumberReport (5)
 
+    # Supervision (0x6c = 108)
+    0x6c01: ['B{session}', 'A{command}'],  # Get (1)
+    0x6c02: ['B{session}', 'B{status}', 'B{duration}'],  # Report (2)
+
     # Configuration (0x70 = 112)
     0x7004: ['B{parameter}', 'V{value}'],  # Set (4)
     0x7005: ['B{parameter}'],  # Get (5)
     0x7006: ['B{parameter}', 'V{value}'],  # Report (6)
+    0x7007: ['W{parameter}', 'B{count}', 'B{flags}', 'L{values}'],  # BulkSet (7)
+    0x7008: ['W{parameter}', 'B{count}'],  # BulkGet (8)
+    0x7009: ['W{parameter}', 'B{count}', 'B{follow}', 'B{flags}', 'L{values}'],  # BulkReport (9)
+    0x700e: ['W{parameter}'],  # PropertiesGet (14)
+    0x700f: ['W{parameter}', 'P{properties}'],  # PropertiesReport (15)
 
     # Alarm (0x71 = 113)
     0x7104: [],  # Get (4)
@@ -1345,6 +1384,9 @@ SUBCMD_TO_PARSE_TABLE = {
     0x8b02: [],  # Get (2)
     0x8b03: ['C{date}'],  # Report (3)
 
+    # MultiCmd (0x8f = 143)
+    0x8f01: ['B{count}', 'L{commands}'],  # Encap (1)
+
     # Security (0x98 = 152)
     0x9802: [],  # SupportedGet (2)
     0x9803: ['B{mode}', 'L{command}'],  # SupportedReport (3)
@@ -1374,7 +1416,7 @@ SUBCMD_TO_PARSE_TABLE = {
     0x9f07: ['B{type}'],  # KexFail (7)
     0x9f08: ['B{mode}', 'L{key}'],  # PublicKeyReport (8)
     0x9f09: ['B{key}'],  # NetworkKeyGet (9)
-    0x9f0a: ['B{key}', 'L{key}'],  # NetworkKeyReport (10)
+    0x9f0a: ['B{keys}', 'L{key}'],  # NetworkKeyReport (10)
     0x9f0b: [],  # NetworkKeyVerify (11)
     0x9f0c: ['B{mode}'],  # TransferEnd (12)
     0x9f0d: [],  # CommandsSupportedGet (13)